@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import logging
+import struct
+import threading
+import zlib
+import crc8
+import packet
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+# Capability and frame flags
+AGGREGATE_ZLIB = 0x01
+AGGREGATE_LZ4 = 0x02
+AGGREGATE_DELTA = 0x04
+AGGREGATE_ENABLE = 0x80 # Capability only, the peer understands aggregate frames
+AGGREGATE_COMPRESSION = AGGREGATE_ZLIB | AGGREGATE_LZ4
+AGGREGATE_SUPPORTED = AGGREGATE_ENABLE | AGGREGATE_ZLIB | AGGREGATE_DELTA | (AGGREGATE_LZ4 if lz4 is not None else 0)
+
+AGGREGATE_FLAGS = struct.Struct('B')
+AGGREGATE_SEQUENCE = struct.Struct('B')
+AGGREGATE_ID = struct.Struct('B')
+AGGREGATE_MAX_BODY = 0xFFFF - packet.PACKET_OVERHEAD - AGGREGATE_FLAGS.size - AGGREGATE_SEQUENCE.size
+AGGREGATE_ZLIB_LEVEL = 1
+AGGREGATE_KEYFRAME_INTERVAL = 16 # Frames between frames sent without delta encoding
+
+def _xor(data, reference):
+    return bytes(bytearray(a ^ b for a, b in zip(bytearray(data), bytearray(reference))))
+
+class Aggregator(object):
+    """
+    Packs many packets into one aggregate frame and unpacks them again
+    The aggregate frame is a normal frame with ID PACKET_AGGREGATE_ID and
+    the data:
+      Flags = 1 byte (AGGREGATE_ZLIB, AGGREGATE_LZ4, AGGREGATE_DELTA)
+      Sequence = 1 byte, counts the frames sent on the link
+      Body = ID (1 byte) and data of each packet, possibly compressed
+    The data size of each packet comes from the packet list, so both ends
+    must have the packet registered.  With AGGREGATE_DELTA the data of each
+    packet is XORed with the last data sent for that ID on this link, every
+    AGGREGATE_KEYFRAME_INTERVAL frames are sent without it.  A receiver
+    that misses a frame sees the gap in the sequence and discards the
+    delta frames until the next of those keyframes.
+    lock is held by the sender while it packs and sends frames and while
+    it negotiates, so the two never change the state at the same time.
+    """
+    def __init__(self, flags=0):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.flags = flags
+        self.crc = crc8.CRC8()
+        self.tx_data = {}
+        self.rx_data = {}
+        self.tx_frames = 0
+        self.tx_sequence = 0
+        self.tx_pending = None # Delta state and sequence of frames packed but not sent yet
+        self.rx_sequence = None # Sequence of the last frame received, None after a gap
+        self.rx_discarded = 0
+        self.request_version = 0
+        self.lock = threading.Lock()
+
+        return
+
+    def negotiate(self, requested):
+        """
+        Choose the flags to use from those the peer requested
+        Returns the flags chosen
+        """
+        self.logger.debug('negotiate(0x{:02x})'.format(requested))
+        flags = requested & AGGREGATE_SUPPORTED
+        if flags & AGGREGATE_LZ4:
+            # Prefer the faster compression
+            flags &= ~AGGREGATE_ZLIB
+        if not flags & AGGREGATE_COMPRESSION:
+            # Delta encoding only helps compression
+            flags &= ~AGGREGATE_DELTA
+        self.flags = flags
+        self.tx_data = {}
+        self.tx_frames = 0
+        self.tx_sequence = 0
+        self.tx_pending = None
+        self.logger.info('Aggregate flags 0x{:02x}'.format(self.flags))
+        return flags
+
+    def pack(self, records, commit=True):
+        """
+        Pack (packet ID, data) records into aggregate frames, with commit
+        False the delta encoding state only moves on when commit() is called
+        once the frames have been sent, so frames that are dropped do not
+        leave the receiver decoding against data it never got
+        Returns the frames in a single buffer
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('pack({})'.format(repr(records)))
+        delta = self.flags & AGGREGATE_DELTA and self.tx_frames % AGGREGATE_KEYFRAME_INTERVAL != 0
+        frames = []
+        body = []
+        body_size = 0
+        tx_data = {}
+        sequence = self.tx_sequence
+        for packet_id, data in records:
+            if body_size + AGGREGATE_ID.size + len(data) > AGGREGATE_MAX_BODY:
+                frames.append(self._frame(b''.join(body), delta, sequence))
+                sequence = (sequence + 1) & 0xFF
+                body = []
+                body_size = 0
+            if self.flags & AGGREGATE_DELTA:
+                if delta:
+                    body.append(AGGREGATE_ID.pack(packet_id) + _xor(data, self.tx_data.get(packet_id, bytes(bytearray(len(data))))))
+                else:
+                    body.append(AGGREGATE_ID.pack(packet_id) + data)
+                tx_data[packet_id] = data
+            else:
+                body.append(AGGREGATE_ID.pack(packet_id) + data)
+            body_size += AGGREGATE_ID.size + len(data)
+        if body:
+            frames.append(self._frame(b''.join(body), delta, sequence))
+            sequence = (sequence + 1) & 0xFF
+        self.tx_pending = (tx_data, sequence)
+        if commit:
+            self.commit()
+        return b''.join(frames)
+
+    def commit(self):
+        """
+        Keep the delta encoding state of the frames last packed, once they
+        have been sent
+        """
+        if self.tx_pending is None:
+            return
+        tx_data, self.tx_sequence = self.tx_pending
+        self.tx_data.update(tx_data)
+        self.tx_frames += 1
+        self.tx_pending = None
+
+    def _frame(self, body, delta, sequence):
+        flags = AGGREGATE_DELTA if delta else 0
+        if self.flags & AGGREGATE_LZ4:
+            compressed = lz4.block.compress(body)
+            if len(compressed) < len(body):
+                body = compressed
+                flags |= AGGREGATE_LZ4
+        elif self.flags & AGGREGATE_ZLIB:
+            compressor = zlib.compressobj(AGGREGATE_ZLIB_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+            compressed = compressor.compress(body) + compressor.flush()
+            if len(compressed) < len(body):
+                body = compressed
+                flags |= AGGREGATE_ZLIB
+        data = AGGREGATE_FLAGS.pack(flags) + AGGREGATE_SEQUENCE.pack(sequence) + body
+        header = packet.PACKET_HEADER.pack(packet.PACKET_START_BYTES[0], packet.PACKET_START_BYTES[1],
+                                           len(data) + packet.PACKET_OVERHEAD, packet.PACKET_AGGREGATE_ID)
+        return header + data + packet.PACKET_CRC.pack(self.crc.calculate(data))
+
+    def unpack(self, frame, packet_list):
+        """
+        Unpack every packet in an aggregate frame into the packets of
+        packet_list, the frame CRC must already have been checked
+        Returns the packets unpacked or None if the frame is a delta from a
+        frame that was not received, it is discarded
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('unpack({})'.format(repr(frame)))
+        flags = AGGREGATE_FLAGS.unpack_from(frame, packet.PACKET_HEADER.size)[0]
+        sequence = AGGREGATE_SEQUENCE.unpack_from(frame, packet.PACKET_HEADER.size + AGGREGATE_FLAGS.size)[0]
+        if flags & AGGREGATE_DELTA and (self.rx_sequence is None or sequence != (self.rx_sequence + 1) & 0xFF):
+            if self.rx_sequence is not None:
+                self.logger.warning('Aggregate frame {} missing, deltas discarded until a keyframe'.format((self.rx_sequence + 1) & 0xFF))
+            self.rx_sequence = None
+            self.rx_discarded += 1
+            return None
+        self.rx_sequence = sequence
+        body = frame[packet.PACKET_HEADER.size + AGGREGATE_FLAGS.size + AGGREGATE_SEQUENCE.size:-packet.PACKET_CRC.size]
+        try:
+            if flags & AGGREGATE_LZ4:
+                if lz4 is None:
+                    self.logger.error('LZ4 aggregate received but lz4 is not installed')
+                    raise ValueError
+                body = lz4.block.decompress(body)
+            elif flags & AGGREGATE_ZLIB:
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        except Exception as e:
+            self.logger.error('Aggregate decompression failed {}'.format(repr(e)))
+            raise ValueError
+        pkts = []
+        index = 0
+        while index < len(body):
+            packet_id = AGGREGATE_ID.unpack_from(body, index)[0]
+            if packet_id < len(packet_list) and packet_id != packet.PACKET_AGGREGATE_ID:
+                pkt = packet_list[packet_id]
+            else:
+                pkt = None
+            if pkt is None:
+                self.logger.warning('Unknown packet ID 0x{:02x} in aggregate, rest dropped'.format(packet_id))
+                break
+            index += AGGREGATE_ID.size
+            size = pkt._struct.size
+            data = body[index:index + size]
+            if len(data) != size:
+                self.logger.warning('Aggregate truncated in packet ID 0x{:02x}'.format(packet_id))
+                break
+            if flags & AGGREGATE_DELTA:
+                data = _xor(data, self.rx_data.get(packet_id, bytes(bytearray(size))))
+            self.rx_data[packet_id] = data
+            pkt._from_bytes(data)
+            pkts.append(pkt)
+            index += size
+        return pkts
+
+if __name__ == '__main__':
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test aggregate frames')
+
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets per aggregate',
+                        type=int,
+                        default=20)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    tx_packets = [None] * packet.PACKET_MAX_ID
+    rx_packets = [None] * packet.PACKET_MAX_ID
+    for packet_id in range(1, args.num_packets + 1):
+        tx_packets[packet_id] = packet.Packet(format='f', id=packet_id, name='Value {}'.format(packet_id),
+                                              element_names=['value'], element_values=[random.uniform(0, 100)])
+        rx_packets[packet_id] = packet.Packet(format='f', id=packet_id, name='Value {}'.format(packet_id),
+                                              element_names=['value'])
+    records = [(pkt.id, pkt._to_bytes()) for pkt in tx_packets if pkt is not None]
+
+    single_size = sum(len(pkt.pack()) for pkt in tx_packets if pkt is not None)
+    print('{} separate frames: {} bytes'.format(args.num_packets, single_size))
+    for flags in (AGGREGATE_ENABLE, AGGREGATE_ENABLE | AGGREGATE_ZLIB,
+                  AGGREGATE_ENABLE | AGGREGATE_ZLIB | AGGREGATE_DELTA):
+        tx_aggregator = Aggregator()
+        tx_aggregator.negotiate(flags)
+        rx_aggregator = Aggregator()
+        sizes = []
+        for i in range(0, 3):
+            frame = tx_aggregator.pack(records)
+            sizes.append(len(frame))
+            rx_aggregator.unpack(frame, rx_packets)
+        print('Aggregate flags 0x{:02x}: {} bytes'.format(tx_aggregator.flags, sizes))
+    # A delta frame that was dropped rather than sent is never committed, so
+    # the next frame still decodes
+    for pkt in tx_packets[1:args.num_packets + 1]:
+        pkt.value = random.uniform(0, 100)
+    tx_aggregator.pack([(pkt.id, pkt._to_bytes()) for pkt in tx_packets if pkt is not None], False)
+    for pkt in tx_packets[1:args.num_packets + 1]:
+        pkt.value = random.uniform(0, 100)
+    rx_aggregator.unpack(tx_aggregator.pack([(pkt.id, pkt._to_bytes()) for pkt in tx_packets if pkt is not None]), rx_packets)
+    for packet_id in range(1, args.num_packets + 1):
+        assert rx_packets[packet_id].value == tx_packets[packet_id]._struct.unpack(tx_packets[packet_id]._to_bytes())[0]
+    # A delta frame that was sent but lost leaves a gap in the sequence, the
+    # deltas after it are discarded until the next keyframe
+    def changed_records():
+        for pkt in tx_packets[1:args.num_packets + 1]:
+            pkt.value = random.uniform(0, 100)
+        return [(pkt.id, pkt._to_bytes()) for pkt in tx_packets if pkt is not None]
+    tx_aggregator.pack(changed_records())
+    while tx_aggregator.tx_frames % AGGREGATE_KEYFRAME_INTERVAL != 0:
+        assert rx_aggregator.unpack(tx_aggregator.pack(changed_records()), rx_packets) is None
+    assert rx_aggregator.unpack(tx_aggregator.pack(changed_records()), rx_packets)
+    assert rx_aggregator.unpack(tx_aggregator.pack(changed_records()), rx_packets)
+    for packet_id in range(1, args.num_packets + 1):
+        assert rx_packets[packet_id].value == tx_packets[packet_id]._struct.unpack(tx_packets[packet_id]._to_bytes())[0]
+    print('{} delta frames discarded after a lost frame'.format(rx_aggregator.rx_discarded))
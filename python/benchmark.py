@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import errno
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import timeit
+import client
+import crc8
+import decoder
+import packet
+import reactor
+import server
+
+BENCHMARK_LOG_FORMAT = '%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s'
+BENCHMARK_CRC_SIZES = [16, 64, 256, 1024, 4096]
+BENCHMARK_FORMATS = [('small', 'f'), ('mixed', 'iIcf12s'), ('medium', '32f'), ('large', '256d')]
+BENCHMARK_PERCENTILES = [50, 90, 99]
+BENCHMARK_TIMEOUT = 30.0
+# MyServer's client threads select() on their sockets, which fails once a
+# descriptor passes FD_SETSIZE (1024), and this process holds both ends of
+# every connection
+BENCHMARK_THREADED_MAX_CONNECTIONS = 400
+
+def _packet():
+    return packet.Packet(format='iIcf12s',
+                         id=0x01,
+                         name='Benchmark Packet',
+                         element_names=['SIGNED_INT', 'UNSIGNED_INT', 'CHAR', 'FLOAT', 'STRING'],
+                         element_values=[-2353, 1782, b'A', 28.1734, b'Sweet String'])
+
+def bench_logging(count):
+    """
+    Time per packet to pack, decode and unpack with the root logger at each
+    level, log records are formatted and written to os.devnull
+    Returns a dictionary of level name to seconds per packet
+    """
+    root_logger = logging.getLogger()
+    saved_level = root_logger.level
+    saved_handlers = root_logger.handlers[:]
+    null_stream = open(os.devnull, 'w')
+    handler = logging.StreamHandler(null_stream)
+    handler.setFormatter(logging.Formatter(BENCHMARK_LOG_FORMAT))
+    root_logger.handlers = [handler]
+
+    tx_packet = _packet()
+    rx_packet = _packet()
+    frame_decoder = decoder.FrameDecoder()
+
+    def round_trip():
+        frame_decoder.feed(tx_packet.pack())
+        for packet_id, frame in frame_decoder.frames():
+            rx_packet.unpack(frame)
+
+    results = {}
+    try:
+        for level in (logging.WARNING, logging.INFO, logging.DEBUG):
+            root_logger.setLevel(level)
+            results[logging.getLevelName(level)] = timeit.timeit(round_trip, number=count) / count
+    finally:
+        root_logger.setLevel(saved_level)
+        root_logger.handlers = saved_handlers
+        null_stream.close()
+    return results
+
+def _connect(address, timeout=5.0):
+    # The server socket is put into listening state by the server thread
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(address)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED or time.time() > deadline:
+                raise
+            time.sleep(0.01)
+
+def _serve(server_class, status_packet, connections, keepalive, read):
+    # Start a server publishing status_packet and connect raw sockets to it
+    # that are read by read(skt) from the returned reactor
+    my_server = server_class('127.0.0.1', 0)
+    my_server.add_packet(status_packet)
+    my_server.add_status(status_packet.id)
+    server_thread = threading.Thread(target=my_server.start)
+    server_thread.setDaemon(True)
+    server_thread.start()
+
+    address = my_server.serversocket.getsockname()
+    sockets = [_connect(address) for i in range(connections)]
+
+    request = packet.subscribe_packet([status_packet.id], server.SERVER_MAX_PACKET_RATE, keepalive).pack()
+    for skt in sockets:
+        skt.sendall(request)
+
+    rx_reactor = reactor.Reactor()
+    for skt in sockets:
+        skt.setblocking(0)
+        rx_reactor.add_reader(skt, read, skt)
+
+    # Let the server settle after the connections before measuring
+    settle_time = timeit.default_timer() + server.SERVER_MAX_PACKET_RATE * 2
+    while timeit.default_timer() < settle_time:
+        rx_reactor.run_once(server.SERVER_MAX_PACKET_RATE)
+    return my_server, server_thread, sockets, rx_reactor
+
+def _unserve(my_server, server_thread, sockets, rx_reactor):
+    # Stop the server so its sockets and threads, client threads included,
+    # are gone before the next measurement
+    for skt in sockets:
+        rx_reactor.remove_reader(skt)
+        skt.close()
+    rx_reactor.close()
+    my_server.stop()
+    server_thread.join()
+
+class _ErrorCount(logging.Handler):
+    # Counts the errors logged while a server benchmark runs
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+def _run_server_benchmark(function, server_class, connections, duration):
+    """
+    Returns the result of function(server_class, connections, duration),
+    or {'errors': count} if any errors were logged while it ran so a broken
+    run is not taken for a measurement
+    """
+    errors = _ErrorCount()
+    root_logger = logging.getLogger()
+    root_logger.addHandler(errors)
+    try:
+        result = function(server_class, connections, duration)
+    finally:
+        root_logger.removeHandler(errors)
+    if errors.count:
+        return {'errors': errors.count}
+    return result
+
+def _server_classes(connections):
+    if connections > BENCHMARK_THREADED_MAX_CONNECTIONS:
+        return (server.MyEventServer,)
+    return (server.MyServer, server.MyEventServer)
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return dict(('p{}'.format(percentile), None) for percentile in BENCHMARK_PERCENTILES + [100])
+    results = dict(('p{}'.format(percentile), values[int(round(percentile / 100.0 * (len(values) - 1)))])
+                   for percentile in BENCHMARK_PERCENTILES)
+    results['p100'] = values[-1]
+    return results
+
+def bench_crc(sizes, duration):
+    """
+    Bytes per second CRC8.calculate() processes for each data size, and
+    CRC8.calculate_matrix() for 1000 rows of each size if NumPy is installed
+    """
+    my_crc = crc8.CRC8()
+    generator = random.Random(0)
+    results = {}
+    for size in sizes:
+        data = bytes(bytearray(generator.getrandbits(8) for i in range(size)))
+        count = max(1, int(duration * 1e6 / size))
+        seconds = timeit.timeit(lambda: my_crc.calculate(data), number=count)
+        results[str(size)] = {'calculate': size * count / seconds}
+        if crc8.numpy is not None:
+            matrix = crc8.numpy.frombuffer(data * 1000, dtype=crc8.numpy.uint8).reshape(1000, size)
+            count = max(1, count // 1000)
+            seconds = timeit.timeit(lambda: my_crc.calculate_matrix(matrix), number=count)
+            results[str(size)]['calculate_matrix'] = matrix.size * count / seconds
+    return results
+
+def bench_packet(count):
+    """
+    Operations per second of pack() and unpack() for each of
+    BENCHMARK_FORMATS, with Packet and with a packet_class() class
+    """
+    results = {}
+    for name, format in BENCHMARK_FORMATS:
+        element_names = ['e{}'.format(index) for index in range(len(packet.element_formats(format)))]
+        element_values = [b'A' if element_format == 'c' else b'Sweet String' if element_format[-1] == 's' else 1
+                          for element_format in packet.element_formats(format)]
+        classic = packet.Packet(format=format, id=0x01, name=name, element_names=element_names, element_values=element_values)
+        compact = packet.packet_class(format, 0x01, name, element_names)(*element_values)
+        frame = classic.pack()
+        results[name] = {'size': classic.size}
+        for kind, pkt in (('packet', classic), ('compact', compact)):
+            results[name][kind + '_pack'] = count / timeit.timeit(pkt.pack, number=count)
+            results[name][kind + '_unpack'] = count / timeit.timeit(lambda: pkt.unpack(frame), number=count)
+    return results
+
+def bench_client(transport, count):
+    """
+    Frames per second MyClient.process_input() receives from a sender thread
+    over a socketpair or loopback TCP
+    """
+    if transport == 'socketpair':
+        rx_socket, tx_socket = socket.socketpair()
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        tx_socket = socket.create_connection(listener.getsockname())
+        rx_socket = listener.accept()[0]
+        listener.close()
+
+    tx_packet = _packet()
+    frames = []
+    for index in range(count):
+        tx_packet.UNSIGNED_INT = index
+        frames.append(tx_packet.pack())
+    data = b''.join(frames)
+    rx_packet = _packet()
+    my_client = client.MyClient(skt=rx_socket)
+    my_client.add_packet(rx_packet)
+
+    sender = threading.Thread(target=tx_socket.sendall, args=(data,))
+    sender.setDaemon(True)
+    start = timeit.default_timer()
+    sender.start()
+    while rx_packet.UNSIGNED_INT != count - 1 and timeit.default_timer() - start < BENCHMARK_TIMEOUT:
+        my_client.process_input(1.0)
+    seconds = timeit.default_timer() - start
+    sender.join()
+    tx_socket.close()
+    my_client.close()
+    return {'frames_per_second': count / seconds, 'bytes_per_second': len(data) / seconds}
+
+def bench_latency(server_class, connections, duration):
+    """
+    Seconds from a status packet changing to each client receiving it, the
+    value changes every SERVER_MAX_PACKET_RATE and clients subscribe to
+    changes only, so this includes waiting for the next status tick
+    Returns the latency percentiles in seconds and the fan-out percentiles,
+    the seconds from the first client receiving a value to each of the
+    others receiving it
+    """
+    status_packet = packet.Packet(format='d',
+                                  id=0x01,
+                                  name='Benchmark Time',
+                                  element_names=['time'],
+                                  element_values=[0.0])
+    value = struct.Struct(status_packet.format)
+    decoders = {}
+    arrivals = {}
+    measuring = [False]
+
+    def read(skt):
+        frame_decoder = decoders.setdefault(skt, decoder.FrameDecoder())
+        frame_decoder.recv(skt, decoder.DECODER_CHUNK_SIZE)
+        now = time.time()
+        for packet_id, frame in frame_decoder.frames():
+            if measuring[0]:
+                arrivals.setdefault(value.unpack_from(frame, packet.PACKET_HEADER.size)[0], []).append(now)
+
+    running = [True]
+
+    def update():
+        while running[0]:
+            status_packet.time = time.time()
+            time.sleep(server.SERVER_MAX_PACKET_RATE)
+
+    updater = threading.Thread(target=update)
+    updater.setDaemon(True)
+    updater.start()
+
+    my_server, server_thread, sockets, rx_reactor = _serve(server_class, status_packet, connections, -1.0, read)
+    measuring[0] = True
+    end = timeit.default_timer() + duration
+    now = timeit.default_timer()
+    while now < end:
+        rx_reactor.run_once(end - now)
+        now = timeit.default_timer()
+    running[0] = False
+    _unserve(my_server, server_thread, sockets, rx_reactor)
+    updater.join()
+
+    latencies = [arrival - changed for changed, times in arrivals.items() for arrival in times]
+    fanouts = [arrival - min(times) for times in arrivals.values() for arrival in times]
+    return {'latency': _percentiles(latencies),
+            'fanout': _percentiles(fanouts),
+            'samples': len(latencies)}
+
+def bench_server(server_class, connections, duration):
+    """
+    Connect raw sockets to a server publishing one status packet and count
+    the frames received in duration seconds, all sockets are read from a
+    single event loop in this thread
+    Returns a dictionary of the frames received, the fraction of the
+    expected frames and the CPU time used by the process per second
+    """
+    status_packet = packet.Packet(format='f',
+                                  id=0x01,
+                                  name='Benchmark Value',
+                                  element_names=['value'],
+                                  element_values=[0.0])
+    bytes_received = [0]
+
+    def read(skt):
+        bytes_received[0] += len(skt.recv(65536))
+
+    # Ask for every update, not just changes, so each tick is a full fan-out
+    my_server, server_thread, sockets, rx_reactor = _serve(server_class, status_packet, connections, 0.0, read)
+    bytes_received[0] = 0
+    cpu_start = sum(os.times()[:2])
+    start = timeit.default_timer()
+    end = start + duration
+    now = start
+    while now < end:
+        rx_reactor.run_once(end - now)
+        now = timeit.default_timer()
+    cpu_time = sum(os.times()[:2]) - cpu_start
+    threads = threading.active_count()
+
+    _unserve(my_server, server_thread, sockets, rx_reactor)
+
+    frames = bytes_received[0] // status_packet.size
+    expected = connections * (now - start) / server.SERVER_MAX_PACKET_RATE
+    return {'frames': frames,
+            'delivered': frames / expected,
+            'cpu': cpu_time / (now - start),
+            'threads': threads}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Packet processing benchmarks')
+
+    parser.add_argument('benchmarks',
+                        help='Benchmarks to run (logging, crc, packet, client, server, latency)',
+                        nargs='*',
+                        default=['logging', 'crc', 'packet', 'client', 'server', 'latency'])
+    parser.add_argument('-n', '--count',
+                        help='Number of packets per measurement',
+                        type=int,
+                        default=10000)
+    parser.add_argument('-c', '--connections',
+                        help='Connection counts for the server benchmarks',
+                        type=int,
+                        nargs='+',
+                        default=[10, 100, 500])
+    parser.add_argument('-d', '--duration',
+                        help='Seconds per server measurement',
+                        type=float,
+                        default=2.0)
+    parser.add_argument('-j', '--json',
+                        help='Write the results as JSON to this file, - for stdout',
+                        default=None)
+
+    args = parser.parse_args()
+
+    # Human readable output goes to stderr when the JSON goes to stdout
+    out = sys.stderr if args.json == '-' else sys.stdout
+    results = {'version': {'python': platform.python_version(),
+                           'platform': platform.platform(),
+                           'numpy': crc8.numpy is not None,
+                           'crc8_native': crc8.crc8_native is not None},
+               'time': time.time(),
+               'arguments': vars(args)}
+
+    if 'logging' in args.benchmarks:
+        results['logging'] = bench_logging(args.count)
+        print('Logging overhead (pack, decode and unpack):', file=out)
+        for level, seconds in sorted(results['logging'].items(), key=lambda item: item[1]):
+            print('  {:7s} {:8.2f} us/packet'.format(level, seconds * 1e6), file=out)
+
+    if 'crc' in args.benchmarks:
+        results['crc'] = bench_crc(BENCHMARK_CRC_SIZES, 0.2)
+        print('CRC8 throughput:', file=out)
+        for size in BENCHMARK_CRC_SIZES:
+            print('  {:5d} bytes: {}'.format(size, ', '.join('{} {:8.2f} MB/s'.format(name, rate / 1e6)
+                  for name, rate in sorted(results['crc'][str(size)].items()))), file=out)
+
+    if 'packet' in args.benchmarks:
+        results['packet'] = bench_packet(args.count)
+        print('Packet operations:', file=out)
+        for name, format in BENCHMARK_FORMATS:
+            result = results['packet'][name]
+            print('  {:6s} {:5d} bytes: pack {:9.0f}/s unpack {:9.0f}/s, compact pack {:9.0f}/s unpack {:9.0f}/s'.format(
+                  name, result['size'], result['packet_pack'], result['packet_unpack'],
+                  result['compact_pack'], result['compact_unpack']), file=out)
+
+    if 'client' in args.benchmarks:
+        results['client'] = {}
+        print('MyClient.process_input:', file=out)
+        for transport in ('socketpair', 'tcp'):
+            results['client'][transport] = bench_client(transport, args.count)
+            print('  {:10s} {:9.0f} frames/s'.format(transport, results['client'][transport]['frames_per_second']), file=out)
+
+    if 'server' in args.benchmarks:
+        results['server'] = {}
+        print('Status fan-out by connection count:', file=out)
+        for connections in args.connections:
+            if server.MyServer not in _server_classes(connections):
+                print('  {:13s} {:5d} connections: skipped, over {} connections'.format(
+                      server.MyServer.__name__, connections, BENCHMARK_THREADED_MAX_CONNECTIONS), file=out)
+            for server_class in _server_classes(connections):
+                result = _run_server_benchmark(bench_server, server_class, connections, args.duration)
+                results['server'].setdefault(server_class.__name__, {})[str(connections)] = result
+                if 'errors' in result:
+                    print('  {:13s} {:5d} connections: failed, {} errors logged'.format(
+                          server_class.__name__, connections, result['errors']), file=out)
+                    continue
+                print('  {:13s} {:5d} connections: {:5.1f}% delivered, {:5.1f}% CPU, {:5d} threads'.format(
+                      server_class.__name__, connections, result['delivered'] * 100, result['cpu'] * 100, result['threads']), file=out)
+
+    if 'latency' in args.benchmarks:
+        results['latency'] = {}
+        print('Status change to client latency by connection count:', file=out)
+        for connections in args.connections:
+            if server.MyServer not in _server_classes(connections):
+                print('  {:13s} {:5d} connections: skipped, over {} connections'.format(
+                      server.MyServer.__name__, connections, BENCHMARK_THREADED_MAX_CONNECTIONS), file=out)
+            for server_class in _server_classes(connections):
+                result = _run_server_benchmark(bench_latency, server_class, connections, args.duration)
+                results['latency'].setdefault(server_class.__name__, {})[str(connections)] = result
+                if 'errors' in result:
+                    print('  {:13s} {:5d} connections: failed, {} errors logged'.format(
+                          server_class.__name__, connections, result['errors']), file=out)
+                    continue
+                for kind in ('latency', 'fanout'):
+                    print('  {:13s} {:5d} connections {:7s}: {}'.format(server_class.__name__, connections, kind, ', '.join(
+                          '{} {:7.2f} ms'.format(name, result[kind][name] * 1e3) if result[kind][name] is not None else '{} -'.format(name)
+                          for name in ['p{}'.format(percentile) for percentile in BENCHMARK_PERCENTILES] + ['p100'])), file=out)
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif args.json is not None:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import array
+import logging
+import mmap
+import os
+import struct
+import time
+import packet
+
+try:
+    import numpy
+    import columnar
+except ImportError:
+    numpy = None
+
+CAPTURE_INDEX_SUFFIX = '.idx'
+CAPTURE_INDEX = struct.Struct('<dQB') # Timestamp, frame offset and packet ID
+CAPTURE_LENGTH = struct.Struct('H')
+CAPTURE_LENGTH_OFFSET = 2
+
+if numpy is not None:
+    CAPTURE_INDEX_DTYPE = numpy.dtype([('timestamp', '<f8'), ('offset', '<u8'), ('id', 'u1')])
+
+def _mmap(f):
+    # mmap cannot map an empty file
+    if os.fstat(f.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class CaptureWriter(object):
+    """
+    Appends received frames to a capture file
+    The capture file holds the frames exactly as received, so it can be
+    replayed through the frame decoder.  Each frame also gets a record in a
+    sidecar index file (CAPTURE_INDEX_SUFFIX) of timestamp, offset of the
+    frame in the capture file and packet ID.  Timestamps never go backwards
+    so readers can binary search them.
+    """
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.path = path
+        self.file = open(path, 'ab')
+        self.index_file = open(path + CAPTURE_INDEX_SUFFIX, 'ab')
+        self.offset = self.file.tell()
+        self.last_timestamp = 0.0
+        self.frames = 0
+        self.logger.info('Capturing to {} from offset {}'.format(repr(path), self.offset))
+
+        return
+
+    def write(self, frame, packet_id=None, timestamp=None):
+        """
+        Append one complete frame, packet_id defaults to the ID in the frame
+        header and timestamp to now
+        """
+        if packet_id is None:
+            packet_id = packet.PACKET_HEADER.unpack_from(frame)[3]
+        if timestamp is None:
+            timestamp = time.time()
+        timestamp = max(timestamp, self.last_timestamp)
+        self.file.write(frame)
+        self.index_file.write(CAPTURE_INDEX.pack(timestamp, self.offset, packet_id))
+        self.offset += len(frame)
+        self.last_timestamp = timestamp
+        self.frames += 1
+
+    def flush(self):
+        self.file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        self.logger.debug('close()')
+        self.file.close()
+        self.index_file.close()
+
+class CaptureReader(object):
+    """
+    Random access to a capture file written by CaptureWriter
+    The capture and index files are memory mapped so only the pages used
+    are read, frames are returned as slices of the map.  Selecting frames by
+    packet ID uses NumPy if it is installed.
+    """
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.path = path
+        self.file = open(path, 'rb')
+        self.index_file = open(path + CAPTURE_INDEX_SUFFIX, 'rb')
+        self.data = _mmap(self.file)
+        self.index = _mmap(self.index_file)
+        self.count = len(self.index) // CAPTURE_INDEX.size
+        self.logger.info('Opened capture {} with {} frames'.format(repr(path), self.count))
+
+        return
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, n):
+        """
+        Returns (timestamp, offset, packet ID) of the n'th frame
+        """
+        return CAPTURE_INDEX.unpack_from(self.index, n * CAPTURE_INDEX.size)
+
+    def frame(self, n):
+        offset = self.entry(n)[1]
+        length = CAPTURE_LENGTH.unpack_from(self.data, offset + CAPTURE_LENGTH_OFFSET)[0]
+        return self.data[offset:offset + length]
+
+    def find_time(self, timestamp):
+        """
+        Returns the number of the first frame at or after timestamp
+        """
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def select(self, packet_id=None, start=None, end=None):
+        """
+        Returns the timestamps and offsets of the frames with packet_id (any
+        if None) from start up to but not including end
+        """
+        first = 0 if start is None else self.find_time(start)
+        last = self.count if end is None else self.find_time(end)
+        if first >= last:
+            return [], []
+        if numpy is not None:
+            entries = numpy.frombuffer(self.index, CAPTURE_INDEX_DTYPE, last - first, first * CAPTURE_INDEX.size)
+            if packet_id is not None:
+                entries = entries[entries['id'] == packet_id]
+            return entries['timestamp'], entries['offset']
+        timestamps = []
+        offsets = []
+        for n in range(first, last):
+            timestamp, offset, entry_id = self.entry(n)
+            if packet_id is None or entry_id == packet_id:
+                timestamps.append(timestamp)
+                offsets.append(offset)
+        return timestamps, offsets
+
+    def frames(self, packet_id=None, start=None, end=None):
+        """
+        Generator of (timestamp, frame) for the selected frames
+        """
+        timestamps, offsets = self.select(packet_id, start, end)
+        for timestamp, offset in zip(timestamps, offsets):
+            offset = int(offset)
+            length = CAPTURE_LENGTH.unpack_from(self.data, offset + CAPTURE_LENGTH_OFFSET)[0]
+            yield timestamp, self.data[offset:offset + length]
+
+    def columns(self, pkt, start=None, end=None):
+        """
+        Decode every frame of pkt.id from start to end into one column per
+        element, the frames were checked by the decoder when captured
+        Returns a dictionary of element name to values plus 'timestamp',
+        numeric columns are arrays and other columns are lists, all of them
+        are NumPy arrays if NumPy is installed
+        """
+        self.logger.debug('columns({}, {}, {})'.format(repr(pkt.name), repr(start), repr(end)))
+        if numpy is not None:
+            return self._numpy_columns(pkt, start, end)
+        rows = []
+        kept = []
+        for timestamp, offset in zip(*self.select(pkt.id, start, end)):
+            offset = int(offset)
+            if CAPTURE_LENGTH.unpack_from(self.data, offset + CAPTURE_LENGTH_OFFSET)[0] != pkt.size:
+                self.logger.warning('Frame at {} is not the size of {}'.format(offset, repr(pkt.name)))
+                continue
+            rows.append(pkt._struct.unpack_from(self.data, offset + packet.PACKET_HEADER.size))
+            kept.append(timestamp)
+        columns = {'timestamp': array.array('d', kept)}
+        values = list(zip(*rows)) or [()] * len(pkt.element_names)
+        for element_name, element_format, column in zip(pkt.element_names, packet.element_formats(pkt.format), values):
+            if element_format in packet.PACKET_ARRAY_FORMATS:
+                columns[element_name] = array.array(element_format, column)
+            else:
+                columns[element_name] = list(column)
+        return columns
+
+    def _numpy_columns(self, pkt, start, end):
+        timestamps, offsets = self.select(pkt.id, start, end)
+        if len(offsets) == 0:
+            columns = columnar.decode_rows(pkt, numpy.zeros((0, pkt.size), dtype=numpy.uint8), check=False)
+        else:
+            lengths = columnar.gather(self.data, offsets + CAPTURE_LENGTH_OFFSET, CAPTURE_LENGTH.size).view(numpy.uint16).reshape(-1)
+            valid = lengths == pkt.size
+            if not valid.all():
+                self.logger.warning('{} frames are not the size of {}'.format(len(valid) - valid.sum(), repr(pkt.name)))
+                timestamps = timestamps[valid]
+                offsets = offsets[valid]
+            columns = columnar.decode_rows(pkt, columnar.gather(self.data, offsets, pkt.size), check=False)
+        columns['timestamp'] = numpy.array(timestamps)
+        return columns
+
+    def close(self):
+        self.logger.debug('close()')
+        for mapped in (self.data, self.index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self.file.close()
+        self.index_file.close()
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import tempfile
+    import timeit
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test capture files')
+
+    parser.add_argument('-f', '--file',
+                        help='Capture file to write, a temporary file if not given',
+                        default=None)
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets to capture',
+                        type=int,
+                        default=100000)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    path = args.file
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.cap')
+        os.close(handle)
+
+    value_packet = packet.Packet(format='If', id=0x01, name='Value', element_names=['count', 'value'], element_values=[0, 0.0])
+    name_packet = packet.Packet(format='12s', id=0x02, name='Name', element_names=['name'], element_values=[b'Sweet String'])
+
+    writer = CaptureWriter(path)
+    start = timeit.default_timer()
+    for count in range(args.num_packets):
+        if count % 10 == 0:
+            writer.write(name_packet.pack(), name_packet.id, 1000.0 + count)
+        value_packet.count = count
+        value_packet.value = random.uniform(0, 100)
+        writer.write(value_packet.pack(), value_packet.id, 1000.0 + count)
+    writer.close()
+    print('Wrote {} frames in {:.3f} s'.format(writer.frames, timeit.default_timer() - start))
+
+    reader = CaptureReader(path)
+    start = timeit.default_timer()
+    columns = reader.columns(value_packet, 1000.0 + args.num_packets // 2, 1000.0 + args.num_packets // 2 + 1000)
+    print('Decoded {} of {} frames in {:.3f} s, counts {} to {}'.format(
+          len(columns['count']), len(reader), timeit.default_timer() - start, columns['count'][0], columns['count'][-1]))
+    reader.close()
+
+    if args.file is None:
+        os.remove(path)
+        os.remove(path + CAPTURE_INDEX_SUFFIX)
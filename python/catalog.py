@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Generated by schema.py from packets.json, do not edit
+from __future__ import(print_function)
+
+import struct
+import crc8
+import packet
+
+_HEADER = packet.PACKET_HEADER
+_CRC = packet.PACKET_CRC
+_crc = crc8.CRC8()
+_calculate = _crc.calculate
+_calculate_from = _crc.calculate_from
+# Slots are set through their descriptors, which skips __setattr__
+_set_version = packet.CompactPacket.version.__set__
+_set_trace_interval = packet.CompactPacket.trace_interval.__set__
+_set_trace_count = packet.CompactPacket._trace_count.__set__
+# Element names are only used as arguments and attributes, locals and
+# globals start with _ so an element can not hide them
+_TRACE_INTERVAL = packet.PACKET_TRACE_INTERVAL
+_bool = bool
+_bytes = bytes
+_float = float
+_int = int
+_element_value = packet.element_value
+
+class ServerValue(packet.CompactPacket):
+    """
+    Server Value, ID 0x01
+    """
+    __slots__ = ('value',)
+    format = '<f'
+    id = 0x01
+    name = 'Server Value'
+    element_names = __slots__
+    size = 10
+    _struct = struct.Struct(format)
+    _element_types = {'value': float}
+    _defaults = (0.0,)
+
+    def __init__(self, value=0.0):
+        _set_version(self, 0)
+        _set_trace_interval(self, _TRACE_INTERVAL)
+        _set_trace_count(self, 0)
+        _set_server_value_value(self, _element_value(_float, value))
+
+    def _values(self):
+        return (self.value,)
+
+    def _set_values(self, values):
+        (_0,) = values
+        _set_server_value_value(self, _0)
+        _set_version(self, self.version + 1)
+
+    def pack(self):
+        data = _SERVER_VALUE_STRUCT.pack(self.value)
+        return _SERVER_VALUE_HEADER + data + _CRC.pack(_calculate(data))
+
+    def unpack_from(self, buffer, offset=0, check_crc=True):
+        header = _HEADER.unpack_from(buffer, offset)
+        if header != _SERVER_VALUE_HEADER_VALUES:
+            self.logger.error('Bad header {} != {}'.format(repr(header), repr(_SERVER_VALUE_HEADER_VALUES)))
+            raise ValueError
+        if check_crc:
+            crc = _calculate_from(buffer, offset + 5, 4)
+            if _CRC.unpack_from(buffer, offset + 9)[0] != crc:
+                self.logger.error('Bad CRC 0x{:02x} != 0x{:02x}'.format(crc, _CRC.unpack_from(buffer, offset + 9)[0]))
+                raise ValueError
+        (_0,) = _SERVER_VALUE_STRUCT.unpack_from(buffer, offset + 5)
+        _set_server_value_value(self, _0)
+        _set_version(self, self.version + 1)
+        if self.trace_interval:
+            self._trace(header)
+        return 10
+
+_SERVER_VALUE_STRUCT = ServerValue._struct
+_SERVER_VALUE_HEADER_VALUES = (packet.PACKET_START_BYTES[0], packet.PACKET_START_BYTES[1], 10, 0x01)
+_SERVER_VALUE_HEADER = _HEADER.pack(*_SERVER_VALUE_HEADER_VALUES)
+_set_server_value_value = ServerValue.value.__set__
+
+class ServerValue2(packet.CompactPacket):
+    """
+    Server Value 2, ID 0x02
+    """
+    __slots__ = ('value_2',)
+    format = '<f'
+    id = 0x02
+    name = 'Server Value 2'
+    element_names = __slots__
+    size = 10
+    _struct = struct.Struct(format)
+    _element_types = {'value_2': float}
+    _defaults = (0.0,)
+
+    def __init__(self, value_2=0.0):
+        _set_version(self, 0)
+        _set_trace_interval(self, _TRACE_INTERVAL)
+        _set_trace_count(self, 0)
+        _set_server_value_2_value_2(self, _element_value(_float, value_2))
+
+    def _values(self):
+        return (self.value_2,)
+
+    def _set_values(self, values):
+        (_0,) = values
+        _set_server_value_2_value_2(self, _0)
+        _set_version(self, self.version + 1)
+
+    def pack(self):
+        data = _SERVER_VALUE_2_STRUCT.pack(self.value_2)
+        return _SERVER_VALUE_2_HEADER + data + _CRC.pack(_calculate(data))
+
+    def unpack_from(self, buffer, offset=0, check_crc=True):
+        header = _HEADER.unpack_from(buffer, offset)
+        if header != _SERVER_VALUE_2_HEADER_VALUES:
+            self.logger.error('Bad header {} != {}'.format(repr(header), repr(_SERVER_VALUE_2_HEADER_VALUES)))
+            raise ValueError
+        if check_crc:
+            crc = _calculate_from(buffer, offset + 5, 4)
+            if _CRC.unpack_from(buffer, offset + 9)[0] != crc:
+                self.logger.error('Bad CRC 0x{:02x} != 0x{:02x}'.format(crc, _CRC.unpack_from(buffer, offset + 9)[0]))
+                raise ValueError
+        (_0,) = _SERVER_VALUE_2_STRUCT.unpack_from(buffer, offset + 5)
+        _set_server_value_2_value_2(self, _0)
+        _set_version(self, self.version + 1)
+        if self.trace_interval:
+            self._trace(header)
+        return 10
+
+_SERVER_VALUE_2_STRUCT = ServerValue2._struct
+_SERVER_VALUE_2_HEADER_VALUES = (packet.PACKET_START_BYTES[0], packet.PACKET_START_BYTES[1], 10, 0x02)
+_SERVER_VALUE_2_HEADER = _HEADER.pack(*_SERVER_VALUE_2_HEADER_VALUES)
+_set_server_value_2_value_2 = ServerValue2.value_2.__set__
+
+class Negotiate(packet.CompactPacket):
+    """
+    Negotiate, ID 0xfc
+    """
+    __slots__ = ('capabilities',)
+    format = '<B'
+    id = 0xfc
+    name = 'Negotiate'
+    element_names = __slots__
+    size = 7
+    _struct = struct.Struct(format)
+    _element_types = {'capabilities': int}
+    _defaults = (0,)
+
+    def __init__(self, capabilities=0):
+        _set_version(self, 0)
+        _set_trace_interval(self, _TRACE_INTERVAL)
+        _set_trace_count(self, 0)
+        _set_negotiate_capabilities(self, _element_value(_int, capabilities))
+
+    def _values(self):
+        return (self.capabilities,)
+
+    def _set_values(self, values):
+        (_0,) = values
+        _set_negotiate_capabilities(self, _0)
+        _set_version(self, self.version + 1)
+
+    def pack(self):
+        data = _NEGOTIATE_STRUCT.pack(self.capabilities)
+        return _NEGOTIATE_HEADER + data + _CRC.pack(_calculate(data))
+
+    def unpack_from(self, buffer, offset=0, check_crc=True):
+        header = _HEADER.unpack_from(buffer, offset)
+        if header != _NEGOTIATE_HEADER_VALUES:
+            self.logger.error('Bad header {} != {}'.format(repr(header), repr(_NEGOTIATE_HEADER_VALUES)))
+            raise ValueError
+        if check_crc:
+            crc = _calculate_from(buffer, offset + 5, 1)
+            if _CRC.unpack_from(buffer, offset + 6)[0] != crc:
+                self.logger.error('Bad CRC 0x{:02x} != 0x{:02x}'.format(crc, _CRC.unpack_from(buffer, offset + 6)[0]))
+                raise ValueError
+        (_0,) = _NEGOTIATE_STRUCT.unpack_from(buffer, offset + 5)
+        _set_negotiate_capabilities(self, _0)
+        _set_version(self, self.version + 1)
+        if self.trace_interval:
+            self._trace(header)
+        return 7
+
+_NEGOTIATE_STRUCT = Negotiate._struct
+_NEGOTIATE_HEADER_VALUES = (packet.PACKET_START_BYTES[0], packet.PACKET_START_BYTES[1], 7, 0xfc)
+_NEGOTIATE_HEADER = _HEADER.pack(*_NEGOTIATE_HEADER_VALUES)
+_set_negotiate_capabilities = Negotiate.capabilities.__set__
+
+class Subscribe(packet.CompactPacket):
+    """
+    Subscribe, ID 0xfe
+    """
+    __slots__ = ('interval', 'keepalive', 'packet_ids',)
+    format = '<ff32s'
+    id = 0xfe
+    name = 'Subscribe'
+    element_names = __slots__
+    size = 46
+    _struct = struct.Struct(format)
+    _element_types = {'interval': float, 'keepalive': float, 'packet_ids': bytes}
+    _defaults = (0.0, 0.0, b'',)
+
+    def __init__(self, interval=0.0, keepalive=0.0, packet_ids=b''):
+        _set_version(self, 0)
+        _set_trace_interval(self, _TRACE_INTERVAL)
+        _set_trace_count(self, 0)
+        _set_subscribe_interval(self, _element_value(_float, interval))
+        _set_subscribe_keepalive(self, _element_value(_float, keepalive))
+        _set_subscribe_packet_ids(self, _element_value(_bytes, packet_ids))
+
+    def _values(self):
+        return (self.interval, self.keepalive, self.packet_ids,)
+
+    def _set_values(self, values):
+        (_0, _1, _2,) = values
+        _set_subscribe_interval(self, _0)
+        _set_subscribe_keepalive(self, _1)
+        _set_subscribe_packet_ids(self, _2)
+        _set_version(self, self.version + 1)
+
+    def pack(self):
+        data = _SUBSCRIBE_STRUCT.pack(self.interval, self.keepalive, self.packet_ids)
+        return _SUBSCRIBE_HEADER + data + _CRC.pack(_calculate(data))
+
+    def unpack_from(self, buffer, offset=0, check_crc=True):
+        header = _HEADER.unpack_from(buffer, offset)
+        if header != _SUBSCRIBE_HEADER_VALUES:
+            self.logger.error('Bad header {} != {}'.format(repr(header), repr(_SUBSCRIBE_HEADER_VALUES)))
+            raise ValueError
+        if check_crc:
+            crc = _calculate_from(buffer, offset + 5, 40)
+            if _CRC.unpack_from(buffer, offset + 45)[0] != crc:
+                self.logger.error('Bad CRC 0x{:02x} != 0x{:02x}'.format(crc, _CRC.unpack_from(buffer, offset + 45)[0]))
+                raise ValueError
+        (_0, _1, _2,) = _SUBSCRIBE_STRUCT.unpack_from(buffer, offset + 5)
+        _set_subscribe_interval(self, _0)
+        _set_subscribe_keepalive(self, _1)
+        _set_subscribe_packet_ids(self, _2)
+        _set_version(self, self.version + 1)
+        if self.trace_interval:
+            self._trace(header)
+        return 46
+
+_SUBSCRIBE_STRUCT = Subscribe._struct
+_SUBSCRIBE_HEADER_VALUES = (packet.PACKET_START_BYTES[0], packet.PACKET_START_BYTES[1], 46, 0xfe)
+_SUBSCRIBE_HEADER = _HEADER.pack(*_SUBSCRIBE_HEADER_VALUES)
+_set_subscribe_interval = Subscribe.interval.__set__
+_set_subscribe_keepalive = Subscribe.keepalive.__set__
+_set_subscribe_packet_ids = Subscribe.packet_ids.__set__
+
+PACKET_CLASSES = {0x01: ServerValue, 0x02: ServerValue2, 0xfc: Negotiate, 0xfe: Subscribe}
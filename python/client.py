@@ -8,15 +8,28 @@ import socket
 import logging
 import threading
 import select
+import time
+import timeit
+import errno
 import packet
-import struct
+import decoder
+import aggregate
+import capture
+import dispatch
+import history
+import metrics
+import send_buffer
 import serial
+import serial_transport
+import udp_transport
+
+CLIENT_RECV_SIZE = decoder.DECODER_CHUNK_SIZE
 
 class MyClient(object):
     """
     Client template
     """
-    def __init__(self, dest=None, port=None, timeout=None, baudrate=9600, skt=None):
+    def __init__(self, dest=None, port=None, timeout=None, baudrate=9600, skt=None, pool=None, transport=None):
         self.logger = logging.getLogger(__name__)
         self.logger.debug('__init__')
 
@@ -25,14 +38,28 @@ class MyClient(object):
         self.logger.debug('  timeout   = {}'.format(repr(timeout)))
         self.logger.debug('  baudrate  = {}'.format(repr(baudrate)))
         self.logger.debug('  socket    = {}'.format(repr(skt)))
+        self.logger.debug('  pool      = {}'.format(repr(pool)))
+        self.logger.debug('  transport = {}'.format(repr(transport)))
 
         self.clientsocket = None
         self.serialport = None
+        self.transport = None
+        self.send_buffer = None
+        self.capture = None
+        self.dispatcher = None
+        self.metrics = None
+        self.scheduler = None
         self.timeout = timeout
+        self.recv_size = CLIENT_RECV_SIZE
 
-        if skt is None:
+        if transport is not None:
+            # Such as a udp_transport.DatagramTransport
+            self.transport = transport
+            # Such as each read taking a whole datagram
+            self.recv_size = getattr(transport, 'recv_size', CLIENT_RECV_SIZE)
+        elif skt is None:
             if dest is None:
-                raise ValueError('Must specify an address/serial port or socket')
+                raise ValueError('Must specify an address/serial port, socket or transport')
             # Check to see if we received an IP address or serial port
             try:
                 sktaddr = socket.gethostbyname(dest)
@@ -42,126 +69,320 @@ class MyClient(object):
                 self.logger.info('Client connected to {}'.format(self.clientsocket.getsockname()))
             except socket.gaierror:
                 self.logger.info('Opening serial port {}'.format(repr(dest)))
-                self.serialport = serial.Serial(dest, baudrate, timeout=self.timeout)
+                self.serialport = serial.serial_for_url(dest, baudrate)
+                self.transport = serial_transport.SerialTransport(self.serialport)
         else:
             self.clientsocket = skt
 
         if self.clientsocket is not None:
             # Non-blocking socket interface
             self.clientsocket.setblocking(0)
+            self.transport = self.clientsocket
+            self.send_buffer = send_buffer.SendBuffer(self.clientsocket)
 
         self.logger.info('Creating data locks')
         self.packet_list_lock = threading.Lock()
         self.packet_list = [None] * packet.PACKET_MAX_ID
+        self.history = [None] * packet.PACKET_MAX_ID
+        self.decoder = decoder.FrameDecoder(pool=pool)
+        # Frames are no longer than the largest packet registered, so a
+        # corrupted length does not hold up the stream, except aggregate
+        # frames which may be any size
+        self.decoder.max_frame_size = 0
+        self.decoder.set_frame_size(packet.PACKET_AGGREGATE_ID, decoder.DECODER_MAX_FRAME_SIZE)
+        self.aggregator = aggregate.Aggregator()
+        for pkt in (packet.negotiate_packet(), packet.datagram_packet()):
+            self.packet_list[pkt.id] = pkt
+            self._set_frame_size(pkt)
 
         return
 
+    def _set_frame_size(self, pkt):
+        self.decoder.set_frame_size(pkt.id, pkt.size)
+        self.decoder.max_frame_size = max(self.decoder.max_frame_size, pkt.size)
+
     def add_packet(self, pkt):
         self.logger.debug('add_packet({})'.format(repr(pkt)))
         if self.packet_list[pkt.id] is not None:
             self.logger.warning('Packet ID 0x{:02x} already exists'.format(pkt.id))
         with self.packet_list_lock:
             self.packet_list[pkt.id] = pkt
+        self._set_frame_size(pkt)
+
+    def enable_history(self, packet_id, depth=history.HISTORY_DEPTH, policy=history.HISTORY_OVERWRITE):
+        """
+        Keep every sample of packet_id received in history[packet_id]
+        instead of only the last value in packet_list, a depth of 0 turns
+        the history off
+        """
+        self.logger.debug('enable_history(0x{:02x}, {}, {})'.format(packet_id, repr(depth), repr(policy)))
+        if self.packet_list[packet_id] is None:
+            self.logger.error('Packet ID 0x{:02x} does not exist'.format(packet_id))
+            raise ValueError
+        if depth == 0:
+            self.history[packet_id] = None
+        else:
+            self.history[packet_id] = history.History(self.packet_list[packet_id], depth, policy)
+
+    def set_dispatcher(self, dispatcher):
+        """
+        Pass every packet received to the handlers registered with
+        dispatcher (a dispatch.Dispatcher), None stops dispatching
+        """
+        self.logger.debug('set_dispatcher({})'.format(repr(dispatcher)))
+        self.dispatcher = dispatcher
+
+    def add_handler(self, packet_id, callback, **options):
+        """
+        Run callback(packet_id, values) for every packet_id received, on a
+        worker thread so it does not hold up receiving (see
+        dispatch.Dispatcher.register() for the options)
+        Returns the dispatch.Handler
+        """
+        self.logger.debug('add_handler(0x{:02x}, {})'.format(packet_id, repr(callback)))
+        if self.dispatcher is None:
+            self.dispatcher = dispatch.Dispatcher()
+        return self.dispatcher.register(packet_id, callback, **options)
+
+    def enable_metrics(self, client_metrics=None):
+        """
+        Count the frames and bytes sent and received and time receiving,
+        client_metrics defaults to a new metrics.Metrics
+        Returns the metrics
+        """
+        self.logger.debug('enable_metrics({})'.format(repr(client_metrics)))
+        if client_metrics is None:
+            client_metrics = metrics.Metrics('client')
+        client_metrics.gauge('resyncs', lambda: self.decoder.resyncs)
+        client_metrics.gauge('crc_errors', lambda: self.decoder.crc_errors)
+        client_metrics.gauge('length_errors', lambda: self.decoder.length_errors)
+        client_metrics.gauge('rx_buffer_bytes', lambda: len(self.decoder))
+        if self.clientsocket is not None:
+            client_metrics.gauge('send_queue_bytes', lambda: metrics.send_queue(self.clientsocket))
+            client_metrics.gauge('send_buffer_bytes', lambda: len(self.send_buffer))
+            client_metrics.gauge('send_buffer_high_water', lambda: self.send_buffer.high_water_count)
+        elif isinstance(self.transport, udp_transport.DatagramTransport):
+            client_metrics.gauge('datagrams_bad', lambda: self.transport.bad)
+            client_metrics.gauge('datagrams_stale', lambda: self.transport.stale)
+            client_metrics.gauge('datagrams_missed', lambda: self.transport.missed)
+        elif self.transport is not None:
+            client_metrics.gauge('serial_dropped_bytes', lambda: self.transport.ring.dropped)
+            client_metrics.gauge('send_queue_bytes', lambda: self.transport.write_pending)
+        self._receive_time = client_metrics.histogram('receive_seconds')
+        if not isinstance(self.packet_list_lock, metrics.TimedLock):
+            self.packet_list_lock = metrics.TimedLock(self.packet_list_lock, client_metrics.histogram('lock_wait_seconds'))
+        self.metrics = client_metrics
+        return client_metrics
 
     def set_timeout(self, timeout):
         self.logger.debug('set_timeout({})'.format(repr(timeout)))
         self.timeout = timeout
-        if self.clientsocket is not None:
-            self.clientsocket.settimeout(timeout)
-        if self.serialport is not None:
-            self.serialport.settimeout(timeout)
+
+    def set_capture(self, capture):
+        """
+        Append every frame received to capture (a capture.CaptureWriter),
+        None stops capturing
+        """
+        self.logger.debug('set_capture({})'.format(repr(capture)))
+        self.capture = capture
+
+    def set_scheduler(self, scheduler):
+        """
+        Charge everything sent to scheduler (a link_scheduler.LinkScheduler),
+        the budget of the link that decides which status packets a server
+        sends it, None stops charging
+        """
+        self.logger.debug('set_scheduler({})'.format(repr(scheduler)))
+        self.scheduler = scheduler
+
+    def link_sent(self):
+        """
+        Returns the bytes sent on the link so far and the bytes still
+        waiting to be sent
+        """
+        if self.send_buffer is not None:
+            return self.send_buffer.bytes_sent, len(self.send_buffer)
+        if isinstance(self.transport, serial_transport.SerialTransport):
+            return self.transport.bytes_written, self.transport.write_pending
+        return 0, 0
 
     def send_packet(self, pkt):
-        self.logger.debug('send_packet({})'.format(repr(pkt)))
-        bytes_sent = 0
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('send_packet({})'.format(repr(pkt)))
         with self.packet_list_lock:
             packet_data = pkt.pack()
-        while bytes_sent < len(packet_data):
-            sent = self.clientsocket.send(packet_data[bytes_sent:])
-            if sent == 0:
-                self.logger.info('Sending socket has been closed')
+        if self.metrics is not None:
+            self.metrics.tx_frames[pkt.id] += 1
+            self.metrics.tx_bytes[pkt.id] += len(packet_data)
+        return self.send_data(packet_data)
+
+    def subscribe(self, packet_ids, interval, keepalive=None):
+        """
+        Ask the server to send packet_ids every interval seconds when they
+        change, unchanged packets are sent again every keepalive seconds (0
+        for every interval, None for never)
+        """
+        self.logger.debug('subscribe({}, {}, {})'.format(repr(packet_ids), repr(interval), repr(keepalive)))
+        if keepalive is None:
+            keepalive = -1.0
+        return self.send_packet(packet.subscribe_packet(packet_ids, interval, keepalive))
+
+    def negotiate(self, capabilities=aggregate.AGGREGATE_SUPPORTED):
+        """
+        Tell the server which aggregate frames and compression this client
+        accepts, the answer is in packet_list[PACKET_NEGOTIATE_ID]
+        """
+        self.logger.debug('negotiate(0x{:02x})'.format(capabilities))
+        return self.send_packet(packet.negotiate_packet(capabilities))
+
+    def send_data(self, data):
+        """
+        Send data that has already been packed, such as a buffer of frames
+        shared by several clients
+        Data a socket can not take now is queued in send_buffer and sent
+        once it is writable (by process_input() or flush()).
+        Returns False if the socket has been closed
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('send_data({})'.format(repr(data)))
+        if self.send_buffer is not None:
+            if not self.send_buffer.write(data):
                 return False
-            bytes_sent += sent
+        elif self.transport.send(data) == 0:
+            self.logger.info('Sending socket has been closed')
+            return False
+        if self.scheduler is not None:
+            self.scheduler.charge(len(data), time.time())
+        if self.metrics is not None:
+            self.metrics.counters['sent_bytes'] += len(data)
         return True
 
+    def flush(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for the data queued by
+        send_data() to be sent
+        Returns True if everything has been sent
+        """
+        self.logger.debug('flush({})'.format(repr(timeout)))
+        if self.send_buffer is None:
+            return True
+        return self.send_buffer.wait(timeout)
+
     def process_input(self, timeout=None):
-        self.logger.debug('process_input({})'.format(repr(timeout)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('process_input({})'.format(repr(timeout)))
         if timeout is None:
             timeout = self.timeout
-        ready_to_read, ready_to_write, in_error = select.select([self.clientsocket], [], [], timeout)
-        for skt in ready_to_read:
-            # Looking for the start code in the header
-            start_byte_index = 0
-            start_byte_found = False
-            data_chunks = []
-            self.logger.debug('Start code search:')
-            while not start_byte_found:
-                data_byte = skt.recv(1)
-                if data_byte == '':
-                    self.logger.info('Socket has been closed looking for Start code')
-                    return False
-                self.logger.debug('  index:  {}'.format(start_byte_index))
-                self.logger.debug('  rx:     0x{:02x}'.format(ord(data_byte)))
-                if ord(data_byte) == packet.PACKET_START_BYTES[start_byte_index]:
-                    data_chunks.append(data_byte)
-                    start_byte_index += 1
-                else:
-                    self.logger.info('  Start byte expected but not received')
-                    data_chunks = []
-                    start_byte_index = 0
-                if start_byte_index > 1:
-                    self.logger.debug('  Start code found')
-                    start_byte_found = True
-            packet_length = skt.recv(2)
-            if packet_length == '':
-                self.logger.info('Socket has been closed looking for packet length')
-                return False
-            if len(packet_length) < 2:
-                packet_length += skt.recv(1)
-            # If we didn't get more data and the recv call returned the socket has been closed
-            if len(packet_length) < 2:
-                self.logger.info('Socket has been closed looking for second byte of packet length')
-                return False
-            data_chunks.append(packet_length)
-            packet_length = int(struct.unpack('H', packet_length)[0])
-            self.logger.debug('  length: 0x{:04x}'.format(packet_length))
-            # Now get the packet ID
-            packet_id = skt.recv(1)
-            if packet_id == '':
-                self.logger.info('Socket has been closed looking for packet id')
+        if self.send_buffer is not None and len(self.send_buffer):
+            writers = [self.transport]
+        else:
+            writers = []
+        ready_to_read, ready_to_write, in_error = select.select([self.transport], writers, [], timeout)
+        if ready_to_write:
+            try:
+                self.send_buffer.flush()
+            except socket.error as e:
+                self.logger.info('Send failed {}'.format(repr(e)))
                 return False
-            data_chunks.append(packet_id)
-            packet_id = ord(packet_id)
-            self.logger.debug('  ID:     0x{:02x}'.format(packet_id))
-            data_remaining = packet_length
-            bytes_recvd = 5 # Start with the header received
-            while bytes_recvd < (data_remaining):
-                data_recvd = skt.recv(min(data_remaining - bytes_recvd, 2048))
-                if data_recvd == '':
-                    self.logger.info('Socket has been closed receiving data')
-                    return False
-                data_chunks.append(data_recvd)
-                bytes_recvd += len(data_recvd)
-                self.logger.debug('  rx data:     {}'.format(''.join('%02x ' % ord(c) for c in data_recvd)))
-                self.logger.debug('  bytes_recvd: {}'.format(bytes_recvd))
+        if not ready_to_read:
+            return None
+        return self.receive()
+
+    def receive(self):
+        """
+        Read the data waiting on the socket or serial port and unpack every
+        complete packet
+        Returns the last packet received, None if no complete packet has been
+        received yet or False if the socket has been closed
+        """
+        self.logger.debug('receive()')
+        try:
+            bytes_recvd = self.decoder.recv(self.transport, self.recv_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            if e.errno != errno.ECONNRESET:
+                raise
+            bytes_recvd = 0
+        if bytes_recvd == 0:
+            self.logger.info('Socket has been closed')
+            return False
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('  bytes_recvd: {}'.format(bytes_recvd))
+        client_metrics = self.metrics
+        if client_metrics is not None:
+            receive_start = timeit.default_timer()
+        rcvd_pkt = None
+        # Frames are unpacked where they were received, the decoder has
+        # already checked their CRC
+        buf = self.decoder.buffer
+        for packet_id, start, end in self.decoder.frame_offsets():
+            if client_metrics is not None:
+                client_metrics.rx_frames[packet_id] += 1
+                client_metrics.rx_bytes[packet_id] += end - start
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('  rx data:     {}'.format(''.join('%02x ' % c for c in buf[start:end])))
+            if self.capture is not None:
+                self.capture.write(self.decoder.view[start:end], packet_id)
             # Process the packet
             with self.packet_list_lock:
-                if self.packet_list[packet_id] is None:
-                    self.logger.warning('Unknown packet received ID = 0x{:02x}'.format(packet_id))
+                if packet_id == packet.PACKET_AGGREGATE_ID:
+                    try:
+                        pkts = self.aggregator.unpack(bytes(buf[start:end]), self.packet_list)
+                    except ValueError:
+                        self.logger.warning('Bad aggregate packet received')
+                        if client_metrics is not None:
+                            client_metrics.counters['bad_packets'] += 1
+                        continue
+                    if pkts is None:
+                        # Delta from a frame that was lost, wait for a keyframe
+                        if client_metrics is not None:
+                            client_metrics.counters['aggregate_discarded'] += 1
+                        continue
                 else:
-                    self.packet_list[packet_id].unpack(''.join(data_chunks))
-            # Load the received packet on the queue
-            self.logger.info('Packet 0x{:02x} recevied'.format(packet_id))
-            return self.packet_list[packet_id]
-        return None
+                    if packet_id < len(self.packet_list):
+                        pkt = self.packet_list[packet_id]
+                    else:
+                        pkt = None
+                    if pkt is None:
+                        self.logger.warning('Unknown packet received ID = 0x{:02x}'.format(packet_id))
+                        if client_metrics is not None:
+                            client_metrics.counters['unknown_packets'] += 1
+                        continue
+                    try:
+                        pkt.unpack_from(buf, start, False)
+                    except ValueError:
+                        self.logger.warning('Bad packet received ID = 0x{:02x}'.format(packet_id))
+                        if client_metrics is not None:
+                            client_metrics.counters['bad_packets'] += 1
+                        continue
+                    pkts = [pkt]
+            # The values are copied before the next frame is unpacked
+            for pkt in pkts:
+                if self.history[pkt.id] is not None:
+                    self.history[pkt.id].append(pkt._values())
+                if self.dispatcher is not None:
+                    self.dispatcher.dispatch(pkt)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('Packet 0x{:02x} recevied'.format(pkt.id))
+            if pkts:
+                rcvd_pkt = pkts[-1]
+        if client_metrics is not None:
+            self._receive_time.observe(timeit.default_timer() - receive_start)
+        return rcvd_pkt
+
+    def close(self):
+        self.logger.debug('close()')
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
 
     def __del__(self):
-        self.clientsocket.close()
+        self.close()
 
 if __name__ == '__main__':
     import argparse
-    import random
-    import time
+    import hub
 
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description='Test TCP/IP server')
@@ -173,10 +394,24 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--address',
                         help='Network address to connect to',
                         default='')
+    parser.add_argument('-b', '--baudrate',
+                        help='Baud rate when the address is a serial port',
+                        type=int,
+                        default=9600)
     parser.add_argument('-n', '--num_clients',
                         help='Number of clients to connect',
                         type=int,
                         default=1)
+    parser.add_argument('-r', '--rate',
+                        help='Seconds between updates to subscribe to',
+                        type=float,
+                        default=None)
+    parser.add_argument('-g', '--aggregate',
+                        help='Ask the server for aggregate frames',
+                        action='store_true')
+    parser.add_argument('-c', '--capture',
+                        help='File to capture received packets to',
+                        default=None)
     parser.add_argument('-l', '--logfile',
                         help='File to log messages to',
                         default=None)
@@ -206,19 +441,23 @@ if __name__ == '__main__':
                              name='Server Value',
                              element_names=['value'])
 
+    def received(my_client, rcvd_pkt):
+        if rcvd_pkt is False:
+            print('Client {:04d} closed'.format(my_clients.index(my_client)))
+        elif rcvd_pkt.id == my_packet.id:
+            print('Value from server to client {:04d} = {}'.format(my_clients.index(my_client), rcvd_pkt.value))
+
+    # Every client is read by one event loop as soon as it has data
+    my_hub = hub.ClientHub(received)
     my_clients = []
     for i in range(0, args.num_clients):
-        my_clients.append(MyClient(addr, args.port))
+        my_clients.append(my_hub.connect(addr, args.port, baudrate=args.baudrate))
         my_clients[-1].add_packet(my_packet)
+        if args.capture is not None:
+            my_clients[-1].set_capture(capture.CaptureWriter('{}.{:04d}'.format(args.capture, i) if args.num_clients > 1 else args.capture))
+        if args.rate is not None:
+            my_hub.send_packet(my_clients[-1], packet.subscribe_packet([my_packet.id], args.rate, -1.0))
+        if args.aggregate:
+            my_hub.send_packet(my_clients[-1], packet.negotiate_packet(aggregate.AGGREGATE_SUPPORTED))
 
-    loop_count = 0
-    while True:
-        client_num = 0
-        print('Loop count {:04d}'.format(loop_count))
-        loop_count += 1
-        for my_client in my_clients:
-            print('Processing client {:04d}'.format(client_num))
-            my_client.process_input(0.1)
-            with my_client.packet_list_lock:
-                print('Value from server = {}'.format(my_client.packet_list[1].value))
-            client_num += 1
+    my_hub.run()
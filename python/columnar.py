@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import logging
+import re
+import struct
+import numpy
+import packet
+
+COLUMNAR_BYTE_ORDERS = {'@': '=', '=': '=', '<': '<', '>': '>', '!': '>'}
+# NumPy types of the struct codes whose standard size is not their native size
+COLUMNAR_STANDARD_TYPES = {'l': 'i4', 'L': 'u4'}
+
+logger = logging.getLogger(__name__)
+
+def element_dtype(element_format, byte_order='=', native=True):
+    if element_format == 'c':
+        return numpy.dtype('S1')
+    if element_format[-1] in 'sp':
+        return numpy.dtype('S{}'.format(element_format[:-1] or 1))
+    if not native:
+        element_format = COLUMNAR_STANDARD_TYPES.get(element_format, element_format)
+    return numpy.dtype(byte_order + element_format)
+
+def packet_dtype(pkt):
+    """
+    NumPy structured dtype of a whole frame of pkt
+    The fields are the packet elements at the offsets struct gives them, so
+    pad bytes and native alignment padding are kept, plus the frame
+    'start', 'length', 'id' and 'crc' fields.
+    """
+    prefix = pkt.format[0] if pkt.format[:1] in COLUMNAR_BYTE_ORDERS else ''
+    byte_order = COLUMNAR_BYTE_ORDERS.get(prefix, '=')
+    # Native formats use native sizes and alignment, the others standard sizes
+    native = prefix in ('', '@')
+    names = ['start', 'length', 'id']
+    formats = [numpy.dtype('2u1'), numpy.dtype('=u2'), numpy.dtype('u1')]
+    offsets = [0, 2, 4]
+    element_names = iter(pkt.element_names)
+    previous = prefix
+    # Walk the whole format, pad bytes have no element but move the
+    # elements after them
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', pkt.format):
+        if code == 'x':
+            previous += count + code
+            continue
+        for element_format in [count + code] if code in 'sp' else [code] * int(count or 1):
+            size = struct.calcsize((prefix or '@') + element_format)
+            names.append(next(element_names))
+            formats.append(element_dtype(element_format, byte_order, native))
+            offsets.append(packet.PACKET_HEADER.size + struct.calcsize(previous + element_format) - size)
+            previous += element_format
+    names.append('crc')
+    formats.append(numpy.dtype('u1'))
+    offsets.append(pkt.size - packet.PACKET_CRC.size)
+    return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': pkt.size})
+
+def decode_rows(pkt, rows, check=True):
+    """
+    Decode a 2D uint8 array with one frame of pkt per row
+    Frames with a bad start code, length, ID or CRC are dropped when check
+    is set.
+    Returns a dictionary of element name to array of values
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('decode_rows({}, {})'.format(repr(pkt.name), repr(rows.shape)))
+    if rows.shape[1] != pkt.size:
+        logger.error('Rows of {} bytes are not {} byte frames'.format(rows.shape[1], pkt.size))
+        raise ValueError
+    frames = numpy.ascontiguousarray(rows).view(packet_dtype(pkt)).reshape(-1)
+    if check:
+        valid = ((frames['start'][:, 0] == packet.PACKET_START_BYTES[0]) &
+                 (frames['start'][:, 1] == packet.PACKET_START_BYTES[1]) &
+                 (frames['length'] == pkt.size) &
+                 (frames['id'] == pkt.id))
+        # The CRC of the data followed by its CRC is zero
+        valid &= pkt.crc.calculate_matrix(rows[:, packet.PACKET_HEADER.size:]) == 0
+        if not valid.all():
+            logger.warning('{} of {} {} frames dropped'.format(len(frames) - valid.sum(), len(frames), repr(pkt.name)))
+            frames = frames[valid]
+    return dict((element_name, frames[element_name].copy()) for element_name in pkt.element_names)
+
+def decode(pkt, buffer, count=-1, offset=0, check=True):
+    """
+    Decode count back to back frames of pkt (all of them if -1) from a
+    buffer starting at offset
+    """
+    if count < 0:
+        count = (len(buffer) - offset) // pkt.size
+    rows = numpy.frombuffer(buffer, numpy.uint8, count * pkt.size, offset).reshape(count, pkt.size)
+    return decode_rows(pkt, rows, check)
+
+def decode_frames(pkt, frames, check=True):
+    """
+    Decode a sequence of separate frames of pkt, such as those yielded by
+    FrameDecoder.frames() for one ID
+    """
+    return decode(pkt, b''.join(bytes(frame) for frame in frames), check=check)
+
+def gather(buffer, offsets, size):
+    """
+    Copy the size byte frames at offsets in buffer into a 2D uint8 array
+    """
+    data = numpy.frombuffer(buffer, numpy.uint8)
+    offsets = numpy.asarray(offsets, dtype=numpy.int64)
+    return data[offsets[:, numpy.newaxis] + numpy.arange(size)]
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import timeit
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test columnar decoding')
+
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets to decode',
+                        type=int,
+                        default=100000)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    adc_packet = packet.Packet(format='IcH8h',
+                               id=0x10,
+                               name='ADC Samples',
+                               element_names=['tick', 'channel', 'flags'] + ['sample{}'.format(i) for i in range(8)],
+                               element_values=[0, b'A', 0] + [0] * 8)
+    buffer = bytearray(adc_packet.size * args.num_packets)
+    for index in range(args.num_packets):
+        adc_packet.tick = index
+        adc_packet.sample0 = random.randint(-2048, 2047)
+        adc_packet.pack_into(buffer, index * adc_packet.size)
+    # Corrupt one frame
+    buffer[adc_packet.size * (args.num_packets // 2) + packet.PACKET_HEADER.size] ^= 0xff
+
+    start = timeit.default_timer()
+    columns = decode(adc_packet, buffer)
+    bulk_time = timeit.default_timer() - start
+
+    start = timeit.default_timer()
+    for index in range(args.num_packets):
+        try:
+            adc_packet.unpack_from(buffer, index * adc_packet.size)
+        except ValueError:
+            pass
+    single_time = timeit.default_timer() - start
+
+    print('{} of {} packets, bulk {:.3f} s, one at a time {:.3f} s'.format(
+          len(columns['tick']), args.num_packets, bulk_time, single_time))
+    assert columns['tick'][-1] == args.num_packets - 1
+
+    # Pad bytes move the elements after them
+    padded_packet = packet.Packet(format='<BxB3xH', id=0x11, name='Padded',
+                                  element_names=['first', 'second', 'third'], element_values=[1, 2, 3])
+    columns = decode(padded_packet, padded_packet.pack() * 2)
+    assert [columns[element_name][-1] for element_name in padded_packet.element_names] == [1, 2, 3]
+
+    # Long integers are native or standard size with the format
+    for prefix in ('@', '<'):
+        long_packet = packet.Packet(format=prefix + 'BlxL', id=0x12, name='Long',
+                                    element_names=['first', 'second', 'third'], element_values=[1, -2, 3])
+        columns = decode(long_packet, long_packet.pack() * 2)
+        assert [columns[element_name][-1] for element_name in long_packet.element_names] == [1, -2, 3]
@@ -4,9 +4,23 @@ from __future__ import(print_function)
 
 __version__ = filter(str.isdigit, '$Revision: $')
 
+import ctypes
 import logging
+import os
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CRC8_SLICES = 8
+CRC8_NATIVE_LIBRARY = os.environ.get('ALMA_CRC8_LIBRARY',
+                                     os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                  '..', 'stm32', 'common', 'build', 'libcrc8.so'))
+CRC8_NATIVE_MIN_LENGTH = 32 # Below this the ctypes call costs more than the Python loop
+CRC8_NATIVE_MAX_LENGTH = 0xFFFF # crc8_calculate() takes a uint16_t length
+
 CRC8_POLYNOMIAL = 0x07
 CRC8_TABLE = [
               0x00,0x07,0x0e,0x09,0x1c,0x1b,0x12,0x15,
@@ -43,9 +57,44 @@ CRC8_TABLE = [
               0xe6,0xe1,0xe8,0xef,0xfa,0xfd,0xf4,0xf3,
              ]
 
+def slice_tables(table, slices):
+    """
+    Build the tables for slicing-by-N from a CRC8 table, table N is the CRC
+    of a byte followed by N zero bytes
+    """
+    tables = [list(table)]
+    for i in range(1, slices):
+        tables.append([table[value] for value in tables[-1]])
+    return tables
+
+def _load_native(path):
+    """
+    Load the firmware CRC8 implementation (stm32/common/crc8.c) built as a
+    shared library, returns None if it is not available or does not match
+    the generated table
+    """
+    try:
+        library = ctypes.CDLL(path)
+        polynomial = ctypes.c_uint8.in_dll(library, 'crc8_polynomial').value
+    except (OSError, ValueError):
+        return None
+    if polynomial != CRC8_POLYNOMIAL:
+        return None
+    library.crc8_calculate.restype = ctypes.c_uint8
+    return library
+
+CRC8_TABLES = slice_tables(CRC8_TABLE, CRC8_SLICES)
+crc8_native = _load_native(CRC8_NATIVE_LIBRARY)
+if numpy is not None:
+    crc8_numpy_tables = numpy.array(CRC8_TABLES, dtype=numpy.uint8)
+
 class CRC8(object):
     """
     CRC8 algorithm
+    Single buffers are calculated with the firmware library when it has been
+    built and the buffer is large enough to be worth the call, otherwise with
+    a table lookup per byte.  Batches are calculated with slicing-by-N over
+    all buffers of the same length at once when NumPy is installed.
     """
     def __init__(self, polynomial=0x07):
         self.logger = logging.getLogger(__name__)
@@ -56,22 +105,16 @@ class CRC8(object):
 
         return
 
-    def generate_table(self, output_file = sys.stdout, language = 'c'):
-        self.logger.debug('generate_table({},{})'.format(repr(output_file),repr(language)))
+    def generate_table(self, output_file = sys.stdout, language = 'c', slices = 1):
+        self.logger.debug('generate_table({},{},{})'.format(repr(output_file),repr(language),repr(slices)))
         if language == 'c':
-            print('const uint8_t crc8_polynomial = 0x{:02x};'.format(self.polynomial))
-            print('const uint8_t crc8_table[] = {', file=output_file)
+            print('const uint8_t crc8_polynomial = 0x{:02x};'.format(self.polynomial), file=output_file)
         elif language == 'python':
-            print('CRC8_POLYNOMIAL = 0x{:02x}'.format(self.polynomial))
-            print('CRC8_TABLE = [', file=output_file)
+            print('CRC8_POLYNOMIAL = 0x{:02x}'.format(self.polynomial), file=output_file)
 
+        table = []
         for divident in range(0,256):
             current_byte = divident
-            if divident % 8 == 0:
-                if language == 'c':
-                    output_file.write('                              ')
-                elif language == 'python':
-                    output_file.write('              ')
             for bit in range(0,8):
                 if (current_byte & 0x80) != 0:
                     current_byte = current_byte << 1
@@ -79,26 +122,127 @@ class CRC8(object):
                 else:
                     current_byte = current_byte << 1
                 current_byte = current_byte & 0xff
-            output_file.write('0x{:02x},'.format(current_byte))
-            if divident % 8 == 7:
-                output_file.write('\n')
+            table.append(current_byte)
 
-        if language == 'c':
-            print('                             };', file=output_file)
-        elif language == 'python':
-            print('             ]', file=output_file)
+        for index, slice_table in enumerate(slice_tables(table, slices)):
+            suffix = '' if index == 0 else '_{}'.format(index)
+            if language == 'c':
+                print('const uint8_t crc8_table{}[] = {{'.format(suffix), file=output_file)
+            elif language == 'python':
+                print('CRC8_TABLE{} = ['.format(suffix.upper()), file=output_file)
 
-    def calculate(self, data):
-        self.logger.debug('calculate({})'.format(repr(data)))
+            for divident in range(0,256):
+                if divident % 8 == 0:
+                    if language == 'c':
+                        output_file.write('                              ')
+                    elif language == 'python':
+                        output_file.write('              ')
+                output_file.write('0x{:02x},'.format(slice_table[divident]))
+                if divident % 8 == 7:
+                    output_file.write('\n')
+
+            if language == 'c':
+                print('                             };', file=output_file)
+            elif language == 'python':
+                print('             ]', file=output_file)
+
+    def _check_polynomial(self):
         if CRC8_POLYNOMIAL != self.polynomial:
             self.logger.error('CRC8 polynomial does not match generated table!')
             raise ValueError('CRC8 polynomial does not match generated table!')
+
+    def calculate(self, data):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('calculate({})'.format(repr(data)))
+        self._check_polynomial()
+        length = len(data)
+        if crc8_native is not None and CRC8_NATIVE_MIN_LENGTH <= length <= CRC8_NATIVE_MAX_LENGTH:
+            if isinstance(data, bytearray):
+                data = (ctypes.c_char * length).from_buffer(data)
+            elif isinstance(data, memoryview):
+                data = data.tobytes()
+            return crc8_native.crc8_calculate(data, ctypes.c_uint16(length))
         crc = 0
         for byte in bytearray(data):
-            temp = byte ^ crc
-            crc = CRC8_TABLE[temp]
+            crc = CRC8_TABLE[byte ^ crc]
+        return crc
+
+    def calculate_from(self, buffer, offset, length):
+        """
+        Calculate the CRC of length bytes of buffer starting at offset, a
+        bytearray is passed to the native library where it is without
+        copying
+        """
+        self._check_polynomial()
+        if crc8_native is not None and CRC8_NATIVE_MIN_LENGTH <= length <= CRC8_NATIVE_MAX_LENGTH and isinstance(buffer, bytearray):
+            return crc8_native.crc8_calculate((ctypes.c_char * length).from_buffer(buffer, offset), ctypes.c_uint16(length))
+        data = buffer[offset:offset + length]
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        crc = 0
+        for byte in data:
+            crc = CRC8_TABLE[byte ^ crc]
         return crc
 
+    def calculate_many(self, data_list):
+        """
+        Calculate the CRC of each buffer in data_list
+        Returns a list of CRCs in the same order
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('calculate_many({})'.format(repr(data_list)))
+        self._check_polynomial()
+        if numpy is None:
+            return [self.calculate(data) for data in data_list]
+
+        # Group the buffers by length so each group is a single matrix
+        groups = {}
+        for index, data in enumerate(data_list):
+            groups.setdefault(len(data), []).append(index)
+        crc_list = [0] * len(data_list)
+        for length, indexes in groups.items():
+            rows = [data_list[index] for index in indexes]
+            rows = [row.tobytes() if isinstance(row, memoryview) else row for row in rows]
+            matrix = numpy.frombuffer(bytearray().join(rows), dtype=numpy.uint8).reshape(len(indexes), length)
+            for index, crc in zip(indexes, self.calculate_matrix(matrix).tolist()):
+                crc_list[index] = crc
+        return crc_list
+
+    def calculate_matrix(self, matrix):
+        """
+        Calculate the CRC of each row of a 2D uint8 NumPy array
+        The bytes after the first of every slice do not depend on the running
+        CRC, so their table lookups are done for the whole matrix at once
+        leaving one lookup per slice in the loop.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('calculate_matrix({})'.format(repr(matrix.shape)))
+        self._check_polynomial()
+        rows, length = matrix.shape
+        crc = numpy.zeros(rows, dtype=numpy.uint8)
+        sliced_length = length - length % CRC8_SLICES
+        if sliced_length > 0:
+            sliced = matrix[:, :sliced_length].reshape(rows, -1, CRC8_SLICES)
+            partial = numpy.zeros(sliced.shape[:2], dtype=numpy.uint8)
+            for index in range(1, CRC8_SLICES):
+                partial ^= crc8_numpy_tables[CRC8_SLICES - 1 - index][sliced[:, :, index]]
+            first_table = crc8_numpy_tables[CRC8_SLICES - 1]
+            for index in range(sliced.shape[1]):
+                crc = first_table[crc ^ sliced[:, index, 0]] ^ partial[:, index]
+        for index in range(sliced_length, length):
+            crc = crc8_numpy_tables[0][crc ^ matrix[:, index]]
+        return crc
+
+    def check_many(self, data_list):
+        """
+        Check a batch of buffers that each end with their CRC byte
+        The CRC of data followed by its own CRC is zero, so the whole buffer
+        is checked in one pass.  Returns a list of True/False.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('check_many({})'.format(repr(data_list)))
+        return [crc == 0 for crc in self.calculate_many(data_list)]
+
 
 if __name__ == '__main__':
     import argparse
@@ -118,6 +262,10 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--language',
                         help='Language to output in (c or python)',
                         default='c')
+    parser.add_argument('-s', '--slices',
+                        help='Number of tables to generate for slicing-by-N',
+                        type=int,
+                        default=1)
     parser.add_argument('-p', '--polynomial',
                         help='Polynomial to use in generating CRC8 table',
                         type=int,
@@ -138,6 +286,6 @@ if __name__ == '__main__':
         root_logger.setLevel(logging.INFO)
 
     crc8 = CRC8(args.polynomial)
-    crc8.generate_table(args.file,args.language)
+    crc8.generate_table(args.file,args.language,args.slices)
 
     print('crc8 of {} = 0x{:02x}'.format(repr(args.data),crc8.calculate(args.data)))
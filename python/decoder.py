@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import logging
+import struct
+import threading
+import crc8
+import packet
+
+DECODER_CHUNK_SIZE = 4096
+DECODER_MAX_FRAME_SIZE = 0xFFFF
+DECODER_RECV_SPACE = 0x4000 # Room for reads beyond the largest partial frame
+DECODER_HEADER_SIZE = 5 # Start code, length and ID
+DECODER_MIN_FRAME_SIZE = DECODER_HEADER_SIZE + 1 # Header and CRC
+
+PACKET_START_CODE = bytes(bytearray(packet.PACKET_START_BYTES))
+PACKET_LENGTH = struct.Struct('H')
+
+class BufferPool(object):
+    """
+    Preallocated receive buffers shared by frame decoders
+    A decoder takes a buffer when data arrives and gives it back once
+    everything in it has been decoded, so many mostly idle connections
+    share a few buffers.  New buffers are made when the pool is empty.
+    """
+    def __init__(self, size=DECODER_MAX_FRAME_SIZE + DECODER_RECV_SPACE, count=0):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.size = size
+        self.lock = threading.Lock()
+        self.buffers = [bytearray(size) for index in range(count)]
+        self.allocated = count
+
+        return
+
+    def get(self):
+        with self.lock:
+            if self.buffers:
+                return self.buffers.pop()
+            self.allocated += 1
+        return bytearray(self.size)
+
+    def put(self, buffer):
+        with self.lock:
+            self.buffers.append(buffer)
+
+class FrameDecoder(object):
+    """
+    Incremental decoder for the packet stream
+    Data is received straight into a preallocated buffer (with recv_into
+    where the socket has it) which is searched for the start code, every
+    complete frame in the buffer is returned and partial frames are kept
+    until the rest of the data is received.  head and tail are the start
+    and end of the data not decoded yet, it is only moved to the front of
+    the buffer when a read would not fit after it.  Frames with a bad
+    length or CRC are skipped by searching for the next start code.  With a
+    pool the buffer is taken from and given back to the pool.  Frames of an
+    ID given a size with set_frame_size() may be no longer than it, other
+    frames no longer than max_frame_size, so a corrupted length field only
+    holds up the frames behind it until that much data has arrived.
+    """
+    def __init__(self, max_frame_size=DECODER_MAX_FRAME_SIZE, pool=None):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.max_frame_size = max_frame_size
+        self.frame_sizes = [0] * (packet.PACKET_MAX_ID + 1) # Largest frame of each ID, 0 for max_frame_size
+        self.pool = pool
+        self.buffer_size = max_frame_size + DECODER_RECV_SPACE if pool is None else pool.size
+        if self.buffer_size <= max_frame_size:
+            self.logger.error('Buffers of {} bytes can not hold {} byte frames'.format(self.buffer_size, max_frame_size))
+            raise ValueError
+        self.buffer = None
+        self.view = None
+        self.head = 0
+        self.tail = 0
+        self.resyncs = 0
+        self.length_errors = 0
+        self.crc_errors = 0
+        self.crc = crc8.CRC8()
+
+        return
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def _reserve(self, size):
+        # Returns the room after tail, at least size if the buffer can hold it
+        if self.buffer is None:
+            self.buffer = bytearray(self.buffer_size) if self.pool is None else self.pool.get()
+            self.view = memoryview(self.buffer)
+        free = len(self.buffer) - self.tail
+        if free >= size:
+            return free
+        pending = self.tail - self.head
+        if pending + size > len(self.buffer):
+            # Only when more is fed than has been decoded, the buffer grows
+            # and is not given back to the pool
+            buffer = bytearray(pending + size)
+            buffer[:pending] = self.view[self.head:self.tail]
+            if self.pool is not None and len(self.buffer) == self.pool.size:
+                self.pool.put(self.buffer)
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif pending:
+            self.buffer[:pending] = self.buffer[self.head:self.tail]
+        self.head = 0
+        self.tail = pending
+        return len(self.buffer) - self.tail
+
+    def _release(self):
+        # Everything has been decoded, start again at the front of the buffer
+        self.head = 0
+        self.tail = 0
+        if self.pool is not None and self.buffer is not None and len(self.buffer) == self.pool.size:
+            self.pool.put(self.buffer)
+            self.buffer = None
+            self.view = None
+
+    def set_frame_size(self, packet_id, size):
+        """
+        Accept frames of packet_id up to size bytes, 0 for max_frame_size
+        """
+        if size > self.buffer_size - DECODER_RECV_SPACE:
+            self.logger.error('Frames of {} bytes do not fit the buffers'.format(size))
+            raise ValueError
+        self.frame_sizes[packet_id] = size
+
+    def feed(self, data):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('feed({})'.format(repr(data)))
+        self._reserve(len(data))
+        self.buffer[self.tail:self.tail + len(data)] = data
+        self.tail += len(data)
+
+    def recv(self, skt, size=DECODER_CHUNK_SIZE):
+        """
+        Read up to size bytes from the socket into the buffer
+        Returns the number of bytes read, 0 if the socket has been closed
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('recv({}, {})'.format(repr(skt), repr(size)))
+        size = min(size, self._reserve(size))
+        recv_into = getattr(skt, 'recv_into', None)
+        try:
+            if recv_into is not None:
+                count = recv_into(self.view[self.tail:self.tail + size], size)
+            else:
+                data = skt.recv(size)
+                count = len(data)
+                self.buffer[self.tail:self.tail + count] = data
+        except Exception:
+            if self.tail == self.head:
+                self._release()
+            raise
+        self.tail += count
+        if self.tail == self.head:
+            self._release()
+        return count
+
+    def frame_offsets(self):
+        """
+        Generator returning (packet ID, start, end) for every complete frame
+        in the buffer, the frame is buffer[start:end] until the generator is
+        resumed.  The consumed data is removed from the buffer when the
+        generator finishes.
+        """
+        self.logger.debug('frame_offsets()')
+        buf = self.buffer
+        index = self.head
+        tail = self.tail
+        frame_sizes = self.frame_sizes
+        try:
+            while True:
+                start = buf.find(PACKET_START_CODE, index, tail) if index < tail else -1
+                if start < 0:
+                    # Keep a trailing first start byte, the rest of the start
+                    # code may be in the next read
+                    end = tail
+                    if end > index and buf[end - 1] == packet.PACKET_START_BYTES[0]:
+                        end -= 1
+                    if end > index:
+                        self._resync(end - index)
+                    index = end
+                    break
+                if start != index:
+                    self._resync(start - index)
+                index = start
+                if tail - start < DECODER_HEADER_SIZE:
+                    break
+                length = PACKET_LENGTH.unpack_from(buf, start + 2)[0]
+                if length < DECODER_MIN_FRAME_SIZE or length > (frame_sizes[buf[start + 4]] or self.max_frame_size):
+                    if self.logger.isEnabledFor(logging.INFO):
+                        self.logger.info('Bad frame length {}'.format(length))
+                    self.length_errors += 1
+                    index = start + 1
+                    continue
+                if tail - start < length:
+                    break
+                end = start + length
+                if buf[end - 1] != self.crc.calculate_from(buf, start + DECODER_HEADER_SIZE, length - DECODER_MIN_FRAME_SIZE):
+                    if self.logger.isEnabledFor(logging.INFO):
+                        self.logger.info('Bad frame CRC for ID 0x{:02x}'.format(buf[start + 4]))
+                    self.crc_errors += 1
+                    index = start + 1
+                    continue
+                index = end
+                yield buf[start + 4], start, end
+        finally:
+            self.head = index
+            if self.head == self.tail:
+                self._release()
+
+    def frames(self):
+        """
+        Generator returning (packet ID, frame) for every complete frame in
+        the buffer, each frame is copied out of the buffer
+        """
+        offsets = self.frame_offsets()
+        try:
+            for packet_id, start, end in offsets:
+                yield packet_id, bytes(self.buffer[start:end])
+        finally:
+            offsets.close()
+
+    def _resync(self, skipped):
+        self.resyncs += 1
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('Start code expected but not received, skipped {} bytes'.format(skipped))
+
+if __name__ == '__main__':
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test frame decoder')
+
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets to decode',
+                        type=int,
+                        default=10)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    my_packet = packet.Packet(format='f',
+                              id=0x01,
+                              name='Test Value',
+                              element_names=['value'])
+
+    # Build a stream of packets with garbage between them
+    stream = bytearray()
+    for i in range(0, args.num_packets):
+        my_packet.value = random.uniform(0, 100)
+        stream.extend(bytearray(random.randint(0, 255) for j in range(random.randint(0, 3))))
+        stream.extend(my_packet.pack())
+
+    # Feed the stream to the decoder in random sized chunks
+    decoder = FrameDecoder()
+    decoder.set_frame_size(my_packet.id, my_packet.size)
+    index = 0
+    frame_count = 0
+    while index < len(stream):
+        chunk_size = random.randint(1, 16)
+        decoder.feed(stream[index:index + chunk_size])
+        index += chunk_size
+        for packet_id, frame in decoder.frames():
+            my_packet.unpack(frame)
+            print('Packet 0x{:02x} value = {}'.format(packet_id, my_packet.value))
+            frame_count += 1
+
+    print('Decoded {} of {} packets, {} resyncs'.format(frame_count, args.num_packets, decoder.resyncs))
+    assert frame_count == args.num_packets
+
+    # A stream without garbage decodes without resyncs however it is split
+    decoder = FrameDecoder()
+    for i in range(0, args.num_packets):
+        frame = my_packet.pack()
+        split = random.randint(0, len(frame))
+        decoder.feed(frame[:split])
+        frames = list(decoder.frames())
+        decoder.feed(frame[split:])
+        frames.extend(decoder.frames())
+        assert len(frames) == 1
+    assert decoder.resyncs == 0
+
+    # A start code followed by a corrupted length does not hold up the
+    # frames behind it
+    decoder = FrameDecoder(max_frame_size=my_packet.size)
+    decoder.set_frame_size(my_packet.id, my_packet.size)
+    decoder.feed(bytearray(packet.PACKET_START_BYTES) + packet.PACKET_HEADER.pack(0, 0, 0xF000, my_packet.id)[2:] + my_packet.pack())
+    assert len(list(decoder.frames())) == 1
+    decoder.feed(bytearray(packet.PACKET_START_BYTES) + packet.PACKET_HEADER.pack(0, 0, 0xF000, 0x77)[2:] + my_packet.pack())
+    assert len(list(decoder.frames())) == 1
+    print('{} length errors'.format(decoder.length_errors))
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import logging
+import multiprocessing
+import threading
+import time
+import packet
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+DISPATCH_QUEUE_SIZE = 1024
+DISPATCH_WORKERS = 1
+DISPATCH_DROP = 'drop' # Packets for a full handler queue are dropped
+DISPATCH_BLOCK = 'block' # Receiving waits for room in a full handler queue
+
+class Handler(object):
+    """
+    Callback registered for one packet ID
+    Packets are put in a bounded queue on the receiving thread and the
+    callback is run by the handler's own worker threads, so a slow handler
+    only fills its own queue.  With a process pool the worker threads pass
+    the callback to the pool and wait for it to finish.
+    """
+    def __init__(self, packet_id, callback, workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE,
+                 policy=DISPATCH_DROP, pool=None):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        if policy not in (DISPATCH_DROP, DISPATCH_BLOCK):
+            self.logger.error('Unknown dispatch policy {}'.format(repr(policy)))
+            raise ValueError
+        self.packet_id = packet_id
+        self.callback = callback
+        self.policy = policy
+        self.pool = pool
+        self.queue = queue.Queue(queue_size)
+
+        self.stats_lock = threading.Lock()
+        self.queued = 0
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        self.workers = []
+        for index in range(workers):
+            worker = threading.Thread(target=self._worker)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+        return
+
+    def put(self, item):
+        """
+        Queue (packet ID, time received, values) for the callback
+        Returns False if the packet was dropped
+        """
+        if self.policy == DISPATCH_BLOCK:
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                with self.stats_lock:
+                    self.dropped += 1
+                return False
+        depth = self.queue.qsize()
+        with self.stats_lock:
+            self.queued += 1
+            self.max_depth = max(self.max_depth, depth)
+        return True
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            packet_id, received, values = item
+            error = False
+            try:
+                if self.pool is not None:
+                    self.pool.apply(self.callback, (packet_id, values))
+                else:
+                    self.callback(packet_id, values)
+            except Exception as e:
+                self.logger.error('Handler {} for 0x{:02x} failed {}'.format(repr(self.callback), packet_id, repr(e)))
+                error = True
+            latency = time.time() - received
+            with self.stats_lock:
+                self.handled += 1
+                self.errors += error
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        with self.stats_lock:
+            return {'packet_id': self.packet_id,
+                    'callback': getattr(self.callback, '__name__', repr(self.callback)),
+                    'queued': self.queued,
+                    'handled': self.handled,
+                    'dropped': self.dropped,
+                    'errors': self.errors,
+                    'depth': self.queue.qsize(),
+                    'max_depth': self.max_depth,
+                    'latency_mean': self.latency_total / self.handled if self.handled else 0.0,
+                    'latency_max': self.latency_max}
+
+    def stop(self):
+        self.logger.debug('stop()')
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+class Dispatcher(object):
+    """
+    Passes received packets to the handlers registered for their ID
+    dispatch() is called on the receiving thread with the decoded packet,
+    the element values are copied into a dictionary so the packet can be
+    unpacked again while the handlers run.  Callbacks are called as
+    callback(packet_id, values).  With processes > 0 callbacks run in a
+    multiprocessing pool of that size, so they must be module level
+    functions.
+    """
+    def __init__(self, workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE, policy=DISPATCH_DROP, processes=0):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self.pool = multiprocessing.Pool(processes) if processes > 0 else None
+        self.handlers_lock = threading.Lock()
+        self.handlers = [()] * packet.PACKET_MAX_ID
+
+        return
+
+    def register(self, packet_id, callback, workers=None, queue_size=None, policy=None):
+        """
+        Run callback for every packet_id dispatched, workers, queue_size and
+        policy default to those of the dispatcher
+        Returns the Handler
+        """
+        self.logger.debug('register(0x{:02x}, {})'.format(packet_id, repr(callback)))
+        handler = Handler(packet_id, callback,
+                          self.workers if workers is None else workers,
+                          self.queue_size if queue_size is None else queue_size,
+                          self.policy if policy is None else policy,
+                          self.pool)
+        with self.handlers_lock:
+            self.handlers[packet_id] = self.handlers[packet_id] + (handler,)
+        return handler
+
+    def unregister(self, handler):
+        self.logger.debug('unregister({})'.format(repr(handler)))
+        with self.handlers_lock:
+            self.handlers[handler.packet_id] = tuple(registered for registered in self.handlers[handler.packet_id]
+                                                     if registered is not handler)
+        handler.stop()
+
+    def dispatch(self, pkt):
+        handlers = self.handlers[pkt.id]
+        if not handlers:
+            return
+        item = (pkt.id, time.time(), dict(zip(pkt.element_names, pkt._values())))
+        for handler in handlers:
+            handler.put(item)
+
+    def stats(self):
+        """
+        Returns the statistics of every handler
+        """
+        return [handler.stats() for handlers in self.handlers for handler in handlers]
+
+    def stop(self):
+        self.logger.debug('stop()')
+        with self.handlers_lock:
+            handlers = [handler for registered in self.handlers for handler in registered]
+            self.handlers = [()] * packet.PACKET_MAX_ID
+        for handler in handlers:
+            handler.stop()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+def _fast_handler(packet_id, values):
+    return values['count']
+
+def _slow_handler(packet_id, values):
+    time.sleep(0.001)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test packet dispatch')
+
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets to dispatch',
+                        type=int,
+                        default=10000)
+    parser.add_argument('-w', '--workers',
+                        help='Worker threads per handler',
+                        type=int,
+                        default=4)
+    parser.add_argument('-p', '--processes',
+                        help='Run handlers in a pool of this many processes',
+                        type=int,
+                        default=0)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    my_packet = packet.Packet(format='If', id=0x01, name='Value', element_names=['count', 'value'], element_values=[0, 0.0])
+
+    my_dispatcher = Dispatcher(workers=args.workers, processes=args.processes)
+    handlers = [my_dispatcher.register(my_packet.id, _fast_handler, workers=1),
+                my_dispatcher.register(my_packet.id, _slow_handler)]
+
+    start = time.time()
+    for count in range(args.num_packets):
+        my_packet.count = count
+        my_dispatcher.dispatch(my_packet)
+    dispatch_time = time.time() - start
+    my_dispatcher.stop()
+    stats = [handler.stats() for handler in handlers]
+
+    print('Dispatched {} packets in {:.3f} s'.format(args.num_packets, dispatch_time))
+    for handler_stats in stats:
+        print('  {callback:14s} handled {handled:6d} dropped {dropped:6d} errors {errors:3d} max depth {max_depth:5d} '
+              'latency mean {latency_mean:.4f} s max {latency_max:.4f} s'.format(**handler_stats))
+        assert handler_stats['handled'] + handler_stats['dropped'] == args.num_packets
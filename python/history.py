@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import array
+import logging
+import time
+import packet
+
+HISTORY_DEPTH = 1024
+HISTORY_DROP = 'drop' # Samples received when the history is full are dropped
+HISTORY_OVERWRITE = 'overwrite' # Samples received when the history is full replace the oldest
+
+class History(object):
+    """
+    Bounded queue of the samples received for one packet ID
+    Samples are stored in preallocated columns, an array.array for each
+    numeric element and a list for the others, plus a 'timestamp' column.
+    head and tail count every sample ever read and written, the producer
+    (the receiving thread) only moves tail and the consumer only moves head
+    so neither takes a lock.  With HISTORY_OVERWRITE the consumer detects
+    samples overwritten while it was reading them from writing and discards
+    them.
+    """
+    def __init__(self, pkt, depth=HISTORY_DEPTH, policy=HISTORY_OVERWRITE):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        if policy not in (HISTORY_DROP, HISTORY_OVERWRITE):
+            self.logger.error('Unknown history policy {}'.format(repr(policy)))
+            raise ValueError
+        self.packet_id = pkt.id
+        self.element_names = list(pkt.element_names)
+        self.depth = depth
+        self.policy = policy
+        self.columns = []
+        for element_format in packet.element_formats(pkt.format):
+            if element_format in packet.PACKET_ARRAY_FORMATS:
+                self.columns.append(array.array(element_format, [0]) * depth)
+            else:
+                self.columns.append([None] * depth)
+        self.timestamps = array.array('d', [0.0]) * depth
+        self.head = 0
+        self.tail = 0
+        self.writing = -1 # Sample the producer is writing or last wrote
+        self.dropped = 0
+        self.lost = 0
+
+        return
+
+    def __len__(self):
+        return min(self.tail - self.head, self.depth)
+
+    def append(self, values, timestamp=None):
+        """
+        Add the element values of one sample, only call from one thread
+        Returns False if the sample was dropped
+        """
+        if self.policy == HISTORY_DROP and self.tail - self.head >= self.depth:
+            self.dropped += 1
+            return False
+        self.writing = self.tail
+        slot = self.tail % self.depth
+        for column, value in zip(self.columns, values):
+            column[slot] = value
+        self.timestamps[slot] = time.time() if timestamp is None else timestamp
+        self.tail += 1
+        return True
+
+    def drain(self, count=None):
+        """
+        Remove up to count samples (all if None), only call from one thread
+        Returns a dictionary of element name to list of values plus
+        'timestamp', oldest first
+        """
+        tail = self.tail
+        # Samples the producer has lapped are lost before count is taken
+        head = max(self.head, tail - self.depth)
+        if count is not None:
+            tail = min(tail, head + count)
+        samples = [self._read(column, head, tail) for column in self.columns]
+        timestamps = self._read(self.timestamps, head, tail)
+        # Samples the producer may have overwritten while they were read
+        overwritten = self.writing + 1 - self.depth - head
+        if overwritten > 0:
+            overwritten = min(overwritten, tail - head)
+            samples = [column[overwritten:] for column in samples]
+            timestamps = timestamps[overwritten:]
+            head += overwritten
+        self.lost += head - self.head
+        self.head = tail
+        result = dict(zip(self.element_names, samples))
+        result['timestamp'] = timestamps
+        return result
+
+    def pop(self):
+        """
+        Remove the oldest sample
+        Returns the tuple of element values or None if there are no samples
+        """
+        samples = self.drain(1)
+        if not samples['timestamp']:
+            return None
+        return tuple(samples[element_name][0] for element_name in self.element_names)
+
+    def _read(self, column, head, tail):
+        start = head % self.depth
+        end = start + tail - head
+        if end <= self.depth:
+            return column[start:end].tolist() if isinstance(column, array.array) else column[start:end]
+        values = column[start:] + column[:end - self.depth]
+        return values.tolist() if isinstance(column, array.array) else values
+
+if __name__ == '__main__':
+    import argparse
+    import threading
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test packet history')
+
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of samples to produce',
+                        type=int,
+                        default=100000)
+    parser.add_argument('-d', '--depth',
+                        help='Samples kept per packet ID',
+                        type=int,
+                        default=HISTORY_DEPTH)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    my_packet = packet.Packet(format='If', id=0x01, name='Value', element_names=['count', 'value'])
+
+    for policy in (HISTORY_DROP, HISTORY_OVERWRITE):
+        my_history = History(my_packet, args.depth, policy)
+
+        def produce():
+            for count in range(args.num_packets):
+                my_history.append((count, count * 0.5))
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        counts = []
+        while producer.is_alive() or len(my_history):
+            counts.extend(my_history.drain()['count'])
+        producer.join()
+        assert all(later > earlier for earlier, later in zip(counts, counts[1:]))
+        print('{:9s} received {} dropped {} lost {}'.format(policy, len(counts), my_history.dropped, my_history.lost))
+
+    # Once the producer has lapped the consumer the newest samples are read
+    my_history = History(my_packet, 4, HISTORY_OVERWRITE)
+    for count in range(10):
+        my_history.append((count, count * 0.5))
+    assert len(my_history) == 4
+    assert my_history.pop() == (6, 3.0)
+    assert my_history.drain(2)['count'] == [7, 8]
+    assert my_history.drain()['count'] == [9]
+    assert my_history.lost == 6
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import logging
+import socket
+import threading
+import client
+import decoder
+import reactor
+
+class ClientHub(object):
+    """
+    Many client connections on a single event loop
+    Every client, TCP or serial, is watched by one reactor.Reactor (epoll
+    where available) and only the clients that are ready are read, each
+    read decodes every complete frame buffered for that client.  So one
+    thread watches hundreds of devices and the time to see a packet does
+    not grow with the number of connections as it does when process_input()
+    is called on each client in turn.  The clients share a
+    decoder.BufferPool of receive buffers.  callback(clnt, pkt) is run on
+    the loop for every read that unpacks a packet, with pkt the last packet
+    received, and callback(clnt, False) once a connection has closed.
+    send_packet() and send_data() may be called from other threads.
+    """
+    def __init__(self, callback=None, pool=None):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.reactor = reactor.Reactor()
+        self.pool = decoder.BufferPool() if pool is None else pool
+        self.callback = callback
+        self.clients_lock = threading.Lock()
+        self.clients = set()
+        self.writing = set() # Clients the reactor is flushing the send buffer of
+        return
+
+    def connect(self, dest, port=None, baudrate=9600):
+        """
+        Open a client to an address or serial port and add it to the hub
+        Returns the client
+        """
+        self.logger.debug('connect({}, {}, {})'.format(repr(dest), repr(port), repr(baudrate)))
+        clnt = client.MyClient(dest, port, baudrate=baudrate, pool=self.pool)
+        self.add_client(clnt)
+        return clnt
+
+    def add_client(self, clnt):
+        """
+        Watch a client that is already open, it should have been created
+        with pool=hub.pool to share the receive buffers
+        """
+        self.logger.debug('add_client({})'.format(repr(clnt)))
+        with self.clients_lock:
+            self.clients.add(clnt)
+        self.reactor.call_soon_threadsafe(self._watch, clnt)
+
+    def remove_client(self, clnt):
+        """
+        Stop watching a client without closing it
+        """
+        self.logger.debug('remove_client({})'.format(repr(clnt)))
+        with self.clients_lock:
+            if clnt not in self.clients:
+                return
+            self.clients.discard(clnt)
+        self.reactor.call_soon_threadsafe(self._unwatch, clnt)
+
+    def close_client(self, clnt):
+        self.logger.debug('close_client({})'.format(repr(clnt)))
+        self.remove_client(clnt)
+        self.reactor.call_soon_threadsafe(clnt.close)
+
+    def _watch(self, clnt):
+        if clnt in self.clients and clnt.transport is not None:
+            self.reactor.add_reader(clnt.transport, self.read_client, clnt)
+            self._check_writer(clnt)
+
+    def _unwatch(self, clnt):
+        if clnt.transport is None:
+            return
+        self.reactor.remove_reader(clnt.transport)
+        if clnt in self.writing:
+            self.writing.discard(clnt)
+            self.reactor.remove_writer(clnt.transport)
+
+    def read_client(self, clnt):
+        try:
+            rcvd_pkt = clnt.receive()
+        except (socket.error, OSError) as e:
+            self.logger.info('Receive failed {}'.format(repr(e)))
+            rcvd_pkt = False
+        if rcvd_pkt is False:
+            self.logger.info('Interface closed')
+            self._closed(clnt)
+            return
+        if rcvd_pkt is not None and self.callback is not None:
+            self.callback(clnt, rcvd_pkt)
+        # Requests sent by the callback are flushed by the reactor
+        self._check_writer(clnt)
+
+    def _closed(self, clnt):
+        with self.clients_lock:
+            self.clients.discard(clnt)
+        self._unwatch(clnt)
+        clnt.close()
+        if self.callback is not None:
+            self.callback(clnt, False)
+
+    def send_packet(self, clnt, pkt):
+        """
+        Send a packet to a client, whatever the socket does not take now is
+        sent by the loop once it is writable
+        Returns False if the client has closed
+        """
+        with clnt.packet_list_lock:
+            data = pkt.pack()
+        if clnt.metrics is not None:
+            clnt.metrics.tx_frames[pkt.id] += 1
+            clnt.metrics.tx_bytes[pkt.id] += len(data)
+        return self.send_data(clnt, data)
+
+    def send_data(self, clnt, data):
+        if not clnt.send_data(data):
+            return False
+        if clnt.send_buffer is not None and len(clnt.send_buffer) and clnt not in self.writing:
+            self.reactor.call_soon_threadsafe(self._check_writer, clnt)
+        return True
+
+    def _check_writer(self, clnt):
+        if clnt.send_buffer is None or clnt not in self.clients or clnt in self.writing:
+            return
+        if len(clnt.send_buffer):
+            self.writing.add(clnt)
+            self.reactor.add_writer(clnt.transport, self.write_client, clnt)
+
+    def write_client(self, clnt):
+        try:
+            if not clnt.send_buffer.flush():
+                return
+        except socket.error as e:
+            self.logger.info('Send failed {}'.format(repr(e)))
+            self._closed(clnt)
+            return
+        self.writing.discard(clnt)
+        self.reactor.remove_writer(clnt.transport)
+
+    def run_once(self, timeout=reactor.REACTOR_MAX_TIMEOUT):
+        """
+        Wait up to timeout seconds and read every client that is ready
+        """
+        self.reactor.run_once(timeout)
+
+    def run(self):
+        self.logger.debug('run()')
+        self.reactor.run()
+
+    def stop(self):
+        self.logger.debug('stop()')
+        self.reactor.stop()
+
+    def close(self):
+        self.logger.debug('close()')
+        with self.clients_lock:
+            clients = list(self.clients)
+            self.clients.clear()
+        for clnt in clients:
+            self._unwatch(clnt)
+            clnt.close()
+        self.writing.clear()
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    import packet
+    import server
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test the client hub with many connections to an event server')
+
+    parser.add_argument('-n', '--num_clients',
+                        help='Number of clients to connect',
+                        type=int,
+                        default=200)
+    parser.add_argument('-r', '--rate',
+                        help='Seconds between updates to subscribe to',
+                        type=float,
+                        default=0.05)
+    parser.add_argument('-t', '--time',
+                        help='Seconds to run for',
+                        type=float,
+                        default=3.0)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    def value_packet():
+        return packet.Packet(format='d', id=0x01, name='Server Time', element_names=['time'], element_values=[0.0])
+
+    my_server = server.MyEventServer('127.0.0.1', 0)
+    my_server.add_packet(value_packet())
+    my_server.add_status(0x01)
+    server_thread = threading.Thread(target=my_server.start)
+    server_thread.setDaemon(True)
+    server_thread.start()
+    port = my_server.serversocket.getsockname()[1]
+
+    def update():
+        while True:
+            with my_server.packet_list_lock:
+                my_server.packet_list[0x01].time = time.time()
+            time.sleep(args.rate / 2)
+
+    update_thread = threading.Thread(target=update)
+    update_thread.setDaemon(True)
+    update_thread.start()
+
+    delays = []
+    closed = []
+
+    def received(clnt, pkt):
+        if pkt is False:
+            closed.append(clnt)
+        elif pkt.id == 0x01:
+            delays.append(time.time() - pkt.time)
+
+    my_hub = ClientHub(received)
+    time.sleep(0.2)
+    for index in range(args.num_clients):
+        my_client = my_hub.connect('127.0.0.1', port)
+        my_client.add_packet(value_packet())
+        my_hub.send_packet(my_client, packet.subscribe_packet([0x01], args.rate, -1.0))
+
+    end = time.time() + args.time
+    while time.time() < end:
+        my_hub.run_once(0.1)
+    my_server.stop()
+
+    delays.sort()
+    print('{} clients, {} packets received, {} closed, {} receive buffers'.format(args.num_clients, len(delays), len(closed), my_hub.pool.allocated))
+    if delays:
+        print('Age of values when received: median {:.1f} ms, 99% {:.1f} ms, max {:.1f} ms'.format(
+            delays[len(delays) // 2] * 1e3, delays[int(len(delays) * 0.99)] * 1e3, delays[-1] * 1e3))
+    my_hub.close()
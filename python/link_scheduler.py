@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import collections
+import logging
+import threading
+
+LINK_BITS_PER_BYTE = 10 # Start, 8 data and stop bits
+LINK_BURST = 0.2 # Seconds of the link rate that can be sent at once
+LINK_PRIORITY_CRITICAL = 0 # Always sent, such as commands and replies, but charged to the budget
+LINK_PRIORITY_HIGH = 1 # Sent while any budget is left
+LINK_PRIORITY_NORMAL = 2 # Sent when the whole frame fits the budget left
+LINK_PRIORITY_LOW = 3 # Sent when the frame fits the budget kept after the higher priorities
+LINK_LOW_RESERVE = 0.5 # Fraction of the burst budget low priority packets leave unused
+LINK_MEASURE_INTERVAL = 0.5 # Seconds between link rate measurements
+LINK_MEASURE_WEIGHT = 0.25 # Weight of each measurement in the link rate
+LINK_PROBE = 0.05 # Fraction the link rate is raised by while the link keeps up
+
+class LinkScheduler(object):
+    """
+    Token bucket budget for the packets sent over one link
+    The bucket fills at rate bytes a second (baudrate / LINK_BITS_PER_BYTE
+    for a serial link) up to burst seconds of it and every byte sent is
+    charged with charge() (MyClient.send_data() does this once the client
+    has a scheduler), which may leave it in debt.  Each tick select()
+    picks the status packets due that the budget allows, highest priority
+    first, and packets held back by the budget or by the max_rate of their
+    ID are left for a later tick, so a slow link gets fewer updates of the
+    latest values rather than a growing queue of old ones.  With measure
+    the rate is lowered to what the link actually sent while data was
+    queued and raised again, up to the rate given, while nothing is.
+    """
+    def __init__(self, rate=None, baudrate=None, burst=LINK_BURST, priorities=None, measure=False):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        if rate is None:
+            if baudrate is None:
+                self.logger.error('Link rate or baud rate needed')
+                raise ValueError
+            rate = baudrate / float(LINK_BITS_PER_BYTE)
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        # Packet ID -> (priority, max_rate), may be shared by several links
+        self.priorities = {} if priorities is None else priorities
+        self.lock = threading.Lock()
+        self.tokens = self.rate * burst
+        self.time = None
+        self.last_sent = {}
+        self.measure = measure
+        self.measure_time = None
+        self.measure_bytes = 0
+
+        self.bytes_charged = 0
+        self.decimated = collections.defaultdict(int)
+
+        return
+
+    def set_priority(self, packet_id, priority, max_rate=None):
+        """
+        Set the priority of a packet ID and the most times a second it is
+        sent (None for as often as it is due)
+        """
+        self.logger.debug('set_priority(0x{:02x}, {}, {})'.format(packet_id, repr(priority), repr(max_rate)))
+        self.priorities[packet_id] = (priority, max_rate)
+
+    def _fill(self, now):
+        if self.time is not None:
+            self.tokens = min(self.rate * self.burst, self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def charge(self, size, now):
+        """
+        Take size bytes sent on the link from the budget
+        """
+        with self.lock:
+            self._fill(now)
+            self.tokens -= size
+            self.bytes_charged += size
+
+    def select(self, packet_ids, sizes, now):
+        """
+        Returns the packet IDs that may be sent now, highest priority first,
+        sizes are the frame sizes of packet_ids
+        The IDs returned are taken as sent for their max_rate, the bytes are
+        charged when they are sent.
+        """
+        with self.lock:
+            self._fill(now)
+            tokens = self.tokens
+        capacity = self.rate * self.burst
+        default = (LINK_PRIORITY_NORMAL, None)
+        ordered = sorted((self.priorities.get(packet_id, default)[0], index) for index, packet_id in enumerate(packet_ids))
+        selected = []
+        for priority, index in ordered:
+            packet_id = packet_ids[index]
+            size = sizes[index]
+            max_rate = self.priorities.get(packet_id, default)[1]
+            if max_rate and now - self.last_sent.get(packet_id, 0) < 1.0 / max_rate:
+                self.decimated[packet_id] += 1
+                continue
+            if priority <= LINK_PRIORITY_CRITICAL:
+                send = True
+            elif priority == LINK_PRIORITY_HIGH:
+                send = tokens > 0
+            elif priority == LINK_PRIORITY_NORMAL:
+                # A frame larger than the bucket goes once it is full
+                send = tokens >= min(size, capacity)
+            else:
+                send = tokens >= min(size + capacity * LINK_LOW_RESERVE, capacity)
+            if not send:
+                self.decimated[packet_id] += 1
+                continue
+            tokens -= size
+            self.last_sent[packet_id] = now
+            selected.append(packet_id)
+        return selected
+
+    def update(self, bytes_sent, backlog, now):
+        """
+        Measure the link rate from a count of the bytes it has sent (such as
+        SendBuffer.bytes_sent) and the bytes waiting to be sent, when
+        measure is set
+        """
+        if not self.measure:
+            return
+        if self.measure_time is None:
+            self.measure_time = now
+            self.measure_bytes = bytes_sent
+            return
+        elapsed = now - self.measure_time
+        if elapsed < LINK_MEASURE_INTERVAL:
+            return
+        if backlog:
+            # The link was busy so it sent as fast as it could
+            measured = (bytes_sent - self.measure_bytes) / elapsed
+            self.rate = max(self.rate * (1.0 - LINK_MEASURE_WEIGHT) + measured * LINK_MEASURE_WEIGHT, self.max_rate * 0.01)
+        else:
+            self.rate = min(self.rate * (1.0 + LINK_PROBE), self.max_rate)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Link rate {:.0f} bytes/s, {} bytes queued'.format(self.rate, backlog))
+        self.measure_time = now
+        self.measure_bytes = bytes_sent
+
+    def stats(self):
+        return {'rate': self.rate,
+                'tokens': self.tokens,
+                'bytes_charged': self.bytes_charged,
+                'decimated': dict(self.decimated)}
+
+if __name__ == '__main__':
+    import argparse
+    import errno
+    import os
+    import socket
+    import time
+    import client
+    import packet
+    import server
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test the link scheduler with a client that reads at the rate of a serial line')
+
+    parser.add_argument('-b', '--baudrate',
+                        help='Baud rate of the simulated serial line',
+                        type=int,
+                        default=9600)
+    parser.add_argument('-t', '--time',
+                        help='Seconds to run for',
+                        type=float,
+                        default=5.0)
+    parser.add_argument('-n', '--no_scheduler',
+                        help='Send every packet due, to compare',
+                        action='store_true')
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    class SerialLine(object):
+        # Socket read no faster than a serial line delivers
+        def __init__(self, skt, rate):
+            self.skt = skt
+            self.rate = rate
+            self.time = time.time()
+            self.allowance = 0.0
+
+        def fileno(self):
+            return self.skt.fileno()
+
+        def recv_into(self, view, size=0):
+            now = time.time()
+            self.allowance = min(self.allowance + (now - self.time) * self.rate, self.rate * LINK_BURST)
+            self.time = now
+            size = min(size or len(view), int(self.allowance))
+            if size <= 0:
+                raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+            count = self.skt.recv_into(view, size)
+            self.allowance -= count
+            return count
+
+        def send(self, data):
+            return self.skt.send(data)
+
+        def close(self):
+            self.skt.close()
+
+    # An alarm, a fast status and bulk samples that together need several
+    # times the link rate
+    def link_packets():
+        return [packet.Packet(format='dI', id=0x01, name='Alarm', element_names=['time', 'code'], element_values=[0.0, 0]),
+                packet.Packet(format='d4f', id=0x02, name='Status', element_names=['time', 'a', 'b', 'c', 'd'], element_values=[0.0] * 5),
+                packet.Packet(format='d64h', id=0x03, name='Samples', element_names=['time'] + ['sample_{}'.format(index) for index in range(64)],
+                              element_values=[0.0] * 65)]
+
+    my_server = server.MyEventServer('127.0.0.1', 0)
+    for pkt in link_packets():
+        my_server.add_packet(pkt)
+        my_server.add_status(pkt.id)
+    if not args.no_scheduler:
+        my_server.set_link_budget(baudrate=args.baudrate)
+        my_server.set_priority(0x01, LINK_PRIORITY_CRITICAL)
+        my_server.set_priority(0x02, LINK_PRIORITY_HIGH, max_rate=20.0)
+        my_server.set_priority(0x03, LINK_PRIORITY_LOW)
+    server_metrics = my_server.enable_metrics()
+    server_thread = threading.Thread(target=my_server.start)
+    server_thread.setDaemon(True)
+    server_thread.start()
+    time.sleep(0.2)
+
+    skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    skt.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0x1000)
+    skt.connect(my_server.serversocket.getsockname())
+    my_client = client.MyClient(transport=SerialLine(skt, args.baudrate / float(LINK_BITS_PER_BYTE)))
+    for pkt in link_packets():
+        my_client.add_packet(pkt)
+    my_client.subscribe([0x01, 0x02, 0x03], 0.01)
+
+    names = {0x01: 'Alarm', 0x02: 'Status', 0x03: 'Samples'}
+    ages = dict((packet_id, []) for packet_id in names)
+
+    def received(packet_id, values):
+        if values['time'] == 0.0:
+            # Sent before the first update
+            return
+        ages[packet_id].append(time.time() - values['time'])
+
+    for packet_id in names:
+        my_client.add_handler(packet_id, received)
+
+    start = time.time()
+    next_alarm = start
+    while time.time() - start < args.time:
+        now = time.time()
+        with my_server.packet_list_lock:
+            for packet_id in (0x02, 0x03):
+                my_server.packet_list[packet_id].time = now
+            if now >= next_alarm:
+                my_server.packet_list[0x01].time = now
+                my_server.packet_list[0x01].code += 1
+                next_alarm = now + 0.5
+        if my_client.process_input(0.01) is None:
+            time.sleep(0.005)
+    my_server.stop()
+    server_thread.join()
+
+    print('{} baud {} the scheduler, {} status packets decimated'.format(
+        args.baudrate, 'without' if args.no_scheduler else 'with', server_metrics.counters['status_decimated']))
+    for packet_id, name in sorted(names.items()):
+        values = sorted(ages[packet_id])
+        if values:
+            print('  {:8} {:5} received, age median {:8.1f} ms, max {:8.1f} ms'.format(
+                name, len(values), values[len(values) // 2] * 1e3, values[-1] * 1e3))
+        else:
+            print('  {:8} none received'.format(name))
@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import collections
+import heapq
+import logging
+import random
+import socket
+import string
+import struct
+import threading
+import time
+import client
+import metrics
+import packet
+import send_buffer
+import server
+
+LOADGEN_RATE = 10.0 # Frames per second of each packet from each device
+LOADGEN_VARIANTS = 16 # Frames with different random values packed for each packet
+LOADGEN_GARBAGE_SIZE = 32 # Most garbage bytes injected at once
+LOADGEN_MATCH_DEPTH = 64 # Frames a received frame is matched against
+LOADGEN_DRAIN_TIMEOUT = 5.0 # Seconds to wait for the frames in flight at the end
+LOADGEN_HIGH_WATER = 0x4000 # Bytes a device queues before it drops frames
+
+def random_values(format):
+    """
+    Random values for every element of a packet format
+    """
+    values = []
+    for element_format in packet.element_formats(format):
+        code = element_format[-1]
+        if code in 'sp':
+            values.append(''.join(random.choice(string.ascii_letters) for index in range(int(element_format[:-1] or 1))).encode('ascii'))
+        elif code == 'c':
+            values.append(random.choice(string.ascii_letters).encode('ascii'))
+        elif code == '?':
+            values.append(random.random() < 0.5)
+        elif code in 'efd':
+            values.append(random.uniform(-1000.0, 1000.0))
+        else:
+            bits = 8 * struct.calcsize(code)
+            if code.islower():
+                values.append(random.randint(-(1 << (bits - 1)), (1 << (bits - 1)) - 1))
+            else:
+                values.append(random.randint(0, (1 << bits) - 1))
+    return values
+
+class Device(object):
+    """
+    One simulated device, frames written are queued in a send buffer and,
+    when they are valid, remembered with the time they were written until
+    the server receives them
+    """
+    def __init__(self, skt, index, high_water=LOADGEN_HIGH_WATER):
+        self.socket = skt
+        self.socket.setblocking(0)
+        self.index = index
+        self.send_buffer = send_buffer.SendBuffer(skt, high_water, high_water // 4)
+        self.in_flight = collections.deque() # (time written, frame)
+        self.closed = False
+
+class LatencyProbe(object):
+    """
+    Takes the place of the capture file of the server's client for a
+    device, so every frame the server decodes is matched with the oldest
+    frame in flight from the device that has the same bytes.  Frames in
+    flight before the match were lost, frames with no match are phantoms
+    made by garbage that happened to look like a frame.  Runs on the
+    server's event loop.
+    """
+    def __init__(self, device, generator):
+        self.device = device
+        self.generator = generator
+
+    def write(self, frame, packet_id=None, timestamp=None):
+        now = time.time()
+        in_flight = self.device.in_flight
+        # Indexed rather than iterated as the generator thread appends
+        # while this runs, only this thread removes frames
+        for index in range(min(len(in_flight), LOADGEN_MATCH_DEPTH)):
+            sent, sent_frame = in_flight[index]
+            if sent_frame == frame:
+                for skipped in range(index + 1):
+                    in_flight.popleft()
+                self.generator.lost += index
+                self.generator.received += 1
+                self.generator.received_bytes += len(frame)
+                self.generator.latency.observe(now - sent)
+                return
+        self.generator.phantoms += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class LoadServer(server.MyEventServer):
+    """
+    Event server that gives the client of every simulated device its
+    LatencyProbe, devices are connected over TCP or handed one end of a
+    socket pair with add_socket()
+    """
+    def __init__(self, addr='127.0.0.1', port=0):
+        server.MyEventServer.__init__(self, addr, port)
+
+        self.probes = {} # Device address -> LatencyProbe
+        return
+
+    def add_client(self, clnt):
+        server.MyEventServer.add_client(self, clnt)
+        probe = self.probes.get(clnt.clientsocket.getpeername())
+        if probe is not None:
+            clnt.set_capture(probe)
+
+    def add_socket(self, skt, probe):
+        """
+        Serve the server end of a socket pair, may be called from any thread
+        """
+        self.reactor.call_soon_threadsafe(self._add_socket, skt, probe)
+
+    def _add_socket(self, skt, probe):
+        clnt = client.MyClient(skt=skt, pool=self.buffer_pool)
+        server.MyEventServer.add_client(self, clnt)
+        clnt.set_capture(probe)
+        self.reactor.add_reader(skt, self.read_client, clnt)
+
+class LoadGenerator(object):
+    """
+    Simulated devices sending a mix of packets to a LoadServer
+    Every device sends each packet of packets at rates[packet_id] frames a
+    second, burst frames at a time, starting at random times so the load is
+    spread evenly.  A fraction corrupt of the frames have a bad CRC and a
+    fraction garbage are preceded by up to LOADGEN_GARBAGE_SIZE random
+    bytes, which the server's decoders have to resync after.  A device
+    whose send buffer reaches its high water mark drops frames as a device
+    with a full transmit buffer would.  Everything runs in this process,
+    the server on its own thread, so the throughput is of the server and
+    generator sharing one interpreter.
+    """
+    def __init__(self, packets, rates=None, num_devices=100, burst=1, corrupt=0.0, garbage=0.0, socketpairs=False):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.packets = list(packets)
+        self.rates = rates or {}
+        self.num_devices = num_devices
+        self.burst = burst
+        self.corrupt = corrupt
+        self.garbage = garbage
+        self.socketpairs = socketpairs
+        self.server = LoadServer()
+        for pkt in self.packets:
+            self.server.add_packet(pkt)
+        self.devices = []
+        self.server_thread = None
+        self.latency = metrics.Histogram()
+        self.garbage_bytes = bytes(bytearray(random.getrandbits(8) for index in range(0x10000)))
+
+        # Frames with random values and the same frames with a bad CRC
+        self.frames = {}
+        self.bad_frames = {}
+        for pkt in self.packets:
+            frames = []
+            for index in range(LOADGEN_VARIANTS):
+                pkt._set_values(random_values(pkt.format))
+                frames.append(pkt.pack())
+            self.frames[pkt.id] = frames
+            self.bad_frames[pkt.id] = [frame[:-1] + bytes(bytearray([ord(frame[-1:]) ^ 0xff])) for frame in frames]
+
+        self.sent = 0
+        self.sent_bytes = 0
+        self.corrupted = 0
+        self.garbage_sent = 0
+        self.dropped = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.lost = 0
+        self.phantoms = 0
+        self.duration = 0.0
+
+        return
+
+    def start(self):
+        """
+        Start the server and connect the devices
+        """
+        self.logger.debug('start()')
+        # Listen now so the devices can connect before the server thread runs
+        self.server.serversocket.listen(server.SERVER_LISTEN_BACKLOG)
+        self.server_thread = threading.Thread(target=self.server.start)
+        self.server_thread.setDaemon(True)
+        self.server_thread.start()
+        address = self.server.serversocket.getsockname()
+        for index in range(self.num_devices):
+            if self.socketpairs:
+                device_socket, server_socket = socket.socketpair()
+                device = Device(device_socket, index)
+                self.server.add_socket(server_socket, LatencyProbe(device, self))
+            else:
+                device_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                device_socket.bind((address[0], 0))
+                device = Device(device_socket, index)
+                # The probe must be known before the server accepts the device
+                self.server.probes[device_socket.getsockname()] = LatencyProbe(device, self)
+                device_socket.setblocking(1)
+                device_socket.connect(address)
+                device_socket.setblocking(0)
+            self.devices.append(device)
+        # Frames sent before the server has every device would be timed
+        # from before it was accepted
+        deadline = time.time() + LOADGEN_DRAIN_TIMEOUT
+        while len(self.server.clients) < len(self.devices) and time.time() < deadline:
+            time.sleep(0.01)
+        self.logger.info('{} devices connected, {} accepted'.format(len(self.devices), len(self.server.clients)))
+
+    def run(self, duration):
+        """
+        Send the packet mix for duration seconds then wait for the frames in
+        flight to be received
+        """
+        self.logger.debug('run({})'.format(repr(duration)))
+        start = time.time()
+        schedule = []
+        for device in self.devices:
+            for pkt in self.packets:
+                interval = self.burst / float(self.rates.get(pkt.id, LOADGEN_RATE))
+                schedule.append([start + random.uniform(0, interval), device.index, pkt.id, interval])
+        heapq.heapify(schedule)
+        flushing = set()
+        end = start + duration
+        now = start
+        while now < end:
+            while schedule and schedule[0][0] <= now:
+                event = schedule[0]
+                device = self.devices[event[1]]
+                for index in range(self.burst):
+                    self._send(device, event[2])
+                if len(device.send_buffer):
+                    flushing.add(device)
+                event[0] += event[3]
+                heapq.heapreplace(schedule, event)
+            flushing = self._flush(flushing)
+            now = time.time()
+            if schedule and schedule[0][0] > now:
+                time.sleep(min(schedule[0][0] - now, 0.001 if flushing else 0.01))
+                now = time.time()
+        self.duration = now - start
+        for device in self.devices:
+            flushing.add(device)
+        drain_end = time.time() + LOADGEN_DRAIN_TIMEOUT
+        while time.time() < drain_end:
+            flushing = self._flush(flushing)
+            if not flushing and not any(device.in_flight for device in self.devices):
+                break
+            time.sleep(0.001)
+        self.server.stop()
+        self.server_thread.join()
+        # Anything not received by now is taken as lost
+        self.lost += sum(len(device.in_flight) for device in self.devices)
+
+    def _send(self, device, packet_id):
+        if device.closed:
+            return
+        if device.send_buffer.backpressure:
+            self.dropped += 1
+            return
+        if self.corrupt and random.random() < self.corrupt:
+            data = random.choice(self.bad_frames[packet_id])
+            self.corrupted += 1
+        else:
+            data = random.choice(self.frames[packet_id])
+            device.in_flight.append((time.time(), data))
+            self.sent += 1
+            self.sent_bytes += len(data)
+        if self.garbage and random.random() < self.garbage:
+            offset = random.randrange(len(self.garbage_bytes) - LOADGEN_GARBAGE_SIZE)
+            data = self.garbage_bytes[offset:offset + random.randint(1, LOADGEN_GARBAGE_SIZE)] + data
+            self.garbage_sent += 1
+        try:
+            if not device.send_buffer.write(data):
+                device.closed = True
+        except socket.error as e:
+            self.logger.warning('Device {} send failed {}'.format(device.index, repr(e)))
+            device.closed = True
+
+    def _flush(self, flushing):
+        # Returns the devices that still have data queued
+        still_flushing = set()
+        for device in flushing:
+            try:
+                if not device.closed and not device.send_buffer.flush():
+                    still_flushing.add(device)
+            except socket.error as e:
+                self.logger.warning('Device {} send failed {}'.format(device.index, repr(e)))
+                device.closed = True
+        return still_flushing
+
+    def results(self):
+        """
+        Returns the counts, throughput and latency percentiles of the run
+        """
+        decoders = [clnt.decoder for clnt in list(self.server.clients.values())]
+        duration = self.duration or 1.0
+        results = {'devices': len(self.devices),
+                   'duration': self.duration,
+                   'sent': self.sent,
+                   'sent_bytes': self.sent_bytes,
+                   'corrupted': self.corrupted,
+                   'garbage': self.garbage_sent,
+                   'dropped': self.dropped,
+                   'received': self.received,
+                   'received_bytes': self.received_bytes,
+                   'lost': self.lost,
+                   'phantoms': self.phantoms,
+                   'sent_rate': self.sent / duration,
+                   'received_rate': self.received / duration,
+                   'received_byte_rate': self.received_bytes / duration,
+                   'crc_errors': sum(frame_decoder.crc_errors for frame_decoder in decoders),
+                   'length_errors': sum(frame_decoder.length_errors for frame_decoder in decoders),
+                   'resyncs': sum(frame_decoder.resyncs for frame_decoder in decoders),
+                   'latency': self.latency.snapshot()}
+        return results
+
+    def close(self):
+        self.logger.debug('close()')
+        for device in self.devices:
+            device.socket.close()
+        self.devices = []
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import resource
+    import catalog
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Load the server with simulated devices sending the packets of the catalog')
+
+    parser.add_argument('-n', '--num_devices',
+                        help='Number of devices to simulate',
+                        type=int,
+                        default=1000)
+    parser.add_argument('-m', '--mix',
+                        help='Packets to send and frames a second from each device as ID:rate,... (default every catalog packet at {} Hz)'.format(LOADGEN_RATE),
+                        default=None)
+    parser.add_argument('-b', '--burst',
+                        help='Frames each device sends back to back, at the same average rate',
+                        type=int,
+                        default=1)
+    parser.add_argument('-c', '--corrupt',
+                        help='Fraction of frames sent with a bad CRC',
+                        type=float,
+                        default=0.0)
+    parser.add_argument('-g', '--garbage',
+                        help='Fraction of frames preceded by garbage bytes',
+                        type=float,
+                        default=0.0)
+    parser.add_argument('-s', '--socketpairs',
+                        help='Connect the devices with socket pairs instead of TCP over loopback',
+                        action='store_true')
+    parser.add_argument('-t', '--time',
+                        help='Seconds to send for',
+                        type=float,
+                        default=10.0)
+    parser.add_argument('-j', '--json',
+                        help='Print the results as JSON',
+                        action='store_true')
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    # Both ends of every device are in this process
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 2 * args.num_devices + 64 and soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    # The reserved IDs make the server change the subscriptions
+    packet_classes = dict((packet_id, packet_class) for packet_id, packet_class in catalog.PACKET_CLASSES.items()
+                          if packet_id not in (packet.PACKET_SUBSCRIBE_ID, packet.PACKET_AGGREGATE_ID, packet.PACKET_NEGOTIATE_ID))
+    if args.mix is None:
+        rates = dict((packet_id, LOADGEN_RATE) for packet_id in packet_classes)
+    else:
+        rates = dict((int(packet_id, 0), float(rate)) for packet_id, rate in (item.split(':') for item in args.mix.split(',')))
+    my_generator = LoadGenerator([packet_classes[packet_id]() for packet_id in sorted(rates)], rates, args.num_devices,
+                                 args.burst, args.corrupt, args.garbage, args.socketpairs)
+    my_generator.start()
+    my_generator.run(args.time)
+    results = my_generator.results()
+    my_generator.close()
+
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        latency = results['latency']
+        print('{} devices over {} for {:.1f} s'.format(results['devices'], 'socket pairs' if args.socketpairs else 'TCP', results['duration']))
+        print('  Sent      {sent} frames, {corrupted} with a bad CRC, {garbage} after garbage, {dropped} dropped by full devices'.format(**results))
+        print('  Received  {received} frames, {lost} lost, {phantoms} phantoms'.format(**results))
+        print('  Decoder   {crc_errors} CRC errors, {length_errors} length errors, {resyncs} resyncs'.format(**results))
+        print('  Rate      {:.0f} frames/s sent, {:.0f} frames/s and {:.0f} kB/s received'.format(
+            results['sent_rate'], results['received_rate'], results['received_byte_rate'] / 1e3))
+        if latency['count']:
+            # Percentiles are the upper bound of their histogram bucket
+            print('  Latency   p50 <{:.3f} ms, p90 <{:.3f} ms, p99 <{:.3f} ms, max {:.3f} ms'.format(
+                *[min(latency[name], latency['max']) * 1e3 for name in ('p50', 'p90', 'p99', 'max')]))
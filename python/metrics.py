@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import bisect
+import collections
+import fcntl
+import json
+import logging
+import struct
+import termios
+import threading
+import time
+import timeit
+import packet
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+METRICS_BUCKETS = tuple(1e-6 * 2 ** index for index in range(24)) # 1 us to 8 s
+METRICS_PERCENTILES = (50, 90, 99)
+METRICS_PREFIX = 'alma'
+METRICS_QUEUE_SIZE = struct.Struct('i')
+
+def send_queue(skt):
+    """
+    Bytes sent on a socket that the peer has not acknowledged yet
+    """
+    return METRICS_QUEUE_SIZE.unpack(fcntl.ioctl(skt.fileno(), termios.TIOCOUTQ, METRICS_QUEUE_SIZE.pack(0)))[0]
+
+class Histogram(object):
+    """
+    Count of values in fixed buckets
+    Bucket n counts the values up to bounds[n], the last bucket the values
+    above every bound.  Percentiles are the bound of the bucket they fall in.
+    """
+    def __init__(self, bounds=METRICS_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        if self.count == 0:
+            return None
+        rank = percentile / 100.0 * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        results = {'count': self.count,
+                   'sum': self.sum,
+                   'max': self.max,
+                   'buckets': list(zip(self.bounds, self.counts))}
+        for percentile in METRICS_PERCENTILES:
+            results['p{}'.format(percentile)] = self.percentile(percentile)
+        return results
+
+class TimedLock(object):
+    """
+    Lock that records the seconds spent waiting for it in a histogram, only
+    waits that were needed are timed so an uncontended lock costs one
+    non-blocking acquire
+    """
+    def __init__(self, lock, histogram):
+        self.lock = lock
+        self.histogram = histogram
+
+    def acquire(self, blocking=True):
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = timeit.default_timer()
+        self.lock.acquire()
+        self.histogram.observe(timeit.default_timer() - start)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+
+class Metrics(object):
+    """
+    Counters, histograms and gauges for one client or server
+    Per ID frame and byte counts are lists indexed by packet ID and other
+    counts are in counters, both are incremented without a lock so counts
+    from several threads may be slightly low.  Gauges are functions called
+    when a snapshot is taken, so values that already exist elsewhere (such
+    as the decoder error counts) cost nothing until then.  children holds
+    the metrics of the clients of a server.
+    """
+    def __init__(self, name=''):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.name = name
+        self.start_time = time.time()
+        self.rx_frames = [0] * packet.PACKET_MAX_ID
+        self.rx_bytes = [0] * packet.PACKET_MAX_ID
+        self.tx_frames = [0] * packet.PACKET_MAX_ID
+        self.tx_bytes = [0] * packet.PACKET_MAX_ID
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+        self.gauges = {}
+        self.children_lock = threading.Lock()
+        self.children = {}
+
+        return
+
+    def histogram(self, name, bounds=METRICS_BUCKETS):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(bounds)
+        return self.histograms[name]
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def add_child(self, key, metrics):
+        with self.children_lock:
+            self.children[key] = metrics
+
+    def remove_child(self, key):
+        with self.children_lock:
+            self.children.pop(key, None)
+
+    def _gauge_values(self):
+        values = {}
+        for name, function in list(self.gauges.items()):
+            try:
+                values[name] = function()
+            except Exception as e:
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('Gauge {} failed {}'.format(name, repr(e)))
+                values[name] = None
+        return values
+
+    def snapshot(self):
+        """
+        Returns every metric as a dictionary, packet IDs with no traffic are
+        left out
+        """
+        uptime = time.time() - self.start_time
+        per_id = {}
+        for packet_id in range(packet.PACKET_MAX_ID):
+            counts = (self.rx_frames[packet_id], self.rx_bytes[packet_id], self.tx_frames[packet_id], self.tx_bytes[packet_id])
+            if any(counts):
+                per_id['0x{:02x}'.format(packet_id)] = dict(zip(('rx_frames', 'rx_bytes', 'tx_frames', 'tx_bytes'), counts))
+        with self.children_lock:
+            children = list(self.children.values())
+        return {'name': self.name,
+                'uptime': uptime,
+                'rx_frames': sum(self.rx_frames),
+                'rx_bytes': sum(self.rx_bytes),
+                'tx_frames': sum(self.tx_frames),
+                'tx_bytes': sum(self.tx_bytes),
+                'packets': per_id,
+                'counters': dict(self.counters),
+                'histograms': dict((name, histogram.snapshot()) for name, histogram in list(self.histograms.items())),
+                'gauges': self._gauge_values(),
+                'children': [child.snapshot() for child in children]}
+
+    def text(self, snapshot=None):
+        """
+        Returns the snapshot in the Prometheus text format
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = []
+        self._text(snapshot, lines)
+        return '\n'.join(lines) + '\n'
+
+    def _text(self, snapshot, lines):
+        source = 'source="{}"'.format(snapshot['name'])
+        lines.append('{}_uptime_seconds{{{}}} {}'.format(METRICS_PREFIX, source, snapshot['uptime']))
+        for packet_id, counts in sorted(snapshot['packets'].items()):
+            for name, value in sorted(counts.items()):
+                lines.append('{}_{}_total{{{},id="{}"}} {}'.format(METRICS_PREFIX, name, source, packet_id, value))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('{}_{}_total{{{}}} {}'.format(METRICS_PREFIX, name, source, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            if value is not None:
+                lines.append('{}_{}{{{}}} {}'.format(METRICS_PREFIX, name, source, value))
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            total = 0
+            for bound, count in histogram['buckets']:
+                total += count
+                lines.append('{}_{}_bucket{{{},le="{:g}"}} {}'.format(METRICS_PREFIX, name, source, bound, total))
+            lines.append('{}_{}_bucket{{{},le="+Inf"}} {}'.format(METRICS_PREFIX, name, source, histogram['count']))
+            lines.append('{}_{}_sum{{{}}} {}'.format(METRICS_PREFIX, name, source, histogram['sum']))
+            lines.append('{}_{}_count{{{}}} {}'.format(METRICS_PREFIX, name, source, histogram['count']))
+        for child in snapshot['children']:
+            self._text(child, lines)
+
+class MetricsServer(object):
+    """
+    HTTP endpoint for a Metrics object on its own thread
+    GET /metrics returns the Prometheus text format and /metrics.json the
+    snapshot as JSON.  Binds to the loopback address by default.
+    """
+    def __init__(self, metrics, addr='127.0.0.1', port=0):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        logger = self.logger
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.text().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = json.dumps(metrics.snapshot(), sort_keys=True).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(format % args)
+
+        self.httpserver = HTTPServer((addr, port), MetricsRequestHandler)
+        self.address = self.httpserver.server_address
+        self.logger.info('Metrics on http://{}:{}/metrics'.format(self.address[0], self.address[1]))
+        self.thread = threading.Thread(target=self.httpserver.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+        return
+
+    def stop(self):
+        self.logger.debug('stop()')
+        self.httpserver.shutdown()
+        self.httpserver.server_close()
+
+if __name__ == '__main__':
+    import argparse
+    import random
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test metrics')
+
+    parser.add_argument('-p', '--port',
+                        help='Port to serve the metrics on',
+                        type=int,
+                        default=0)
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets to count',
+                        type=int,
+                        default=100000)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    my_metrics = Metrics('test')
+    latency = my_metrics.histogram('latency_seconds')
+    my_metrics.gauge('random', random.random)
+
+    start = timeit.default_timer()
+    for index in range(args.num_packets):
+        packet_id = index & 0x07
+        my_metrics.rx_frames[packet_id] += 1
+        my_metrics.rx_bytes[packet_id] += 20
+        latency.observe(random.expovariate(1000.0))
+    print('{:.3f} us per packet counted'.format((timeit.default_timer() - start) / args.num_packets * 1e6))
+
+    print(my_metrics.text())
+    if args.port:
+        my_server = MetricsServer(my_metrics, port=args.port)
+        while True:
+            time.sleep(1.0)
@@ -4,15 +4,133 @@ from __future__ import(print_function)
 
 __version__ = filter(str.isdigit, '$Revision: $')
 
+import array
 import logging
+import operator
+import re
 import struct
 import crc8
 
 
 PACKET_START_BYTES = (0xa1, 0x95)
 PACKET_MAX_ID = 0xFF
+PACKET_HEADER = struct.Struct('2BHB')
+PACKET_CRC = struct.Struct('B')
+PACKET_OVERHEAD = PACKET_HEADER.size + PACKET_CRC.size
+PACKET_TRACE_INTERVAL = 0 # Log every Nth unpacked packet at INFO level, 0 disables tracing
+# Element formats that array.array can store
+PACKET_ARRAY_FORMATS = frozenset(code for code in 'bBhHiIlLqQfd' if code in getattr(array, 'typecodes', 'bBhHiIlLfd'))
 
-class Packet(object):
+# Type each element of a compact packet is converted to when set
+PACKET_ELEMENT_TYPES = dict([(code, int) for code in 'bBhHiIlLqQnNP'] +
+                            [(code, float) for code in 'efd'] +
+                            [('?', bool), ('c', bytes), ('s', bytes), ('p', bytes)])
+
+# Reserved packet IDs used by the client and server themselves
+PACKET_SUBSCRIBE_ID = 0xFE
+PACKET_AGGREGATE_ID = 0xFD
+PACKET_NEGOTIATE_ID = 0xFC
+PACKET_DATAGRAM_ID = 0xFB
+
+class PacketCodec(object):
+    """
+    Packing and unpacking shared by Packet and the classes made by
+    packet_class(), subclasses provide _values() and _set_values()
+    """
+    __slots__ = ()
+
+    def pack(self):
+        self.logger.debug('pack()')
+        data = self._to_bytes()
+        header = PACKET_HEADER.pack(PACKET_START_BYTES[0], PACKET_START_BYTES[1], self.size, self.id)
+        return header + data + PACKET_CRC.pack(self.crc.calculate(data))
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Pack the packet into a writable buffer (bytearray, memoryview, etc)
+        starting at offset
+        Returns the number of bytes written
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('pack_into({}, {})'.format(repr(buffer), repr(offset)))
+        data_offset = offset + PACKET_HEADER.size
+        crc_offset = offset + self.size - PACKET_CRC.size
+        PACKET_HEADER.pack_into(buffer, offset, PACKET_START_BYTES[0], PACKET_START_BYTES[1], self.size, self.id)
+        self._struct.pack_into(buffer, data_offset, *self._values())
+        PACKET_CRC.pack_into(buffer, crc_offset, self.crc.calculate(memoryview(buffer)[data_offset:crc_offset]))
+        return self.size
+
+    def unpack(self, data):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('unpack({})'.format(repr(data)))
+        header = PACKET_HEADER.unpack_from(data)
+        if len(data) != header[2]:
+            self.logger.error('Bad packet length {} != {}'.format(repr(header[2]), repr(len(data))))
+            raise ValueError
+        self.unpack_from(data)
+
+    def unpack_from(self, buffer, offset=0, check_crc=True):
+        """
+        Unpack the packet from a buffer (bytes, bytearray, memoryview, etc)
+        starting at offset, check_crc=False skips the CRC of frames that
+        have already been checked (such as those from a FrameDecoder)
+        Returns the number of bytes used
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('unpack_from({}, {})'.format(repr(buffer), repr(offset)))
+        header = PACKET_HEADER.unpack_from(buffer, offset)
+        if header[0] != PACKET_START_BYTES[0] or header[1] != PACKET_START_BYTES[1]:
+            self.logger.error('Bad start bytes 0xa195 != 0x{:02x}{:02x}'.format(header[0], header[1]))
+            raise ValueError
+        if header[3] != self.id:
+            self.logger.error('Bad packet ID {} != {}'.format(repr(self.id), repr(header[3])))
+            raise ValueError
+        if header[2] != self.size:
+            self.logger.error('Bad packet size {} != {}'.format(repr(self.size), repr(header[2])))
+            raise ValueError
+        data_offset = offset + PACKET_HEADER.size
+        crc_offset = offset + self.size - PACKET_CRC.size
+        if check_crc:
+            crc = self.crc.calculate_from(buffer, data_offset, crc_offset - data_offset)
+            if PACKET_CRC.unpack_from(buffer, crc_offset)[0] != crc:
+                self.logger.error('Bad CRC 0x{:02x} != 0x{:02x}'.format(crc, PACKET_CRC.unpack_from(buffer, crc_offset)[0]))
+                raise ValueError
+        self._set_values(self._struct.unpack_from(buffer, data_offset))
+        if self.trace_interval:
+            self._trace(header)
+        return self.size
+
+    def set_trace(self, interval):
+        """
+        Log every interval'th unpacked packet at INFO level, 0 disables tracing
+        """
+        self.logger.debug('set_trace({})'.format(repr(interval)))
+        self.trace_interval = interval
+        self._trace_count = 0
+
+    def _trace(self, header):
+        self._trace_count += 1
+        if self._trace_count < self.trace_interval:
+            return
+        self._trace_count = 0
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('Unpacking {}'.format(repr(self.name)))
+            self.logger.info('  Start code: 0x{:02x}{:02x}'.format(header[0], header[1]))
+            self.logger.info('  Size:       {}'.format(repr(header[2])))
+            self.logger.info('  ID:         {}'.format(repr(header[3])))
+            for element_name in self.element_names:
+                self.logger.info('    {} = {}'.format(element_name, getattr(self, element_name)))
+
+    def _to_bytes(self):
+        self.logger.debug('_to_bytes()')
+        return self._struct.pack(*self._values())
+
+    def _from_bytes(self, bytes):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('_from_bytes({})'.format(repr(bytes)))
+        self._set_values(self._struct.unpack(bytes))
+
+class Packet(PacketCodec):
     """
     Packet for serial data stream (Ethernet, RS232/RS422, etc)
     The basic format of the packet is:
@@ -21,7 +139,12 @@ class Packet(object):
       ID = 1 byte
       Data = (length - 1) * bytes
       CRC = 1 byte
+    version is incremented every time an element changes value or the
+    packet is unpacked so senders can skip packets that have not changed.
     """
+    version = 0
+    _elements = frozenset()
+
     def __init__(self, format='', id=0xFF, name='', element_names=None, element_values=None):
         self.logger = logging.getLogger(__name__)
         self.logger.debug('__init__')
@@ -29,8 +152,11 @@ class Packet(object):
         self.format = format
         self.id = id
         self.name = name
+        self.trace_interval = PACKET_TRACE_INTERVAL
+        self._trace_count = 0
         if element_names is not None:
             self.element_names = element_names
+            self._elements = frozenset(element_names)
 
             index = 0
             for element_name in self.element_names:
@@ -43,17 +169,30 @@ class Packet(object):
             self.element_names = []
 
         self.crc = crc8.CRC8()
+        self._compile()
 
         self._log()
 
         return
 
+    def __setattr__(self, name, value):
+        if name in self._elements and self.__dict__.get(name) != value:
+            self.__dict__['version'] = self.version + 1
+        object.__setattr__(self, name, value)
+
+    def _values(self):
+        return [getattr(self, element_name) for element_name in self.element_names]
+
+    def _set_values(self, values):
+        self.__dict__.update(zip(self.element_names, values))
+        self.version += 1
+
     def _log(self):
         self.logger.debug('_log')
         self.logger.info('New packet')
         self.logger.info('  Name:   {}'.format(self.name))
         self.logger.info('  ID:     {}'.format(self.id))
-        self.logger.info('  Length: {}'.format(struct.calcsize(self.format)))
+        self.logger.info('  Length: {}'.format(self._struct.size))
         self.logger.info('  Format: {}'.format(self.format))
         self.logger.info('  Elements:')
         index = 0
@@ -61,6 +200,14 @@ class Packet(object):
             self.logger.info('    {} = {}'.format(element_name, getattr(self, element_name)))
             index += 1
 
+    def _compile(self):
+        """
+        Compile the packet format, must be called whenever the format changes
+        """
+        self.logger.debug('_compile()')
+        self._struct = struct.Struct(self.format)
+        self.size = self._struct.size + PACKET_OVERHEAD
+
     def add_element(self, element_format, element_name, element_value):
         self.logger.debug('add_element({}, {}, {})'.format(repr(element_format), repr(element_name), repr(element_value)))
         if hasattr(self, element_name):
@@ -69,47 +216,177 @@ class Packet(object):
             self.logger.info('Adding {} = {}'.format(repr(element_name), element_value))
             self.format = self.format + element_format
             self.element_names.append(element_name)
+            self._elements = self._elements | frozenset([element_name])
             setattr(self, element_name, element_value)
+            self._compile()
 
-    def pack(self):
-        self.logger.debug('pack()')
-        header = struct.pack('2BHB', PACKET_START_BYTES[0], PACKET_START_BYTES[1], struct.calcsize(self.format) + 6, self.id)
-        return header + self._to_bytes() + struct.pack('B', self.crc.calculate(self._to_bytes()))
+class CompactPacket(PacketCodec):
+    """
+    Base of the packet classes made by packet_class()
+    The format, ID, name, struct, logger and CRC are class attributes shared
+    by every instance and the element values are kept in __slots__, so an
+    instance has no __dict__ and reading an element is a slot lookup.
+    Setting an element converts the value to the type of the element (see
+    element_value()) and increments version when it changes.
+    """
+    __slots__ = ('version', 'trace_interval', '_trace_count')
+    format = ''
+    id = PACKET_MAX_ID
+    name = ''
+    element_names = ()
+    size = PACKET_OVERHEAD
+    logger = logging.getLogger(__name__)
+    crc = crc8.CRC8()
+    _struct = struct.Struct('')
+    _element_types = {}
+    _defaults = ()
 
-    def unpack(self, data):
-        self.logger.debug('unpack({})'.format(repr(data)))
-        header = struct.unpack('2BHB', data[:5])
-        self.logger.info('Unpacking {}'.format(repr(self.name)))
-        self.logger.info('  Header:     {}'.format(repr(data[:5])))
-        self.logger.info('  Start code: 0x{:02x}{:02x}'.format(header[0], header[1]))
-        self.logger.info('  Size:       {}'.format(repr(header[2])))
-        self.logger.info('  ID:         {}'.format(repr(header[3])))
-        if header[0] != PACKET_START_BYTES[0] or header[1] != PACKET_START_BYTES[1]:
-            self.logger.error('Bad start bytes 0xa195 != {}'.format(repr(header[0])))
-            raise ValueError
-        if header[3] != self.id:
-            self.logger.error('Bad packet ID {} != {}'.format(repr(self.id), repr(header[1])))
-            raise ValueError
-        if ord(data[-1]) != self.crc.calculate(data[5:-1]):
-            self.logger.error('Bad CRC 0x{:02x} != 0x{:02x}'.format(self.crc.calculate(data[5:-1]),ord(data[-1])))
-            raise ValueError
-        self._from_bytes(data[5:-1])
+    def __init__(self, *element_values, **elements):
+        object.__setattr__(self, 'version', 0)
+        object.__setattr__(self, 'trace_interval', PACKET_TRACE_INTERVAL)
+        object.__setattr__(self, '_trace_count', 0)
+        for element_name, default in zip(self.element_names, self._defaults):
+            object.__setattr__(self, element_name, default)
+        for element_name, element_value in zip(self.element_names, element_values):
+            setattr(self, element_name, element_value)
+        for element_name, element_value in elements.items():
+            setattr(self, element_name, element_value)
 
-    def _to_bytes(self):
-        self.logger.debug('_to_bytes()')
-        data_list = []
-        for element_name in self.element_names:
-            data_list.append(getattr(self, element_name))
+    def __setattr__(self, name, value):
+        element_type = self._element_types.get(name)
+        if element_type is not None:
+            value = element_value(element_type, value)
+            if getattr(self, name) != value:
+                object.__setattr__(self, 'version', self.version + 1)
+        object.__setattr__(self, name, value)
 
-        return struct.pack(self.format, *data_list)
+    def _values(self):
+        return self._get_values(self)
 
-    def _from_bytes(self, bytes):
-        self.logger.debug('_from_bytes({})'.format(repr(bytes)))
-        data_list = struct.unpack(self.format, bytes)
-        index = 0
-        for element_name in self.element_names:
-            setattr(self, element_name, data_list[index])
-            index += 1
+    def _set_values(self, values):
+        for element_name, value in zip(self.element_names, values):
+            object.__setattr__(self, element_name, value)
+        object.__setattr__(self, 'version', self.version + 1)
+
+def packet_class(format, id, name='', element_names=None, class_name=None):
+    """
+    Make a CompactPacket subclass for one packet type, instances are created
+    with the element values as arguments or keywords
+    """
+    element_names = tuple(element_names or [])
+    formats = element_formats(format)
+    if len(formats) != len(element_names):
+        CompactPacket.logger.error('Format {} has {} elements not {}'.format(repr(format), len(formats), len(element_names)))
+        raise ValueError
+    packet_struct = struct.Struct(format)
+    if len(element_names) == 1:
+        get_element = operator.attrgetter(element_names[0])
+        get_values = lambda packet: (get_element(packet),)
+    elif element_names:
+        get_values = operator.attrgetter(*element_names)
+    else:
+        get_values = lambda packet: ()
+    attributes = {'__slots__': element_names,
+                  'format': format,
+                  'id': id,
+                  'name': name,
+                  'element_names': element_names,
+                  'size': packet_struct.size + PACKET_OVERHEAD,
+                  '_struct': packet_struct,
+                  '_element_types': dict((element_name, PACKET_ELEMENT_TYPES[element_format[-1]])
+                                         for element_name, element_format in zip(element_names, formats)),
+                  '_defaults': tuple(b'\x00' if element_format == 'c' else PACKET_ELEMENT_TYPES[element_format[-1]]()
+                                     for element_format in formats),
+                  '_get_values': staticmethod(get_values)}
+    return type(class_name or 'Packet{:02X}'.format(id), (CompactPacket,), attributes)
+
+def compact_class(pkt):
+    """
+    Make a CompactPacket subclass with the format, ID, name and elements of
+    a Packet
+    """
+    return packet_class(pkt.format, pkt.id, pkt.name, pkt.element_names)
+
+def subscribe_packet(packet_ids=None, interval=0.0, keepalive=-1.0):
+    """
+    Packet a client sends to choose which status packets it receives
+      interval = seconds between updates
+      keepalive = seconds before an unchanged packet is sent again, 0 sends
+                  every interval and negative only sends changes
+      packet_ids = bitmap of the packet IDs wanted
+    """
+    return Packet(format='ff32s',
+                  id=PACKET_SUBSCRIBE_ID,
+                  name='Subscribe',
+                  element_names=['interval', 'keepalive', 'packet_ids'],
+                  element_values=[interval, keepalive, id_bitmap(packet_ids or [])])
+
+def negotiate_packet(capabilities=0):
+    """
+    Packet a client sends with the aggregate capabilities it supports, the
+    server answers with the capabilities it will use (see aggregate.py)
+    """
+    return Packet(format='B',
+                  id=PACKET_NEGOTIATE_ID,
+                  name='Negotiate',
+                  element_names=['capabilities'],
+                  element_values=[capabilities])
+
+def datagram_packet(sequence=0, timestamp=0.0, session=0):
+    """
+    Packet at the start of every UDP datagram (see udp_transport.py)
+      sequence = number of the datagram, counting from 1 in each session
+      timestamp = time the datagram was sent
+      session = random number chosen by the publisher when it starts
+    """
+    return Packet(format='QdI',
+                  id=PACKET_DATAGRAM_ID,
+                  name='Datagram',
+                  element_names=['sequence', 'timestamp', 'session'],
+                  element_values=[sequence, timestamp, session])
+
+def id_bitmap(packet_ids):
+    bitmap = bytearray(32)
+    for packet_id in packet_ids:
+        bitmap[packet_id >> 3] |= 1 << (packet_id & 0x07)
+    return bytes(bitmap)
+
+def bitmap_ids(bitmap):
+    return [packet_id for packet_id in range(0, PACKET_MAX_ID)
+            if bytearray(bitmap)[packet_id >> 3] & (1 << (packet_id & 0x07))]
+
+def element_value(element_type, value):
+    """
+    Returns value converted to element_type (one of PACKET_ELEMENT_TYPES)
+    Raises ValueError rather than lose part of the value, such as 3.7 for
+    an integer, or convert one of another kind, such as a number for bytes.
+    """
+    if element_type is bytes:
+        if isinstance(value, (bytes, bytearray)):
+            return bytes(value)
+    else:
+        try:
+            converted = element_type(value)
+        except (TypeError, ValueError, OverflowError):
+            converted = None
+        # NaN is the only value not equal to itself
+        if converted is not None and (converted == value or (converted != converted and value != value)):
+            return converted
+    CompactPacket.logger.error('{} can not be stored as {}'.format(repr(value), element_type.__name__))
+    raise ValueError
+
+def element_formats(format):
+    """
+    Split a packet format into the format of each element, so 'I3fc12s'
+    gives ['I', 'f', 'f', 'f', 'c', '12s']
+    """
+    formats = []
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', format):
+        if code in 'sp':
+            formats.append(count + code)
+        elif code != 'x':
+            formats.extend([code] * int(count or 1))
+    return formats
 
 if __name__ == '__main__':
     import argparse
@@ -156,7 +433,22 @@ if __name__ == '__main__':
 
     print('{}'.format(repr(binary_data)))
 
+    receive_packet.set_trace(1)
     receive_packet.unpack(binary_data)
 
     receive_packet._log()
 
+
+    # Pack and unpack in place without intermediate copies
+    buffer = bytearray(my_packet.size * 2)
+    my_packet.pack_into(buffer, my_packet.size)
+    receive_packet.unpack_from(memoryview(buffer), my_packet.size)
+
+    receive_packet._log()
+
+    # Same packet as a compact class shared by many instances
+    CompactReceivePacket = compact_class(receive_packet)
+    compact_packet = CompactReceivePacket()
+    compact_packet.unpack(binary_data)
+    print('{} STRING = {}'.format(CompactReceivePacket.__name__, repr(compact_packet.STRING)))
+    assert compact_packet.pack() == binary_data
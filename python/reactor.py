@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import threading
+import time
+
+REACTOR_READ = 0x001 # Same values as select.POLLIN/EPOLLIN
+REACTOR_WRITE = 0x004 # Same values as select.POLLOUT/EPOLLOUT
+REACTOR_ERROR = 0x008 | 0x010 # POLLERR | POLLHUP
+REACTOR_MAX_TIMEOUT = 1.0
+
+def _fileno(fileobj):
+    if isinstance(fileobj, int):
+        return fileobj
+    return fileobj.fileno()
+
+class _SelectPoller(object):
+    """
+    select.select() with the register/modify/unregister/poll interface of
+    select.poll(), used where neither epoll nor poll are available
+    """
+    def __init__(self):
+        self.events = {}
+
+    def register(self, fd, events):
+        self.events[fd] = events
+
+    def modify(self, fd, events):
+        self.events[fd] = events
+
+    def unregister(self, fd):
+        del self.events[fd]
+
+    def poll(self, timeout):
+        readers = [fd for fd, events in self.events.items() if events & REACTOR_READ]
+        writers = [fd for fd, events in self.events.items() if events & REACTOR_WRITE]
+        ready_to_read, ready_to_write, in_error = select.select(readers, writers, [], timeout)
+        ready = collections.defaultdict(int)
+        for fd in ready_to_read:
+            ready[fd] |= REACTOR_READ
+        for fd in ready_to_write:
+            ready[fd] |= REACTOR_WRITE
+        return list(ready.items())
+
+class Reactor(object):
+    """
+    Single threaded event loop
+    File descriptors are watched with epoll, poll or select (the best one
+    available) and callbacks are run when they are ready.  Timers are kept in
+    a heap so the loop sleeps until the next file descriptor event or timer
+    rather than polling.  stop() and call_soon_threadsafe() may be called
+    from other threads.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+            self._timeout_scale = 1.0
+        elif hasattr(select, 'poll'):
+            self._poller = select.poll()
+            self._timeout_scale = 1000.0
+        else:
+            self._poller = _SelectPoller()
+            self._timeout_scale = 1.0
+        self.logger.debug('poller = {}'.format(repr(self._poller)))
+
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self._pending = collections.deque()
+        self._pending_lock = threading.Lock()
+        self.running = False
+
+        # Pipe used to wake the loop from other threads
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.add_reader(self._wakeup_read, self._drain_wakeup)
+
+        return
+
+    def _update(self, fd):
+        events = 0
+        if fd in self._readers:
+            events |= REACTOR_READ
+        if fd in self._writers:
+            events |= REACTOR_WRITE
+        return events
+
+    def _register(self, fd, registered):
+        events = self._update(fd)
+        if events == 0:
+            self._poller.unregister(fd)
+        elif registered:
+            self._poller.modify(fd, events)
+        else:
+            self._poller.register(fd, events)
+
+    def add_reader(self, fileobj, callback, *args):
+        fd = _fileno(fileobj)
+        registered = fd in self._readers or fd in self._writers
+        self._readers[fd] = (callback, args)
+        self._register(fd, registered)
+
+    def remove_reader(self, fileobj):
+        fd = _fileno(fileobj)
+        if self._readers.pop(fd, None) is not None:
+            self._register(fd, True)
+
+    def add_writer(self, fileobj, callback, *args):
+        fd = _fileno(fileobj)
+        registered = fd in self._readers or fd in self._writers
+        self._writers[fd] = (callback, args)
+        self._register(fd, registered)
+
+    def remove_writer(self, fileobj):
+        fd = _fileno(fileobj)
+        if self._writers.pop(fd, None) is not None:
+            self._register(fd, True)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Run callback after delay seconds
+        Returns a handle that can be passed to cancel()
+        """
+        timer = [time.time() + delay, next(self._timer_sequence), callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self._pending_lock:
+            self._pending.append((callback, args))
+        self.wakeup()
+
+    def wakeup(self):
+        if self._wakeup_write is None:
+            # Closed
+            return
+        try:
+            os.write(self._wakeup_write, b'\x00')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain_wakeup(self):
+        try:
+            os.read(self._wakeup_read, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run_once(self, timeout=REACTOR_MAX_TIMEOUT):
+        """
+        Wait for events or the next timer and run the callbacks
+        """
+        if self._timers:
+            timeout = min(timeout, max(0, self._timers[0][0] - time.time()))
+        if self._pending:
+            timeout = 0
+        try:
+            events = self._poller.poll(timeout * self._timeout_scale)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            if event & (REACTOR_READ | REACTOR_ERROR) and fd in self._readers:
+                callback, args = self._readers[fd]
+                callback(*args)
+            if event & (REACTOR_WRITE | REACTOR_ERROR) and fd in self._writers:
+                callback, args = self._writers[fd]
+                callback(*args)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, sequence, callback, args = heapq.heappop(self._timers)
+            if callback is not None:
+                callback(*args)
+
+        while self._pending:
+            with self._pending_lock:
+                callback, args = self._pending.popleft()
+            callback(*args)
+
+    def run(self):
+        self.logger.debug('run()')
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.logger.debug('stop()')
+        self.running = False
+        self.wakeup()
+
+    def close(self):
+        """
+        Close the wakeup pipe and the poller once the loop has stopped, the
+        reactor can not be used after
+        """
+        self.logger.debug('close()')
+        if self._wakeup_read is None:
+            return
+        # The wakeup reader is a bound method, removing it also lets the
+        # reactor be collected
+        self.remove_reader(self._wakeup_read)
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+        self._wakeup_read = self._wakeup_write = None
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
+
+    def __del__(self):
+        if self._wakeup_read is not None:
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import json
+import keyword
+import logging
+import os
+import re
+import struct
+import sys
+import packet
+
+# Schema type: (struct code, C type, Python type, Python default)
+SCHEMA_TYPES = {'int8': ('b', 'int8_t', 'int', '0'),
+                'uint8': ('B', 'uint8_t', 'int', '0'),
+                'int16': ('h', 'int16_t', 'int', '0'),
+                'uint16': ('H', 'uint16_t', 'int', '0'),
+                'int32': ('i', 'int32_t', 'int', '0'),
+                'uint32': ('I', 'uint32_t', 'int', '0'),
+                'int64': ('q', 'int64_t', 'int', '0'),
+                'uint64': ('Q', 'uint64_t', 'int', '0'),
+                'float': ('f', 'float', 'float', '0.0'),
+                'double': ('d', 'double', 'float', '0.0'),
+                'bool': ('?', 'uint8_t', 'bool', 'False'),
+                'char': ('c', 'char', 'bytes', "b'\\x00'"),
+                'string': ('s', 'char', 'bytes', "b''")}
+SCHEMA_BYTE_ORDER = '<' # Little endian with no padding, as the STM32 lays out packed structs
+SCHEMA_PREFIX = 'alma'
+# C keywords, and names from the standard headers, that can not name a struct member
+SCHEMA_C_KEYWORDS = frozenset(['auto', 'bool', 'break', 'case', 'char', 'const', 'continue', 'default', 'do',
+                               'double', 'else', 'enum', 'extern', 'false', 'float', 'for', 'goto', 'if',
+                               'inline', 'int', 'long', 'register', 'restrict', 'return', 'short', 'signed',
+                               'sizeof', 'static', 'struct', 'switch', 'true', 'typedef', 'union', 'unsigned',
+                               'void', 'volatile', 'while', 'NULL'])
+# Element names that would hide attributes of the packet classes, they are
+# also the arguments of the generated __init__ so self is reserved too
+SCHEMA_RESERVED_NAMES = (frozenset(dir(packet.CompactPacket)) | frozenset(packet.CompactPacket.__slots__) |
+                         frozenset(keyword.kwlist) | frozenset(['self']) | SCHEMA_C_KEYWORDS)
+
+class Element(object):
+    """
+    One element of a packet, arrays (count > 1) are a C array and an
+    element per value named name_0, name_1, ... in Python
+    """
+    def __init__(self, definition):
+        self.name = str(definition.get('name', ''))
+        self.type = definition.get('type')
+        self.count = int(definition.get('count', 1))
+        self.length = int(definition.get('length', 0))
+        if not re.match(r'^[A-Za-z][A-Za-z0-9_]*$', self.name):
+            raise ValueError('Bad element name {}'.format(repr(self.name)))
+        if self.type not in SCHEMA_TYPES:
+            raise ValueError('Element {} has unknown type {}'.format(self.name, repr(self.type)))
+        self.code, self.c_type, self.python_type, self.default = SCHEMA_TYPES[self.type]
+        if self.type == 'string':
+            if self.length < 1 or self.count != 1:
+                raise ValueError('String {} needs a length and can not be an array'.format(self.name))
+            self.format = '{}s'.format(self.length)
+            self.python_names = [self.name]
+            self.c_declaration = '{} {}[{}]'.format(self.c_type, self.name, self.length)
+        else:
+            if self.length or self.count < 1:
+                raise ValueError('Element {} has a bad count or length'.format(self.name))
+            self.format = self.code * self.count
+            if self.count == 1:
+                self.python_names = [self.name]
+                self.c_declaration = '{} {}'.format(self.c_type, self.name)
+            else:
+                self.python_names = ['{}_{}'.format(self.name, index) for index in range(self.count)]
+                self.c_declaration = '{} {}[{}]'.format(self.c_type, self.name, self.count)
+        for python_name in self.python_names:
+            if python_name in SCHEMA_RESERVED_NAMES:
+                raise ValueError('Element name {} is reserved'.format(python_name))
+
+class PacketSchema(object):
+    """
+    One packet of the catalog, the layout is the struct format
+    SCHEMA_BYTE_ORDER + the element formats in order
+    """
+    def __init__(self, definition):
+        self.name = str(definition.get('name', ''))
+        try:
+            # IDs may be written as strings such as "0x01"
+            self.id = int(str(definition['id']), 0)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Packet {} has a bad ID'.format(repr(self.name)))
+        if not 0 <= self.id < packet.PACKET_MAX_ID:
+            raise ValueError('Packet {} ID 0x{:02x} out of range'.format(repr(self.name), self.id))
+        words = re.findall(r'[A-Za-z0-9]+', self.name)
+        if not words or words[0][0].isdigit():
+            raise ValueError('Packet name {} does not start with a letter'.format(repr(self.name)))
+        self.symbol = '_'.join(word.lower() for word in words)
+        self.class_name = ''.join(word[0].upper() + word[1:] for word in words)
+        self.elements = [Element(element) for element in definition.get('elements', [])]
+        if not self.elements:
+            raise ValueError('Packet {} has no elements'.format(repr(self.name)))
+        self.element_names = [name for element in self.elements for name in element.python_names]
+        if len(set(self.element_names)) != len(self.element_names):
+            raise ValueError('Packet {} has repeated element names'.format(repr(self.name)))
+        self.format = SCHEMA_BYTE_ORDER + ''.join(element.format for element in self.elements)
+        self.data_size = struct.calcsize(self.format)
+        self.size = self.data_size + packet.PACKET_OVERHEAD
+
+class Schema(object):
+    """
+    Packet catalog read from a JSON schema
+      {"packets": [{"id": 1, "name": "Server Value",
+                    "elements": [{"name": "value", "type": "float"},
+                                 {"name": "axes", "type": "int16", "count": 3},
+                                 {"name": "label", "type": "string", "length": 12}]}]}
+    IDs may be numbers or strings such as "0x01", the types are the keys of
+    SCHEMA_TYPES.  python() writes a module with a packet.CompactPacket
+    subclass per packet whose pack(), unpack_from() and value access are
+    straight-line code for its elements, c_header() and c_source() write
+    packed C structs and pack/unpack functions with the same layout, which
+    the C compiler checks against the sizes of the Python struct formats.
+    """
+    def __init__(self, definition, source='schema'):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.source = source
+        self.packets = []
+        ids = set()
+        symbols = set()
+        for packet_definition in definition.get('packets', []):
+            try:
+                pkt = PacketSchema(packet_definition)
+            except ValueError as e:
+                self.logger.error('{}: {}'.format(source, e))
+                raise ValueError
+            if pkt.id in ids or pkt.symbol in symbols:
+                self.logger.error('{}: Packet {} repeats an ID or name'.format(source, repr(pkt.name)))
+                raise ValueError
+            ids.add(pkt.id)
+            symbols.add(pkt.symbol)
+            self.packets.append(pkt)
+        self.logger.info('{} packets in {}'.format(len(self.packets), source))
+
+        return
+
+    def python(self, output_file=sys.stdout):
+        self.logger.debug('python({})'.format(repr(output_file)))
+        out = lambda line='': print(line, file=output_file)
+        out('#!/usr/bin/env python')
+        out('# -*- coding: utf-8 -*-')
+        out('# Generated by schema.py from {}, do not edit'.format(self.source))
+        out('from __future__ import(print_function)')
+        out()
+        out('import struct')
+        out('import crc8')
+        out('import packet')
+        out()
+        out('_HEADER = packet.PACKET_HEADER')
+        out('_CRC = packet.PACKET_CRC')
+        out('_crc = crc8.CRC8()')
+        out('_calculate = _crc.calculate')
+        out('_calculate_from = _crc.calculate_from')
+        out('# Slots are set through their descriptors, which skips __setattr__')
+        out('_set_version = packet.CompactPacket.version.__set__')
+        out('_set_trace_interval = packet.CompactPacket.trace_interval.__set__')
+        out('_set_trace_count = packet.CompactPacket._trace_count.__set__')
+        out('# Element names are only used as arguments and attributes, locals and')
+        out('# globals start with _ so an element can not hide them')
+        out('_TRACE_INTERVAL = packet.PACKET_TRACE_INTERVAL')
+        for python_type in sorted(set(SCHEMA_TYPES[name][2] for name in SCHEMA_TYPES)):
+            out('_{0} = {0}'.format(python_type))
+        out('_element_value = packet.element_value')
+        for pkt in self.packets:
+            self._python_class(pkt, out)
+        out()
+        out('PACKET_CLASSES = {{{}}}'.format(', '.join('0x{:02x}: {}'.format(pkt.id, pkt.class_name) for pkt in self.packets)))
+
+    def _python_class(self, pkt, out):
+        prefix = '_' + pkt.symbol.upper()
+        setters = ['_set_{}_{}'.format(pkt.symbol, name) for name in pkt.element_names]
+        types = []
+        defaults = []
+        for element in pkt.elements:
+            types.extend([element.python_type] * len(element.python_names))
+            defaults.extend([element.default] * len(element.python_names))
+        # Locals holding the element values
+        names = ', '.join('_{}'.format(index) for index in range(len(pkt.element_names)))
+        values = ''.join('self.{}, '.format(name) for name in pkt.element_names).rstrip(' ')
+        data_offset = packet.PACKET_HEADER.size
+        crc_offset = pkt.size - packet.PACKET_CRC.size
+
+        out()
+        out('class {}(packet.CompactPacket):'.format(pkt.class_name))
+        out('    """')
+        out('    {}, ID 0x{:02x}'.format(pkt.name, pkt.id))
+        out('    """')
+        out('    __slots__ = ({})'.format(''.join('{}, '.format(repr(name)) for name in pkt.element_names).rstrip(' ')))
+        out('    format = {}'.format(repr(pkt.format)))
+        out('    id = 0x{:02x}'.format(pkt.id))
+        out('    name = {}'.format(repr(pkt.name)))
+        out('    element_names = __slots__')
+        out('    size = {}'.format(pkt.size))
+        out('    _struct = struct.Struct(format)')
+        out('    _element_types = {{{}}}'.format(', '.join('{}: {}'.format(repr(name), python_type) for name, python_type in zip(pkt.element_names, types))))
+        out('    _defaults = ({})'.format(''.join('{}, '.format(default) for default in defaults).rstrip(' ')))
+        out()
+        out('    def __init__(self, {}):'.format(', '.join('{}={}'.format(name, default) for name, default in zip(pkt.element_names, defaults))))
+        out('        _set_version(self, 0)')
+        out('        _set_trace_interval(self, _TRACE_INTERVAL)')
+        out('        _set_trace_count(self, 0)')
+        for name, setter, python_type in zip(pkt.element_names, setters, types):
+            out('        {}(self, _element_value(_{}, {}))'.format(setter, python_type, name))
+        out()
+        out('    def _values(self):')
+        out('        return ({})'.format(values))
+        out()
+        out('    def _set_values(self, values):')
+        out('        ({},) = values'.format(names))
+        for index, setter in enumerate(setters):
+            out('        {}(self, _{})'.format(setter, index))
+        out('        _set_version(self, self.version + 1)')
+        out()
+        out('    def pack(self):')
+        out('        data = {}_STRUCT.pack({})'.format(prefix, ', '.join('self.{}'.format(name) for name in pkt.element_names)))
+        out('        return {}_HEADER + data + _CRC.pack(_calculate(data))'.format(prefix))
+        out()
+        out('    def unpack_from(self, buffer, offset=0, check_crc=True):')
+        out('        header = _HEADER.unpack_from(buffer, offset)')
+        out('        if header != {}_HEADER_VALUES:'.format(prefix))
+        out('            self.logger.error(\'Bad header {{}} != {{}}\'.format(repr(header), repr({}_HEADER_VALUES)))'.format(prefix))
+        out('            raise ValueError')
+        out('        if check_crc:')
+        out('            crc = _calculate_from(buffer, offset + {}, {})'.format(data_offset, crc_offset - data_offset))
+        out('            if _CRC.unpack_from(buffer, offset + {})[0] != crc:'.format(crc_offset))
+        out('                self.logger.error(\'Bad CRC 0x{{:02x}} != 0x{{:02x}}\'.format(crc, _CRC.unpack_from(buffer, offset + {})[0]))'.format(crc_offset))
+        out('                raise ValueError')
+        out('        ({},) = {}_STRUCT.unpack_from(buffer, offset + {})'.format(names, prefix, data_offset))
+        for index, setter in enumerate(setters):
+            out('        {}(self, _{})'.format(setter, index))
+        out('        _set_version(self, self.version + 1)')
+        out('        if self.trace_interval:')
+        out('            self._trace(header)')
+        out('        return {}'.format(pkt.size))
+        out()
+        out('{}_STRUCT = {}._struct'.format(prefix, pkt.class_name))
+        out('{}_HEADER_VALUES = (packet.PACKET_START_BYTES[0], packet.PACKET_START_BYTES[1], {}, 0x{:02x})'.format(prefix, pkt.size, pkt.id))
+        out('{0}_HEADER = _HEADER.pack(*{0}_HEADER_VALUES)'.format(prefix))
+        for name, setter in zip(pkt.element_names, setters):
+            out('{} = {}.{}.__set__'.format(setter, pkt.class_name, name))
+
+    def c_header(self, output_file=sys.stdout, header_name='alma_packets.h'):
+        self.logger.debug('c_header({}, {})'.format(repr(output_file), repr(header_name)))
+        out = lambda line='': print(line, file=output_file)
+        guard = re.sub(r'[^A-Za-z0-9]', '_', header_name).upper()
+        out('/* Generated by schema.py from {}, do not edit */'.format(self.source))
+        out('#ifndef {}'.format(guard))
+        out('#define {}'.format(guard))
+        out()
+        out('#include <stdint.h>')
+        out()
+        out('#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ != __ORDER_LITTLE_ENDIAN__')
+        out('#error "The packet structs are copied as they are and must be little endian"')
+        out('#endif')
+        out()
+        out('#define ALMA_PACKET_START_0        0x{:02x}'.format(packet.PACKET_START_BYTES[0]))
+        out('#define ALMA_PACKET_START_1        0x{:02x}'.format(packet.PACKET_START_BYTES[1]))
+        out('#define ALMA_PACKET_HEADER_SIZE    {}'.format(packet.PACKET_HEADER.size))
+        out('#define ALMA_PACKET_OVERHEAD       {}'.format(packet.PACKET_OVERHEAD))
+        for pkt in self.packets:
+            upper = '{}_{}'.format(SCHEMA_PREFIX, pkt.symbol).upper()
+            out()
+            out('/* {} */'.format(pkt.name))
+            out('#define {}_ID 0x{:02x}'.format(upper, pkt.id))
+            out('#define {}_SIZE {} /* Whole frame */'.format(upper, pkt.size))
+            out()
+            out('typedef struct __attribute__((packed)) {}_{} {{'.format(SCHEMA_PREFIX, pkt.symbol))
+            for element in pkt.elements:
+                out('    {};'.format(element.c_declaration))
+            out('}} {}_{};'.format(SCHEMA_PREFIX, pkt.symbol))
+            out()
+            out('uint16_t {0}_{1}_pack(const {0}_{1} *values, uint8_t *frame);'.format(SCHEMA_PREFIX, pkt.symbol))
+            out('int {0}_{1}_unpack({0}_{1} *values, const uint8_t *frame, uint16_t length);'.format(SCHEMA_PREFIX, pkt.symbol))
+        out()
+        out('#endif')
+
+    def c_source(self, output_file=sys.stdout, header_name='alma_packets.h'):
+        self.logger.debug('c_source({}, {})'.format(repr(output_file), repr(header_name)))
+        out = lambda line='': print(line, file=output_file)
+        out('/* Generated by schema.py from {}, do not edit */'.format(self.source))
+        out('#include <string.h>')
+        out('#include "{}"'.format(header_name))
+        out('#include "crc8.h"')
+        out()
+        out('/* The structs must have the sizes of the Python struct formats */')
+        for pkt in self.packets:
+            out('typedef char {0}_{1}_size_check[(sizeof({0}_{1}) == {2}) ? 1 : -1];'.format(SCHEMA_PREFIX, pkt.symbol, pkt.data_size))
+        out()
+        out('static inline uint16_t pack_frame(uint8_t id, const void *values, uint16_t size, uint8_t *frame)')
+        out('{')
+        out('    uint16_t length = size + ALMA_PACKET_OVERHEAD;')
+        out()
+        out('    frame[0] = ALMA_PACKET_START_0;')
+        out('    frame[1] = ALMA_PACKET_START_1;')
+        out('    frame[2] = length & 0xff;')
+        out('    frame[3] = length >> 8;')
+        out('    frame[4] = id;')
+        out('    memcpy(frame + ALMA_PACKET_HEADER_SIZE, values, size);')
+        out('    frame[length - 1] = crc8_calculate(frame + ALMA_PACKET_HEADER_SIZE, size);')
+        out('    return length;')
+        out('}')
+        out()
+        out('static inline int unpack_frame(uint8_t id, void *values, uint16_t size, const uint8_t *frame, uint16_t length)')
+        out('{')
+        out('    if (length != size + ALMA_PACKET_OVERHEAD ||')
+        out('        frame[0] != ALMA_PACKET_START_0 || frame[1] != ALMA_PACKET_START_1 ||')
+        out('        (frame[2] | (frame[3] << 8)) != length || frame[4] != id) {')
+        out('        return -1;')
+        out('    }')
+        out('    if (frame[length - 1] != crc8_calculate(frame + ALMA_PACKET_HEADER_SIZE, size)) {')
+        out('        return -1;')
+        out('    }')
+        out('    memcpy(values, frame + ALMA_PACKET_HEADER_SIZE, size);')
+        out('    return 0;')
+        out('}')
+        for pkt in self.packets:
+            name = '{}_{}'.format(SCHEMA_PREFIX, pkt.symbol)
+            out()
+            out('uint16_t {0}_pack(const {0} *values, uint8_t *frame)'.format(name))
+            out('{')
+            out('    return pack_frame({}_ID, values, sizeof({}), frame);'.format(name.upper(), name))
+            out('}')
+            out()
+            out('int {0}_unpack({0} *values, const uint8_t *frame, uint16_t length)'.format(name))
+            out('{')
+            out('    return unpack_frame({}_ID, values, sizeof({}), frame, length);'.format(name.upper(), name))
+            out('}')
+
+    def classes(self):
+        """
+        Compile the Python codecs without writing them to a file
+        Returns a dictionary of packet ID to class
+        """
+        self.logger.debug('classes()')
+        lines = []
+        self.python(_LineWriter(lines))
+        namespace = {}
+        exec(compile(''.join(lines), '<{}>'.format(self.source), 'exec'), namespace)
+        return namespace['PACKET_CLASSES']
+
+class _LineWriter(object):
+    # File like object collecting what print() writes
+    def __init__(self, lines):
+        self.write = lines.append
+
+def load(path):
+    """
+    Read a schema file
+    Returns the Schema
+    """
+    with open(path) as schema_file:
+        definition = json.load(schema_file)
+    return Schema(definition, os.path.basename(path))
+
+if __name__ == '__main__':
+    import argparse
+    import timeit
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Generate the Python and C packet codecs from a packet schema')
+
+    parser.add_argument('schema',
+                        help='Packet schema file')
+    parser.add_argument('-p', '--python',
+                        help='Python module to write',
+                        default=None)
+    parser.add_argument('-c', '--c_output',
+                        help='C header and source to write, without the .h/.c extension',
+                        default=None)
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets to time each codec with',
+                        type=int,
+                        default=100000)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    my_schema = load(args.schema)
+    if args.python is not None:
+        with open(args.python, 'w') as python_file:
+            my_schema.python(python_file)
+    if args.c_output is not None:
+        header_name = os.path.basename(args.c_output) + '.h'
+        with open(args.c_output + '.h', 'w') as header_file:
+            my_schema.c_header(header_file, header_name)
+        with open(args.c_output + '.c', 'w') as source_file:
+            my_schema.c_source(source_file, header_name)
+
+    # Check the generated codecs against packet_class() and time them
+    for packet_id, generated_class in sorted(my_schema.classes().items()):
+        compact = packet.packet_class(generated_class.format, packet_id, generated_class.name, generated_class.element_names)
+        generated_packet = generated_class()
+        compact_packet = compact()
+        frame = generated_packet.pack()
+        assert frame == compact_packet.pack()
+        generated_packet.unpack(frame)
+        compact_packet.unpack(frame)
+        assert generated_packet._values() == compact_packet._values()
+        times = []
+        for codec in (compact_packet, generated_packet):
+            times.append(timeit.timeit(lambda: codec.unpack_from(codec.pack(), 0, False), number=args.num_packets) / args.num_packets)
+        print('0x{:02x} {:20} {:3} bytes  packet_class {:.2f} us  generated {:.2f} us per pack and unpack'.format(
+            packet_id, generated_class.name, generated_class.size, times[0] * 1e6, times[1] * 1e6))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import collections
+import errno
+import logging
+import select
+import socket
+import threading
+import time
+
+SEND_BUFFER_HIGH_WATER = 0x40000 # Backpressure is reported above this many bytes queued
+SEND_BUFFER_LOW_WATER = 0x10000 # and cleared again below this many
+SEND_BUFFER_COALESCE = 0x10000 # Most bytes of small writes joined into one send
+
+class SendBuffer(object):
+    """
+    Outbound queue for a non-blocking socket
+    Data written is sent straight away if nothing is queued, whatever the
+    socket does not take is queued and sent by flush() once the socket is
+    writable.  Queued writes smaller than SEND_BUFFER_COALESCE are joined
+    into a single send and partly sent data is sliced with memoryview so it
+    is not copied again.  backpressure is set once more than high_water
+    bytes are queued and cleared once the queue falls below low_water.
+    write() and flush() may be called from different threads.
+    """
+    def __init__(self, skt, high_water=SEND_BUFFER_HIGH_WATER, low_water=SEND_BUFFER_LOW_WATER):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        if low_water > high_water:
+            self.logger.error('Low water mark {} above high water mark {}'.format(low_water, high_water))
+            raise ValueError
+        self.socket = skt
+        self.high_water = high_water
+        self.low_water = low_water
+        self.lock = threading.Lock()
+        self.chunks = collections.deque()
+        self.offset = 0 # Bytes of the first chunk already sent
+        self.pending = 0
+        self.backpressure = False
+        self.closed = False
+
+        self.sends = 0
+        self.bytes_sent = 0
+        self.max_pending = 0
+        self.high_water_count = 0
+
+        return
+
+    def __len__(self):
+        return self.pending
+
+    def write(self, data):
+        """
+        Queue data and send as much of the queue as the socket takes
+        Returns False if the socket has been closed
+        """
+        if not isinstance(data, bytes):
+            # The caller may reuse a mutable buffer once this returns
+            data = data.tobytes() if isinstance(data, memoryview) else bytes(data)
+        with self.lock:
+            if self.closed:
+                return False
+            if data:
+                self.chunks.append(data)
+                self.pending += len(data)
+            self._flush()
+            if self.pending > self.max_pending:
+                self.max_pending = self.pending
+            return not self.closed
+
+    def flush(self):
+        """
+        Send as much of the queue as the socket takes without blocking
+        Returns True once the queue is empty
+        """
+        with self.lock:
+            self._flush()
+            return self.pending == 0
+
+    def wait(self, timeout=None):
+        """
+        Block until the queue has been sent or timeout seconds have passed
+        Returns True if the queue is empty
+        """
+        end = None if timeout is None else time.time() + timeout
+        while not self.flush():
+            if self.closed:
+                return False
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            select.select([], [self.socket], [], remaining)
+        return True
+
+    def _flush(self):
+        while self.chunks:
+            first = self.chunks[0]
+            if self.offset == 0 and len(first) < SEND_BUFFER_COALESCE and len(self.chunks) > 1:
+                first = self._coalesce()
+            try:
+                sent = self.socket.send(memoryview(first)[self.offset:])
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if sent == 0:
+                self.logger.info('Sending socket has been closed')
+                self.closed = True
+                break
+            self.sends += 1
+            self.bytes_sent += sent
+            self.pending -= sent
+            self.offset += sent
+            if self.offset == len(first):
+                self.chunks.popleft()
+                self.offset = 0
+        if self.pending >= self.high_water:
+            if not self.backpressure:
+                self.high_water_count += 1
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('High water mark reached, {} bytes queued'.format(self.pending))
+            self.backpressure = True
+        elif self.pending <= self.low_water:
+            self.backpressure = False
+
+    def _coalesce(self):
+        # Replace the small chunks at the front of the queue by their join
+        size = 0
+        count = 0
+        for chunk in self.chunks:
+            if count and size + len(chunk) > SEND_BUFFER_COALESCE:
+                break
+            size += len(chunk)
+            count += 1
+        joined = b''.join([self.chunks.popleft() for index in range(count)])
+        self.chunks.appendleft(joined)
+        return joined
+
+    def stats(self):
+        with self.lock:
+            return {'pending': self.pending,
+                    'max_pending': self.max_pending,
+                    'sends': self.sends,
+                    'bytes_sent': self.bytes_sent,
+                    'high_water_count': self.high_water_count,
+                    'backpressure': self.backpressure}
+
+if __name__ == '__main__':
+    import argparse
+    import packet
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test the send buffer with a reader slower than the writer')
+
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets to send',
+                        type=int,
+                        default=100000)
+    parser.add_argument('-w', '--high_water',
+                        help='Bytes queued before backpressure, cleared again at a quarter of this',
+                        type=int,
+                        default=0x2000)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    my_packet = packet.Packet(format='If', id=0x01, name='Value', element_names=['count', 'value'], element_values=[0, 0.0])
+    tx_socket, rx_socket = socket.socketpair()
+    tx_socket.setblocking(0)
+    # Small socket buffers so the queue fills
+    tx_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 0x1000)
+    rx_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 0x1000)
+    my_buffer = SendBuffer(tx_socket, args.high_water, args.high_water // 4)
+
+    received = []
+
+    def reader():
+        while True:
+            data = rx_socket.recv(0x1000)
+            if not data:
+                return
+            received.append(len(data))
+            time.sleep(0.01)
+
+    reader_thread = threading.Thread(target=reader)
+    reader_thread.setDaemon(True)
+    reader_thread.start()
+
+    start = time.time()
+    skipped = 0
+    for count in range(args.num_packets):
+        if my_buffer.backpressure:
+            # A status update the reader is not keeping up with
+            skipped += 1
+            my_buffer.flush()
+            continue
+        my_packet.count = count
+        my_buffer.write(my_packet.pack())
+    my_buffer.wait()
+    write_time = time.time() - start
+    tx_socket.shutdown(socket.SHUT_WR)
+    reader_thread.join()
+
+    stats = my_buffer.stats()
+    print('Wrote {} packets in {:.3f} s, {} skipped under backpressure'.format(args.num_packets - skipped, write_time, skipped))
+    print('  {sends} sends of {bytes_sent} bytes, max queued {max_pending}, high water reached {high_water_count} times'.format(**stats))
+    assert sum(received) == (args.num_packets - skipped) * my_packet.size
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import socket
+import threading
+
+SERIAL_RING_SIZE = 0x10000
+SERIAL_READ_TIMEOUT = 0.1 # How often the reader thread checks for close()
+
+class RingBuffer(object):
+    """
+    Fixed size single producer, single consumer byte ring buffer
+    head and tail count every byte ever read and written, the producer only
+    moves tail and the consumer only moves head so no lock is needed between
+    them.  Data written when the buffer is full is dropped and counted, a
+    producer that must not lose data writes no more than free() bytes.
+    """
+    def __init__(self, size=SERIAL_RING_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.size = size
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def free(self):
+        return self.size - (self.tail - self.head)
+
+    def write(self, data):
+        free = self.size - (self.tail - self.head)
+        if len(data) > free:
+            self.dropped += len(data) - free
+            data = data[:free]
+        start = self.tail % self.size
+        first = min(len(data), self.size - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[0:len(data) - first] = data[first:]
+        self.tail += len(data)
+        return len(data)
+
+    def read(self, size):
+        size = min(size, self.tail - self.head)
+        start = self.head % self.size
+        first = min(size, self.size - start)
+        data = bytes(self.buffer[start:start + first]) + bytes(self.buffer[0:size - first])
+        self.head += size
+        return data
+
+    def read_into(self, view, size):
+        """
+        Copy up to size bytes into a writable memoryview
+        Returns the number of bytes copied
+        """
+        size = min(size, len(view), self.tail - self.head)
+        start = self.head % self.size
+        first = min(size, self.size - start)
+        view[:first] = self.view[start:start + first]
+        view[first:size] = self.view[0:size - first]
+        self.head += size
+        return size
+
+class SerialTransport(object):
+    """
+    Serial port with the interface of a non-blocking socket
+    A reader thread reads everything the port has waiting into a ring
+    buffer and makes fileno() readable, so the port can be used with select
+    like a socket.  Data sent is queued and a writer thread writes all of
+    the queued data in a single call.
+    While the ring buffer is full the reader thread stops reading, so the
+    data waits in the port's buffers (and flow control holds off the
+    sender) rather than being lost.  With lossy set it keeps reading and
+    the data that does not fit is dropped and counted in ring.dropped.
+    """
+    def __init__(self, serialport, ring_size=SERIAL_RING_SIZE, lossy=False):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.serialport = serialport
+        self.serialport.timeout = SERIAL_READ_TIMEOUT
+        self.ring = RingBuffer(ring_size)
+        self.lossy = lossy
+        self.running = True
+        # The reader thread waits here for the consumer to make room
+        self.space_condition = threading.Condition()
+        self.reader_waiting = False
+
+        self.write_queue = collections.deque()
+        self.write_pending = 0
+        self.write_condition = threading.Condition()
+        self.bytes_written = 0
+
+        # Pipe that is readable while the ring buffer has data
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.reader_thread = threading.Thread(target=self._reader)
+        self.reader_thread.setDaemon(True)
+        self.reader_thread.start()
+        self.writer_thread = threading.Thread(target=self._writer)
+        self.writer_thread.setDaemon(True)
+        self.writer_thread.start()
+
+        return
+
+    def fileno(self):
+        return self._wakeup_read
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, b'\x00')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _reader(self):
+        self.logger.debug('_reader()')
+        while self.running:
+            size = max(1, self.serialport.in_waiting)
+            if not self.lossy:
+                if self.ring.free() == 0:
+                    with self.space_condition:
+                        self.reader_waiting = True
+                        while self.running and self.ring.free() == 0:
+                            self.space_condition.wait(SERIAL_READ_TIMEOUT)
+                        self.reader_waiting = False
+                    continue
+                size = min(size, self.ring.free())
+            try:
+                # Block for the first byte then take everything waiting
+                data = self.serialport.read(size)
+            except Exception as e:
+                self.logger.error('Serial port read failed {}'.format(repr(e)))
+                self.running = False
+                break
+            if data:
+                self.ring.write(data)
+                self._wakeup()
+        # Wake the consumer so it sees the port has closed
+        self._wakeup()
+
+    def _writer(self):
+        self.logger.debug('_writer()')
+        while True:
+            with self.write_condition:
+                while self.running and not self.write_queue:
+                    self.write_condition.wait()
+                if not self.write_queue:
+                    return
+                data = b''.join(self.write_queue)
+                self.write_queue.clear()
+                self.write_pending = 0
+            try:
+                self.serialport.write(data)
+            except Exception as e:
+                self.logger.error('Serial port write failed {}'.format(repr(e)))
+                self.running = False
+                self._wakeup()
+                return
+            self.bytes_written += len(data)
+
+    def recv(self, size):
+        """
+        Returns up to size bytes, b'' once the port has closed and raises
+        EAGAIN if no data is waiting like a non-blocking socket
+        """
+        if not self._ready():
+            return b''
+        data = self.ring.read(size)
+        self._consumed()
+        return data
+
+    def recv_into(self, view, size=0):
+        """
+        recv() straight into a writable memoryview, returns the number of
+        bytes received
+        """
+        if not self._ready():
+            return 0
+        count = self.ring.read_into(view, size or len(view))
+        self._consumed()
+        return count
+
+    def _consumed(self):
+        if len(self.ring) > 0:
+            # Stay readable until the ring buffer is empty
+            self._wakeup()
+        if self.reader_waiting:
+            with self.space_condition:
+                self.space_condition.notify()
+
+    def _ready(self):
+        # Returns False once the port has closed, raises EAGAIN if no data
+        try:
+            os.read(self._wakeup_read, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        if len(self.ring) == 0:
+            if not self.running:
+                return False
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        return True
+
+    def send(self, data):
+        """
+        Queue data for the writer thread, returns the number of bytes queued
+        """
+        if not self.running:
+            return 0
+        with self.write_condition:
+            self.write_queue.append(data.tobytes() if isinstance(data, memoryview) else bytes(data))
+            self.write_pending += len(data)
+            self.write_condition.notify()
+        return len(data)
+
+    def close(self):
+        self.logger.debug('close()')
+        self.running = False
+        with self.write_condition:
+            self.write_condition.notify()
+        with self.space_condition:
+            self.space_condition.notify()
+        self.writer_thread.join()
+        self.reader_thread.join()
+        self.serialport.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    import serial
+    import decoder
+    import packet
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test the serial transport, the port must loop back what is sent')
+
+    parser.add_argument('-p', '--port',
+                        help='Serial port or pyserial URL',
+                        default='loop://')
+    parser.add_argument('-b', '--baudrate',
+                        help='Serial port baud rate',
+                        type=int,
+                        default=115200)
+    parser.add_argument('-n', '--num_packets',
+                        help='Number of packets to send',
+                        type=int,
+                        default=10000)
+    parser.add_argument('-r', '--ring_size',
+                        help='Size of the ring buffer, small sizes test a full buffer',
+                        type=int,
+                        default=SERIAL_RING_SIZE)
+    parser.add_argument('-l', '--lossy',
+                        help='Drop data that does not fit the ring buffer',
+                        action='store_true')
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    my_packet = packet.Packet(format='I', id=0x01, name='Counter', element_names=['count'], element_values=[0])
+    transport = SerialTransport(serial.serial_for_url(args.port, args.baudrate), args.ring_size, args.lossy)
+    frame_decoder = decoder.FrameDecoder()
+
+    start = time.time()
+    for count in range(args.num_packets):
+        my_packet.count = count
+        transport.send(my_packet.pack())
+    received = 0
+    while received < args.num_packets and time.time() - start < 10.0:
+        try:
+            frame_decoder.recv(transport, decoder.DECODER_CHUNK_SIZE)
+        except socket.error:
+            time.sleep(0.001)
+            continue
+        received += sum(1 for frame in frame_decoder.frames())
+    elapsed = time.time() - start
+    print('{} of {} packets in {:.3f} s, {} bytes dropped, {} resyncs'.format(
+          received, args.num_packets, elapsed, transport.ring.dropped, frame_decoder.resyncs))
+    transport.close()
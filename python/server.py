@@ -9,22 +9,89 @@ import logging
 import threading
 import select
 import time
+import timeit
+import errno
+import aggregate
 import client
+import decoder
+import dispatch
+import link_scheduler
+import metrics
 import packet
+import reactor
+import shared_table
 
 SERVER_NETWORK_TIMEOUT = 0.1
 SERVER_MAX_PACKET_RATE = 0.1 # Must be greater than 0.01
+SERVER_MIN_PACKET_RATE = 0.01
+SERVER_KEEPALIVE_INTERVAL = 1.0 # Unchanged status packets are sent again this often
+SERVER_LISTEN_BACKLOG = 128
+SERVER_SLOW_DOWNSAMPLE = 'downsample' # Backlogged clients miss updates until their send buffer drains
+SERVER_SLOW_DISCONNECT = 'disconnect' # and are closed once backlogged for the slow timeout
+SERVER_SLOW_TIMEOUT = 5.0
+
+class Subscription(object):
+    """
+    Status packets sent to one client
+    Every interval the packets that have changed since they were last sent
+    to the client are sent.  Unchanged packets are sent again once keepalive
+    seconds have passed, every interval if keepalive is 0 and never if it is
+    None.  packet_ids of None follows the server status list.
+    """
+    def __init__(self, packet_ids=None, interval=SERVER_MAX_PACKET_RATE, keepalive=SERVER_KEEPALIVE_INTERVAL, request_version=0):
+        self.packet_ids = packet_ids
+        self.interval = max(interval, SERVER_MIN_PACKET_RATE)
+        self.keepalive = keepalive
+        self.request_version = request_version
+        self.next_time = 0
+        self.sent_versions = {}
+        self.sent_times = {}
+        self.slow_since = None # When the client's send buffer passed its high water mark
+
+    def due(self, now, packet_list, status_ids):
+        """
+        Returns the packet IDs to send now, None if the client is not due
+        """
+        if now < self.next_time:
+            return None
+        self.next_time += self.interval
+        if self.next_time <= now:
+            # Fell behind, start counting again from now
+            self.next_time = now + self.interval
+        if self.packet_ids is None:
+            packet_ids = status_ids
+        else:
+            packet_ids = self.packet_ids
+        due_ids = []
+        for packet_id in packet_ids:
+            pkt = packet_list[packet_id]
+            if pkt is None:
+                continue
+            if pkt.version != self.sent_versions.get(packet_id):
+                due_ids.append(packet_id)
+            elif self.keepalive is not None and now - self.sent_times.get(packet_id, 0) >= self.keepalive:
+                due_ids.append(packet_id)
+        return due_ids
+
+    def sent(self, now, packet_ids, versions):
+        for packet_id, version in zip(packet_ids, versions):
+            self.sent_versions[packet_id] = version
+            self.sent_times[packet_id] = now
 
 class MyServer(object):
     """
     Server template
+    With reuseport other sockets, such as those of the other processes of a
+    shard.ShardedServer, may listen on the same port.
     """
-    def __init__(self, addr='', port=0):
+    def __init__(self, addr='', port=0, reuseport=False):
         self.logger = logging.getLogger(__name__)
         self.logger.debug('__init__')
 
         # Create INET Streaming socket
         self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuseport:
+            self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         self.serversocket.bind((addr, port))
         self.logger.info('Server bound to {}'.format(self.serversocket.getsockname()))
@@ -34,6 +101,22 @@ class MyServer(object):
         self.status_packet_list_ids = []
         self.packet_list_lock = threading.Lock()
         self.packet_list = [None] * packet.PACKET_MAX_ID
+        self.clients_lock = threading.Lock()
+        self.clients = {}
+        self.client_threads = []
+        self.subscriptions = {}
+        self.status_frames = {}
+        self.status_table = None
+        self.buffer_pool = decoder.BufferPool() # Receive buffers shared by the clients
+        self.dispatcher = dispatch.Dispatcher()
+        self.metrics = None
+        self.metrics_server = None
+        self.publishers = []
+        self.link_budget = None
+        self.link_priorities = {} # Packet ID -> (priority, max_rate) shared by every client's scheduler
+        self.slow_policy = SERVER_SLOW_DOWNSAMPLE
+        self.slow_timeout = SERVER_SLOW_TIMEOUT
+        self.running = False
         return
 
     def add_packet(self, pkt):
@@ -50,61 +133,608 @@ class MyServer(object):
             raise ValueError
         with self.status_packet_list_lock:
             if pkt_id not in self.status_packet_list_ids:
+                if self.status_table is not None:
+                    self._seed_status(self.status_table, pkt_id)
                 self.status_packet_list_ids.append(pkt_id)
                 self.logger.info('Packet ID 0x{:02x} added to status'.format(pkt_id))
             else:
                 self.logger.warning('Packet ID 0x{:02x} already in status'.format(pkt_id))
 
+    def add_handler(self, packet_id, callback, **options):
+        """
+        Run callback(packet_id, values) on a worker thread for every
+        packet_id received from any client (see dispatch.Dispatcher.register()
+        for the options)
+        Returns the dispatch.Handler
+        """
+        self.logger.debug('add_handler(0x{:02x}, {})'.format(packet_id, repr(callback)))
+        return self.dispatcher.register(packet_id, callback, **options)
+
+    def set_status_table(self, table):
+        """
+        Send the status packets published to table (a
+        shared_table.StatusTable) instead of packing the packets in
+        packet_list, so producers publish new values without taking
+        packet_list_lock and senders read them without a lock.  Status
+        packets not published yet are published here from their
+        packet_list values, so call this before other producers start
+        publishing to table.  None goes back to packet_list.
+        """
+        self.logger.debug('set_status_table({})'.format(repr(table)))
+        with self.status_packet_list_lock:
+            frames = {}
+            if table is not None:
+                for packet_id in self.status_packet_list_ids:
+                    self._seed_status(table, packet_id)
+                    frames[packet_id] = table.frame(packet_id)
+            # The status thread may be sending from the frames of the old
+            # table, so they are replaced whole rather than cleared
+            self.status_frames = frames
+            self.status_table = table
+
+    def _seed_status(self, table, packet_id):
+        # Publish the packet_list values of a status packet not published
+        # to table yet, the senders only ever read the table
+        if table.version(packet_id) == 0:
+            with self.packet_list_lock:
+                table.publish(self.packet_list[packet_id])
+
+    def set_slow_policy(self, policy, timeout=SERVER_SLOW_TIMEOUT):
+        """
+        Choose what happens to clients that do not read their status packets
+        as fast as they are sent.  Once a client's send buffer reaches its
+        high water mark it misses status updates, so it gets the latest
+        values when it catches up.  With SERVER_SLOW_DISCONNECT a client
+        still backlogged after timeout seconds is closed.
+        """
+        self.logger.debug('set_slow_policy({}, {})'.format(repr(policy), repr(timeout)))
+        if policy not in (SERVER_SLOW_DOWNSAMPLE, SERVER_SLOW_DISCONNECT):
+            self.logger.error('Unknown slow client policy {}'.format(repr(policy)))
+            raise ValueError
+        self.slow_policy = policy
+        self.slow_timeout = timeout
+
+    def set_link_budget(self, rate=None, baudrate=None, burst=link_scheduler.LINK_BURST, measure=False):
+        """
+        Send each client no more status packets than its link carries, rate
+        bytes a second or baudrate / link_scheduler.LINK_BITS_PER_BYTE, see
+        link_scheduler.LinkScheduler.  Status packets that do not fit are
+        sent in a later interval with their latest values, highest priority
+        first (see set_priority()).  With measure the rate is lowered to what
+        each client's socket actually sends.  A rate and baudrate of None
+        sends every packet due.
+        """
+        self.logger.debug('set_link_budget({}, {}, {}, {})'.format(repr(rate), repr(baudrate), repr(burst), repr(measure)))
+        if rate is None and baudrate is None:
+            self.link_budget = None
+        else:
+            self.link_budget = {'rate': rate, 'baudrate': baudrate, 'burst': burst, 'measure': measure}
+        with self.clients_lock:
+            clients = list(self.clients.values())
+        for clnt in clients:
+            self._set_client_scheduler(clnt)
+
+    def _set_client_scheduler(self, clnt):
+        if self.link_budget is None:
+            clnt.set_scheduler(None)
+        else:
+            clnt.set_scheduler(link_scheduler.LinkScheduler(priorities=self.link_priorities, **self.link_budget))
+
+    def set_priority(self, packet_id, priority, max_rate=None):
+        """
+        Set the link priority of a status packet (a
+        link_scheduler.LINK_PRIORITY_ value) and the most times a second it
+        is sent to each client (None for every interval it is due), used
+        once set_link_budget() has been called
+        """
+        self.logger.debug('set_priority(0x{:02x}, {}, {})'.format(packet_id, repr(priority), repr(max_rate)))
+        if self.packet_list[packet_id] is None:
+            self.logger.error('Packet ID 0x{:02x} does not exist'.format(packet_id))
+            raise ValueError
+        self.link_priorities[packet_id] = (priority, max_rate)
+
+    def enable_metrics(self, port=None, addr='127.0.0.1'):
+        """
+        Count the status packets sent and time sending them, every client
+        gets its own metrics as a child of the server metrics.  The metrics
+        are served over HTTP (see metrics.MetricsServer) if port is given.
+        Returns the server metrics
+        """
+        self.logger.debug('enable_metrics({}, {})'.format(repr(port), repr(addr)))
+        if self.metrics is None:
+            self.metrics = metrics.Metrics('server')
+            self.metrics.gauge('clients', lambda: len(self.clients))
+            self._send_status_time = self.metrics.histogram('send_status_seconds')
+            with self.clients_lock:
+                for fileno, clnt in self.clients.items():
+                    self._enable_client_metrics(fileno, clnt)
+        if port is not None and self.metrics_server is None:
+            self.metrics_server = metrics.MetricsServer(self.metrics, addr, port)
+        return self.metrics
+
+    def _enable_client_metrics(self, fileno, clnt):
+        try:
+            name = '{}:{}'.format(*clnt.clientsocket.getpeername()[:2])
+        except socket.error:
+            name = str(fileno)
+        self.metrics.add_child(fileno, clnt.enable_metrics(metrics.Metrics(name)))
+
+    def add_client(self, clnt):
+        self.logger.debug('add_client({})'.format(repr(clnt)))
+        if clnt.send_buffer is None:
+            # Status packets are only sent through a send buffer
+            self.logger.error('Client has no send buffer')
+            raise ValueError
+        clnt.set_dispatcher(self.dispatcher)
+        self._set_client_scheduler(clnt)
+        if self.metrics is not None:
+            self._enable_client_metrics(clnt.clientsocket.fileno(), clnt)
+        for pkt in self.packet_list:
+            if pkt is not None:
+                clnt.add_packet(pkt)
+        # Each client gets its own subscription request packet, only applied
+        # once a request from the client changes its version
+        request = packet.subscribe_packet()
+        clnt.add_packet(request)
+        # Likewise for the client's negotiation request packet
+        clnt.aggregator.request_version = clnt.packet_list[packet.PACKET_NEGOTIATE_ID].version
+        with self.clients_lock:
+            self.clients[clnt.clientsocket.fileno()] = clnt
+            self.subscriptions[clnt.clientsocket.fileno()] = Subscription(request_version=request.version)
+
+    def add_publisher(self, publisher, packet_ids=None, interval=SERVER_MAX_PACKET_RATE, keepalive=SERVER_KEEPALIVE_INTERVAL):
+        """
+        Send status packets to a udp_transport.DatagramPublisher as if it
+        were a client with the subscription given, one multicast send
+        reaches every subscriber
+        """
+        self.logger.debug('add_publisher({}, {}, {}, {})'.format(repr(publisher), repr(packet_ids), repr(interval), repr(keepalive)))
+        with self.clients_lock:
+            self.publishers.append((publisher, Subscription(packet_ids, interval, keepalive)))
+
+    def close_client(self, clnt):
+        """
+        Stop sending to a client, the client thread sees the socket close,
+        closes it and exits
+        """
+        self.logger.debug('close_client({})'.format(repr(clnt)))
+        with self.clients_lock:
+            try:
+                fileno = clnt.clientsocket.fileno()
+            except socket.error:
+                # Already closed by its client thread
+                return
+            if self.clients.pop(fileno, None) is None:
+                return
+            del self.subscriptions[fileno]
+        if self.metrics is not None:
+            self.metrics.remove_child(fileno)
+        try:
+            clnt.clientsocket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def subscribe(self, clnt, packet_ids=None, interval=SERVER_MAX_PACKET_RATE, keepalive=SERVER_KEEPALIVE_INTERVAL, request_version=0):
+        """
+        Set the status packets sent to a client and how often, see
+        Subscription
+        """
+        self.logger.debug('subscribe({}, {}, {}, {})'.format(repr(clnt), repr(packet_ids), repr(interval), repr(keepalive)))
+        for packet_id in packet_ids or []:
+            if self.packet_list[packet_id] is None:
+                self.logger.error('Packet ID 0x{:02x} does not exist'.format(packet_id))
+                raise ValueError
+        with self.clients_lock:
+            if clnt.clientsocket.fileno() in self.subscriptions:
+                self.subscriptions[clnt.clientsocket.fileno()] = Subscription(packet_ids, interval, keepalive, request_version)
+        self.logger.info('Client subscribed to {} every {}s'.format(repr(packet_ids), interval))
+
+    def check_subscription(self, clnt):
+        """
+        Apply a subscription request received from the client
+        """
+        request = clnt.packet_list[packet.PACKET_SUBSCRIBE_ID]
+        with self.clients_lock:
+            subscription = self.subscriptions.get(clnt.clientsocket.fileno())
+        if subscription is None or subscription.request_version == request.version:
+            return
+        if request.keepalive < 0:
+            keepalive = None
+        else:
+            keepalive = request.keepalive
+        try:
+            self.subscribe(clnt, packet.bitmap_ids(request.packet_ids), request.interval, keepalive, request.version)
+        except ValueError:
+            self.logger.warning('Bad subscription request ignored')
+            subscription.request_version = request.version
+
+    def check_negotiation(self, clnt):
+        """
+        Apply an aggregate negotiation request received from the client and
+        answer with the capabilities chosen
+        """
+        request = clnt.packet_list[packet.PACKET_NEGOTIATE_ID]
+        if clnt.aggregator.request_version == request.version:
+            return
+        clnt.aggregator.request_version = request.version
+        # The status thread packs frames with the aggregator under its lock
+        with clnt.aggregator.lock:
+            capabilities = clnt.aggregator.negotiate(request.capabilities)
+            self.send_data(clnt, packet.negotiate_packet(capabilities).pack())
+
+    def check_requests(self, clnt):
+        self.check_subscription(clnt)
+        self.check_negotiation(clnt)
+
+    def status_frame(self, packet_id):
+        """
+        Returns (version, frame) for a status packet, each version of a
+        packet is only packed once however many clients it is sent to
+        """
+        if self.status_table is not None:
+            frame = self.status_frames.get(packet_id)
+            if frame is not None:
+                return frame
+            # The table has just been set to None
+        pkt = self.packet_list[packet_id]
+        frame = self.status_frames.get(packet_id)
+        if frame is None or frame[0] != pkt.version:
+            with self.packet_list_lock:
+                frame = (pkt.version, pkt.pack())
+            self.status_frames[packet_id] = frame
+        return frame
+
+    def encode_status(self, packet_ids):
+        """
+        Returns the packet versions and the frames in a single buffer
+        """
+        frames = [self.status_frame(packet_id) for packet_id in packet_ids]
+        return [frame[0] for frame in frames], b''.join([frame[1] for frame in frames])
+
+    def encode_aggregate(self, aggregator, packet_ids, commit=True):
+        """
+        Returns the packet versions and the packets in aggregate frames, see
+        aggregate.Aggregator.pack() for commit
+        """
+        frames = [self.status_frame(packet_id) for packet_id in packet_ids]
+        records = [(packet_id, frame[1][packet.PACKET_HEADER.size:-packet.PACKET_CRC.size])
+                   for packet_id, frame in zip(packet_ids, frames)]
+        return [frame[0] for frame in frames], aggregator.pack(records, commit)
+
+    def send_data(self, clnt, data):
+        """
+        Send data to a client, returns True if it was sent or queued in the
+        client's send buffer
+        This never blocks, whatever the non-blocking socket does not take is
+        queued whole in the send buffer, so a client that stops reading
+        neither holds up the others nor gets part of a frame.  Clients that
+        have gone away are closed.
+        """
+        try:
+            if clnt.send_data(data):
+                return True
+            self.logger.info('Interface closed')
+        except socket.error as e:
+            self.logger.info('Send failed {}'.format(repr(e)))
+        self.close_client(clnt)
+        return False
+
+    def check_slow(self, clnt, subscription, now):
+        """
+        Returns True if the client is too far behind to be sent status
+        packets now, see set_slow_policy()
+        """
+        if not clnt.send_buffer.backpressure:
+            if subscription.slow_since is not None:
+                self.logger.info('Client caught up after {:.3f}s'.format(now - subscription.slow_since))
+                subscription.slow_since = None
+            return False
+        if subscription.slow_since is None:
+            self.logger.warning('Client not keeping up, {} bytes queued, status updates skipped'.format(len(clnt.send_buffer)))
+            subscription.slow_since = now
+        elif self.slow_policy == SERVER_SLOW_DISCONNECT and now - subscription.slow_since >= self.slow_timeout:
+            self.logger.warning('Client backlogged for {:.3f}s, disconnecting'.format(now - subscription.slow_since))
+            if self.metrics is not None:
+                self.metrics.counters['slow_disconnects'] += 1
+            self.close_client(clnt)
+        return True
+
+    def sync_status(self, status_ids):
+        """
+        Take the latest frames from the status table, the table version
+        stands in for the packet version so subscriptions see which packets
+        have changed
+        The table is only read, set_status_table() and add_status() have
+        published every status packet to it.
+        """
+        status_table = self.status_table
+        status_frames = self.status_frames
+        if status_table is None:
+            return
+        for packet_id in status_ids:
+            version, frame = status_table.frame(packet_id)
+            cached = status_frames.get(packet_id)
+            if cached is None or cached[0] != version:
+                status_frames[packet_id] = (version, frame)
+            self.packet_list[packet_id].version = version
+
+    def send_status(self, now):
+        """
+        Send every client the status packets it is due, clients due the same
+        packets are sent the same buffer
+        Returns the time the next client is due
+        """
+        with self.status_packet_list_lock:
+            status_ids = list(self.status_packet_list_ids)
+        if self.status_table is not None:
+            self.sync_status(status_ids)
+        with self.clients_lock:
+            clients = [(clnt, self.subscriptions[fileno]) for fileno, clnt in self.clients.items()]
+            publishers = list(self.publishers)
+        server_metrics = self.metrics
+        if server_metrics is not None:
+            start = timeit.default_timer()
+        buffers = {}
+        next_time = now + SERVER_MAX_PACKET_RATE
+        for clnt, subscription in clients:
+            scheduled = subscription.next_time
+            packet_ids = subscription.due(now, self.packet_list, status_ids)
+            next_time = min(next_time, subscription.next_time)
+            if packet_ids is not None and scheduled and clnt.metrics is not None:
+                clnt.metrics.histogram('lag_seconds').observe(now - scheduled)
+            if not packet_ids:
+                continue
+            if self.check_slow(clnt, subscription, now):
+                if server_metrics is not None:
+                    server_metrics.counters['status_skipped'] += 1
+                continue
+            scheduler = clnt.scheduler
+            if scheduler is not None:
+                # Packets left out are still due next interval
+                bytes_sent, backlog = clnt.link_sent()
+                scheduler.update(bytes_sent, backlog, now)
+                selected = scheduler.select(packet_ids, [self.packet_list[packet_id].size for packet_id in packet_ids], now)
+                if server_metrics is not None:
+                    server_metrics.counters['status_decimated'] += len(packet_ids) - len(selected)
+                packet_ids = selected
+                if not packet_ids:
+                    continue
+            # Negotiation changes the aggregator under its lock
+            with clnt.aggregator.lock:
+                flags = clnt.aggregator.flags
+                delta_aggregator = None
+                if flags & aggregate.AGGREGATE_ENABLE and len(packet_ids) > 1:
+                    if flags & aggregate.AGGREGATE_DELTA:
+                        # Delta encoding depends on what this client was sent
+                        delta_aggregator = clnt.aggregator
+                        versions, data = self.encode_aggregate(delta_aggregator, packet_ids, False)
+                    else:
+                        key = (tuple(packet_ids), flags)
+                        if key not in buffers:
+                            buffers[key] = self.encode_aggregate(clnt.aggregator, packet_ids)
+                        versions, data = buffers[key]
+                else:
+                    key = tuple(packet_ids)
+                    if key not in buffers:
+                        buffers[key] = self.encode_status(packet_ids)
+                    versions, data = buffers[key]
+                sent = self.send_data(clnt, data)
+                if sent and delta_aggregator is not None:
+                    delta_aggregator.commit()
+            if sent:
+                subscription.sent(now, packet_ids, versions)
+                if server_metrics is not None:
+                    for packet_id in packet_ids:
+                        server_metrics.tx_frames[packet_id] += 1
+                    server_metrics.counters['status_bytes'] += len(data)
+            elif server_metrics is not None:
+                server_metrics.counters['status_dropped'] += 1
+        for publisher, subscription in publishers:
+            packet_ids = subscription.due(now, self.packet_list, status_ids)
+            next_time = min(next_time, subscription.next_time)
+            if not packet_ids:
+                continue
+            key = tuple(packet_ids)
+            if key not in buffers:
+                buffers[key] = self.encode_status(packet_ids)
+            versions, data = buffers[key]
+            # Datagrams that were dropped are not sent again
+            publisher.send(data)
+            subscription.sent(now, packet_ids, versions)
+            if server_metrics is not None:
+                for packet_id in packet_ids:
+                    server_metrics.tx_frames[packet_id] += 1
+                server_metrics.counters['datagram_bytes'] += len(data)
+        if server_metrics is not None:
+            self._send_status_time.observe(timeit.default_timer() - start)
+        return next_time
+
+    def status_thread(self):
+        self.logger.debug('status_thread()')
+        while self.running:
+            next_time = self.send_status(time.time())
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
     def client_thread(self,skt):
         self.logger.debug('client_thread({})'.format(repr(skt)))
         (client_addr, client_port) = skt.getpeername()
         self.logger.info('Starting client thread for {}:{}'.format(client_addr, client_port))
-        # Create a client
-        clnt = client.MyClient(skt=skt)
-        for pkt in self.packet_list:
-            if pkt is not None:
-                clnt.add_packet(pkt)
-        # Setup the interface
-        interface_closed = False
-        next_packet_time = round(time.time() + SERVER_MAX_PACKET_RATE, 2)
+        # Create a client, status packets are sent to it by the status thread
+        clnt = client.MyClient(skt=skt, pool=self.buffer_pool)
         clnt.set_timeout(SERVER_NETWORK_TIMEOUT)
-        # Make local copy of default global variables
+        self.add_client(clnt)
         # Loop until the socket is closed by the client
-        while not interface_closed:
-            # Send telemetry packets based on subscription interval
-            if time.time() > next_packet_time:
-                next_packet_time = round(time.time() + SERVER_MAX_PACKET_RATE, 2)
-                self.logger.debug('Next packet time: {}'.format(next_packet_time))
-                with self.status_packet_list_lock:
-                    for status_packet_id in self.status_packet_list_ids:
-                        if not clnt.send_packet(self.packet_list[status_packet_id]):
-                            # If no data could be sent the interface is closed
-                            interface_closed = True
-
-            # Wait for commands to be received
-            rcvd_pkt = clnt.process_input()
-            if rcvd_pkt is not None:
-                if rcvd_pkt == False:
-                    self.logger.info('Interface closed')
-                    interface_closed = True
-                else:
-                    # Packet received
-                    self.logger.info('Packet received {}'.format(repr(rcvd_pkt)))
+        interface_closed = False
+        try:
+            while not interface_closed:
+                # Wait for commands to be received
+                rcvd_pkt = clnt.process_input()
+                if rcvd_pkt is not None:
+                    if rcvd_pkt == False:
+                        self.logger.info('Interface closed')
+                        interface_closed = True
+                    else:
+                        # Packet received
+                        if self.logger.isEnabledFor(logging.DEBUG):
+                            self.logger.debug('Packet received {}'.format(repr(rcvd_pkt)))
+                        self.check_requests(clnt)
+        except Exception as e:
+            self.logger.error('Client thread failed {}'.format(repr(e)))
+        self.close_client(clnt)
+        # The socket is only closed by this thread, which may be reading it
+        clnt.close()
         self.logger.info('client_tread exitting')
 
     def start(self):
         self.logger.debug('Server started')
+        self.running = True
         self.serversocket.listen(5)
-        while True:
-            (clientsocket, address) = self.serversocket.accept()
+        # Accept wakes up to see if the server has been stopped
+        self.serversocket.settimeout(SERVER_NETWORK_TIMEOUT)
+        status = threading.Thread(target=self.status_thread)
+        status.setDaemon(True)
+        status.start()
+        while self.running:
+            try:
+                (clientsocket, address) = self.serversocket.accept()
+            except socket.timeout:
+                continue
             self.logger.info('Client connected from {}'.format(address))
             d = threading.Thread(target=self.client_thread, args=(clientsocket,))
             d.setDaemon(True)
             d.start()
+            self.client_threads = [thread for thread in self.client_threads if thread.is_alive()] + [d]
+        status.join()
+        self.shutdown()
+
+    def stop(self):
+        """
+        Stop the server, start() closes every client and the listening
+        socket and returns within SERVER_NETWORK_TIMEOUT
+        """
+        self.logger.debug('stop()')
+        self.running = False
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def shutdown(self):
+        """
+        Close every client and the listening socket once the server has
+        stopped, waiting for the client threads to close their sockets
+        """
+        self.logger.debug('shutdown()')
+        with self.clients_lock:
+            clients = list(self.clients.values())
+        for clnt in clients:
+            self.close_client(clnt)
+        for thread in self.client_threads:
+            thread.join()
+        self.client_threads = []
+        self.serversocket.close()
 
     def __del__(self):
         self.serversocket.close()
 
+class MyEventServer(MyServer):
+    """
+    Server running every client connection on a single event loop
+    Received data is decoded when the socket is readable and status packets
+    are sent from a timer set for the next client due, so no threads are
+    created per client and nothing polls while idle.
+    """
+    def __init__(self, addr='', port=0, reuseport=False):
+        MyServer.__init__(self, addr, port, reuseport)
+
+        self.reactor = reactor.Reactor()
+        self.writing = set() # Clients the reactor is flushing the send buffer of
+        return
+
+    def start(self):
+        self.logger.debug('Event server started')
+        self.serversocket.listen(SERVER_LISTEN_BACKLOG)
+        self.serversocket.setblocking(0)
+        self.reactor.add_reader(self.serversocket, self.accept_clients)
+        self.reactor.call_later(0, self.status_timer)
+        self.reactor.run()
+        self.reactor.remove_reader(self.serversocket)
+        self.shutdown()
+        self.reactor.close()
+
+    def stop(self):
+        self.logger.debug('stop()')
+        self.reactor.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def accept_clients(self):
+        while True:
+            try:
+                (clientsocket, address) = self.serversocket.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            self.logger.info('Client connected from {}'.format(address))
+            clnt = client.MyClient(skt=clientsocket, pool=self.buffer_pool)
+            self.add_client(clnt)
+            self.reactor.add_reader(clientsocket, self.read_client, clnt)
+
+    def read_client(self, clnt):
+        rcvd_pkt = clnt.receive()
+        if rcvd_pkt is False:
+            self.logger.info('Interface closed')
+            self.close_client(clnt)
+        elif rcvd_pkt is not None:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Packet received {}'.format(repr(rcvd_pkt)))
+            self.check_requests(clnt)
+
+    def send_data(self, clnt, data):
+        """
+        Send data to a client and have the reactor flush whatever the socket
+        did not take once it is writable
+        """
+        if not MyServer.send_data(self, clnt, data):
+            return False
+        if len(clnt.send_buffer) and clnt not in self.writing:
+            self.writing.add(clnt)
+            self.reactor.add_writer(clnt.clientsocket, self.write_client, clnt)
+        return True
+
+    def write_client(self, clnt):
+        try:
+            if not clnt.send_buffer.flush():
+                return
+        except socket.error as e:
+            self.logger.info('Send failed {}'.format(repr(e)))
+            self.close_client(clnt)
+            return
+        self.writing.discard(clnt)
+        self.reactor.remove_writer(clnt.clientsocket)
+
+    def close_client(self, clnt):
+        self.logger.debug('close_client({})'.format(repr(clnt)))
+        with self.clients_lock:
+            if self.clients.pop(clnt.clientsocket.fileno(), None) is None:
+                return
+            del self.subscriptions[clnt.clientsocket.fileno()]
+        if self.metrics is not None:
+            self.metrics.remove_child(clnt.clientsocket.fileno())
+        self.reactor.remove_reader(clnt.clientsocket)
+        if clnt in self.writing:
+            self.writing.discard(clnt)
+            self.reactor.remove_writer(clnt.clientsocket)
+        clnt.clientsocket.close()
+
+    def status_timer(self):
+        now = time.time()
+        next_time = self.send_status(now)
+        self.reactor.call_later(max(0, next_time - now), self.status_timer)
+
 if __name__ == '__main__':
     import argparse
     import random
@@ -116,6 +746,7 @@ if __name__ == '__main__':
 
     parser.add_argument('-p', '--port',
                         help='port for server to listen on',
+                        type=int,
                         default=0)
     parser.add_argument('-i', '--interface',
                         help='Network interface to listen on',
@@ -123,6 +754,13 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--address',
                         help='Network address to listen on',
                         default='')
+    parser.add_argument('-e', '--event',
+                        help='Run every client on a single event loop',
+                        action='store_true')
+    parser.add_argument('-m', '--metrics',
+                        help='Port to serve metrics on',
+                        type=int,
+                        default=None)
     parser.add_argument('-l', '--logfile',
                         help='File to log messages to',
                         default=None)
@@ -154,32 +792,72 @@ if __name__ == '__main__':
     my_packet = packet.Packet(format='f',
                              id=0x01,
                              name='Server Value',
-                             element_names=['value'])
+                             element_names=['value'],
+                             element_values=[0.0])
 
     my_packet_2 = packet.Packet(format='f',
                                 id=0x02,
                                 name='Server Value 2',
-                                element_names=['value_2'])
+                                element_names=['value_2'],
+                                element_values=[0.0])
 
-    my_server = MyServer(addr, args.port)
+    my_command = packet.Packet(format='f',
+                               id=0x03,
+                               name='Server Command',
+                               element_names=['command'],
+                               element_values=[0.0])
+
+    if args.event:
+        my_server = MyEventServer(addr, args.port)
+    else:
+        my_server = MyServer(addr, args.port)
     print('Server bound to {}'.format(my_server.serversocket.getsockname()))
+    if args.metrics is not None:
+        my_server.enable_metrics(args.metrics)
+        print('Metrics on {}'.format(my_server.metrics_server.address))
     my_server.add_packet(my_packet)
     my_server.add_packet(my_packet_2)
+    my_server.add_packet(my_command)
     my_server.add_status(1)
     #my_server.add_status(1)
     #my_server.add_status(2)
 
+    # New values are published to the status table, so the server sends
+    # them without either side taking packet_list_lock
+    my_status_table = shared_table.StatusTable(my_server.packet_list)
+    my_server.set_status_table(my_status_table)
+
     server_thread = threading.Thread(target=my_server.start)
     server_thread.setDaemon(True)
     server_thread.start()
 
+    # A client that sends a command rather than a subscription request
+    # keeps getting the default status packets and is not sent a
+    # negotiation reply
+    time.sleep(0.2)
+    host, port = my_server.serversocket.getsockname()
+    check_client = client.MyClient('127.0.0.1' if host == '0.0.0.0' else host, port)
+    check_client.add_packet(packet.Packet(format='f', id=0x01, name='Server Value', element_names=['value'], element_values=[0.0]))
+    negotiate_version = check_client.packet_list[packet.PACKET_NEGOTIATE_ID].version
+    check_client.send_packet(packet.Packet(format='f', id=0x03, name='Server Command', element_names=['command'], element_values=[1.0]))
+    time.sleep(0.2)
+    my_packet.value = 42.0
+    my_status_table.publish(my_packet)
+    end = time.time() + 1.0
+    while check_client.packet_list[0x01].value != 42.0 and time.time() < end:
+        check_client.process_input(0.1)
+    assert check_client.packet_list[0x01].value == 42.0
+    assert check_client.packet_list[packet.PACKET_NEGOTIATE_ID].version == negotiate_version
+    check_client.close()
+
     while True:
         # Wait for a random amount of time, and update data with a new random value to be sent by
         # the server
         delay_time = random.uniform(0, 3)
         root_logger.info('Delaying {}'.format(delay_time))
         time.sleep(delay_time)
-        with my_server.packet_list_lock:
-            my_server.packet_list[1].value = random.uniform(0,100)
-            my_server.packet_list[2].value_2 = random.uniform(0,100)
-            print('Server new value = {}'.format(my_server.packet_list[1].value))
+        my_packet.value = random.uniform(0,100)
+        my_packet_2.value_2 = random.uniform(0,100)
+        my_status_table.publish(my_packet)
+        my_status_table.publish(my_packet_2)
+        print('Server new value = {}'.format(my_packet.value))
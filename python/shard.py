@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import logging
+import multiprocessing
+import socket
+import struct
+import time
+import dispatch
+import packet
+import reactor
+import server
+import shared_table
+
+# Workers are forked, they take over the server's sockets and tables and
+# run a bound method that could not be pickled for spawn
+SHARD_CONTEXT = multiprocessing.get_context('fork') if hasattr(multiprocessing, 'get_context') else multiprocessing
+SHARD_WORKERS = multiprocessing.cpu_count()
+SHARD_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+SHARD_RECEIVED_TIME = struct.Struct('d')
+
+class ReceivedWriter(object):
+    """
+    Takes the place of a capture file for the clients of a worker process,
+    the last frame received for each packet ID is written to the worker's
+    shared table with the time it was received
+    Frames are written as they arrive, the CRC is checked when the parent
+    unpacks them.
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def write(self, frame, packet_id=None, timestamp=None):
+        if packet_id is None:
+            packet_id = packet.PACKET_HEADER.unpack_from(frame)[3]
+        slot = self.table.slots[packet_id]
+        if slot is None or len(frame) + SHARD_RECEIVED_TIME.size != slot[1]:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(frame, memoryview):
+            frame = frame.tobytes()
+        self.table.write(packet_id, SHARD_RECEIVED_TIME.pack(timestamp) + bytes(frame))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class ShardedServer(server.MyEventServer):
+    """
+    Event server spreading client connections over worker processes
+    start() forks workers processes that each run the event loop of a copy
+    of the server, so they share the packets, status list, handlers and
+    settings given before start().  With SO_REUSEPORT every worker listens
+    on its own socket and the kernel shares connections between them,
+    otherwise the workers accept from the listening socket they inherit.
+    A shared socket does not balance, the worker the kernel wakes first
+    accepts every connection waiting, so a burst of clients often all go
+    to the same worker.
+    Status values go to the workers through a shared_table.StatusTable
+    written by publish() (or by producers in other processes when a table
+    backed by a file is set with set_status_table()), the last frame each
+    worker received for every packet ID comes back through a shared table
+    per worker read by received(), so nothing is pickled.
+    """
+    def __init__(self, addr='', port=0, workers=SHARD_WORKERS, reuseport=SHARD_REUSEPORT):
+        server.MyEventServer.__init__(self, addr, port, reuseport)
+
+        self.workers = workers
+        self.reuseport = reuseport
+        self.worker_index = None # Set in the worker processes
+        self.processes = []
+        self.handler_specs = []
+        self.received_tables = []
+        self.received_writer = None
+        return
+
+    def add_handler(self, packet_id, callback, **options):
+        """
+        Run callback(packet_id, values) for every packet_id received in the
+        worker process that received it, must be called before start()
+        """
+        self.logger.debug('add_handler(0x{:02x}, {})'.format(packet_id, repr(callback)))
+        self.handler_specs.append((packet_id, callback, options))
+
+    def start(self):
+        self.logger.debug('Sharded server started')
+        sizes = [0 if pkt is None else pkt.size for pkt in self.packet_list]
+        if self.status_table is None:
+            self.set_status_table(shared_table.StatusTable(self.packet_list))
+        self.received_tables = [shared_table.SharedTable([size and SHARD_RECEIVED_TIME.size + size for size in sizes])
+                                for index in range(self.workers)]
+        if not self.reuseport:
+            self.serversocket.listen(server.SERVER_LISTEN_BACKLOG)
+        for index in range(self.workers):
+            process = SHARD_CONTEXT.Process(target=self._worker, args=(index,))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        self.logger.info('Started {} workers, {}'.format(self.workers, 'SO_REUSEPORT' if self.reuseport else 'shared socket'))
+        for process in self.processes:
+            process.join()
+
+    def _worker(self, index):
+        self.worker_index = index
+        self.processes = []
+        # The parent's event loop and handler threads are not usable after fork
+        self.reactor = reactor.Reactor()
+        self.dispatcher = dispatch.Dispatcher()
+        for packet_id, callback, options in self.handler_specs:
+            self.dispatcher.register(packet_id, callback, **options)
+        self.received_writer = ReceivedWriter(self.received_tables[index])
+        if self.reuseport:
+            address = self.serversocket.getsockname()
+            self.serversocket.close()
+            self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.serversocket.bind(address)
+        self.logger.info('Worker {} started'.format(index))
+        server.MyEventServer.start(self)
+
+    def add_client(self, clnt):
+        server.MyEventServer.add_client(self, clnt)
+        if self.received_writer is not None:
+            clnt.set_capture(self.received_writer)
+
+    def publish(self, packet_id):
+        """
+        Send the current values of a status packet to the workers, call
+        after changing the packet in packet_list
+        """
+        with self.packet_list_lock:
+            self.status_table.publish(self.packet_list[packet_id])
+
+    def received(self, packet_id):
+        """
+        Returns (time received, frame) of the last packet_id received by any
+        worker or None if none has been received
+        """
+        last = None
+        for table in self.received_tables:
+            version, data = table.read(packet_id)
+            if version == 0:
+                continue
+            timestamp = SHARD_RECEIVED_TIME.unpack_from(data)[0]
+            if last is None or timestamp > last[0]:
+                last = (timestamp, data[SHARD_RECEIVED_TIME.size:])
+        return last
+
+    def received_counts(self, packet_id):
+        """
+        Returns the number of packet_id frames received by each worker
+        """
+        return [table.version(packet_id) for table in self.received_tables]
+
+    def unpack_received(self, packet_id):
+        """
+        Unpack the last packet_id received by any worker into packet_list
+        Returns the time it was received or None
+        """
+        last = self.received(packet_id)
+        if last is None:
+            return None
+        with self.packet_list_lock:
+            self.packet_list[packet_id].unpack(last[1])
+        return last[0]
+
+    def stop(self):
+        self.logger.debug('stop()')
+        if self.worker_index is not None:
+            server.MyEventServer.stop(self)
+            return
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+if __name__ == '__main__':
+    import argparse
+    import threading
+    import client
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test the sharded server')
+
+    parser.add_argument('-w', '--workers',
+                        help='Number of worker processes',
+                        type=int,
+                        default=SHARD_WORKERS)
+    parser.add_argument('-n', '--num_clients',
+                        help='Number of clients to connect',
+                        type=int,
+                        default=8)
+    parser.add_argument('-s', '--shared_socket',
+                        help='Accept from one shared socket instead of SO_REUSEPORT, connections are not balanced',
+                        action='store_true')
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    def status_packet():
+        return packet.Packet(format='If', id=0x01, name='Status', element_names=['count', 'value'], element_values=[0, 0.0])
+
+    def command_packet():
+        return packet.Packet(format='I', id=0x02, name='Command', element_names=['command'], element_values=[0])
+
+    my_server = ShardedServer('127.0.0.1', 0, args.workers, SHARD_REUSEPORT and not args.shared_socket)
+    my_server.add_packet(status_packet())
+    my_server.add_packet(command_packet())
+    my_server.add_status(0x01)
+    server_thread = threading.Thread(target=my_server.start)
+    server_thread.setDaemon(True)
+    server_thread.start()
+    time.sleep(0.5)
+
+    port = my_server.serversocket.getsockname()[1]
+    my_clients = []
+    for index in range(args.num_clients):
+        my_client = client.MyClient('127.0.0.1', port)
+        my_client.add_packet(status_packet())
+        my_client.subscribe([0x01], 0.01)
+        my_clients.append(my_client)
+
+    my_command = command_packet()
+    for count in range(1, 11):
+        my_server.packet_list[0x01].count = count
+        my_server.publish(0x01)
+        for index, my_client in enumerate(my_clients):
+            my_command.command = count * 1000 + index
+            my_client.send_packet(my_command)
+        end = time.time() + 0.1
+        while time.time() < end:
+            for my_client in my_clients:
+                my_client.process_input(0.001)
+
+    counts = [my_client.packet_list[0x01].count for my_client in my_clients]
+    my_server.unpack_received(0x02)
+    print('Clients last saw status counts {}'.format(counts))
+    print('Commands received by each worker {}'.format(my_server.received_counts(0x02)))
+    print('Last command {}'.format(my_server.packet_list[0x02].command))
+    my_server.stop()
+    assert counts == [10] * args.num_clients
+    assert sum(my_server.received_counts(0x02)) == 10 * args.num_clients
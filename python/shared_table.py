@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import logging
+import mmap
+import os
+import struct
+import time
+import packet
+
+SHARED_SEQUENCE = struct.Struct('Q')
+SHARED_ALIGN = 8
+SHARED_READ_BACKOFF = 0.0001 # Seconds between reads of a slot being written
+SHARED_READ_TIMEOUT = 1.0 # Seconds before a slot is taken to be stuck mid write
+
+class SharedTable(object):
+    """
+    Fixed size slots of bytes in shared memory with seqlock versioning
+    Each slot starts with a sequence number that the writer makes odd before
+    changing the slot and even again after.  Readers copy the slot and try
+    again if the sequence was odd or changed while they copied it, so
+    neither side takes a lock.  A slot must only have one writer at a time.
+    The memory is an anonymous shared mapping, so processes forked after the
+    table is created share it, or the file at path so any process that maps
+    it with the same sizes shares it.
+    """
+    def __init__(self, sizes, path=None):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.slots = [None] * len(sizes)
+        offset = 0
+        for index, size in enumerate(sizes):
+            if not size:
+                continue
+            self.slots[index] = (offset, size)
+            offset += -(-(SHARED_SEQUENCE.size + size) // SHARED_ALIGN) * SHARED_ALIGN
+        self.size = max(offset, SHARED_ALIGN)
+        self.path = path
+        if path is None:
+            self.memory = mmap.mmap(-1, self.size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < self.size:
+                    os.ftruncate(fd, self.size)
+                self.memory = mmap.mmap(fd, self.size)
+            finally:
+                os.close(fd)
+
+        return
+
+    def write(self, index, data):
+        """
+        Replace the start of a slot with data
+        """
+        if len(data) > self.slots[index][1]:
+            self.logger.error('{} bytes do not fit slot {} of {} bytes'.format(len(data), index, self.slots[index][1]))
+            raise ValueError
+        data = data.tobytes() if isinstance(data, memoryview) else bytes(data)
+
+        def copy(memory, start):
+            memory[start:start + len(data)] = data
+
+        self._write(index, copy)
+
+    def read(self, index):
+        """
+        Returns (version, data) for a slot, version counts the writes to the
+        slot so it is 0 until the slot is first written
+        """
+        size = self.slots[index][1]
+        return self._read(index, lambda memory, start: memory[start:start + size])
+
+    def _write(self, index, function):
+        # function(memory, start) changes the slot starting at start
+        offset = self.slots[index][0]
+        sequence = SHARED_SEQUENCE.unpack_from(self.memory, offset)[0]
+        SHARED_SEQUENCE.pack_into(self.memory, offset, sequence + 1)
+        try:
+            function(self.memory, offset + SHARED_SEQUENCE.size)
+        finally:
+            SHARED_SEQUENCE.pack_into(self.memory, offset, sequence + 2)
+
+    def _read(self, index, function):
+        # function(memory, start) copies what is wanted from the slot
+        offset = self.slots[index][0]
+        start = offset + SHARED_SEQUENCE.size
+        deadline = None
+        while True:
+            sequence = SHARED_SEQUENCE.unpack_from(self.memory, offset)[0]
+            if not sequence & 1:
+                result = function(self.memory, start)
+                if SHARED_SEQUENCE.unpack_from(self.memory, offset)[0] == sequence:
+                    return sequence >> 1, result
+            if deadline is None:
+                # Try again straight away first, the writer is usually done
+                deadline = time.time() + SHARED_READ_TIMEOUT
+                continue
+            if time.time() > deadline:
+                self.logger.error('Slot {} still being written after {}s'.format(index, SHARED_READ_TIMEOUT))
+                raise ValueError
+            time.sleep(SHARED_READ_BACKOFF)
+
+    def version(self, index):
+        """
+        Returns the number of writes to a slot that have finished
+        """
+        return SHARED_SEQUENCE.unpack_from(self.memory, self.slots[index][0])[0] >> 1
+
+    def close(self):
+        self.logger.debug('close()')
+        self.memory.close()
+
+class StatusTable(SharedTable):
+    """
+    Latest frame of every status packet in shared memory
+    Each packet has a slot laid out as its whole frame, so the element
+    values sit at the offsets of the packet's struct format after the
+    header.  Producers publish() packets, possibly from other processes,
+    and senders take the frame or the values of a consistent version
+    without a lock.  Every process must create the table from packets with
+    the same IDs and formats.  Only one producer may publish each packet.
+    """
+    def __init__(self, packets, path=None):
+        SharedTable.__init__(self, [0 if pkt is None else pkt.size for pkt in packets], path)
+
+        self.packets = list(packets)
+        return
+
+    def publish(self, pkt):
+        """
+        Make the current values of pkt the latest version
+        """
+        self.write(pkt.id, pkt.pack())
+
+    def frame(self, packet_id):
+        """
+        Returns (version, frame) of the latest version of a packet
+        """
+        return self.read(packet_id)
+
+    def values(self, packet_id):
+        """
+        Returns (version, element values) of the latest version of a packet
+        """
+        unpack_from = self.packets[packet_id]._struct.unpack_from
+        return self._read(packet_id, lambda memory, start: unpack_from(memory, start + packet.PACKET_HEADER.size))
+
+    def read_into(self, pkt):
+        """
+        Set the elements of pkt to the latest version
+        Returns the version
+        """
+        version, values = self.values(pkt.id)
+        pkt._set_values(values)
+        return version
+
+if __name__ == '__main__':
+    import argparse
+    import multiprocessing
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test the shared table with a writer process')
+
+    parser.add_argument('-n', '--num_writes',
+                        help='Number of writes by the writer process',
+                        type=int,
+                        default=100000)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    # Every write fills the slot with one repeated count so torn reads show
+    record = struct.Struct('64I')
+    my_table = SharedTable([0, record.size])
+
+    def writer():
+        for count in range(1, args.num_writes + 1):
+            my_table.write(1, record.pack(*([count] * 64)))
+
+    process = multiprocessing.Process(target=writer)
+    start = time.time()
+    process.start()
+    reads = 0
+    last = 0
+    while last < args.num_writes:
+        version, data = my_table.read(1)
+        values = record.unpack(data)
+        assert values.count(values[0]) == 64, 'Torn read'
+        assert values[0] >= last
+        last = values[0]
+        reads += 1
+    process.join()
+    print('{} writes and {} consistent reads in {:.3f} s'.format(my_table.version(1), reads, time.time() - start))
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import(print_function)
+
+__version__ = filter(str.isdigit, '$Revision: $')
+
+import collections
+import errno
+import logging
+import os
+import random
+import socket
+import struct
+import time
+import crc8
+import packet
+
+UDP_MAX_SIZE = 1472 # Largest datagram that fits an Ethernet frame
+UDP_MAX_DATAGRAM = 65507 # Largest UDP datagram over IPv4
+UDP_RECV_SIZE = 0x10000 # Read size that takes any datagram whole
+UDP_MAX_SESSIONS = 16 # Publisher sessions whose sequence numbers are remembered
+UDP_TTL = 1 # Multicast stays on the local network
+UDP_MEMBERSHIP = struct.Struct('4s4s')
+
+def is_multicast(addr):
+    return 224 <= int(addr.split('.')[0]) <= 239
+
+class DatagramPublisher(object):
+    """
+    Sends status packets as UDP datagrams to a multicast group (or a single
+    address), so one send reaches every subscriber on the network
+    Each datagram starts with a packet.datagram_packet() frame holding the
+    session, sequence number and time it was sent, followed by as many
+    whole frames as fit in max_size bytes, a larger frame goes in a datagram
+    of its own and a frame too large for any datagram is dropped.  Nothing
+    is queued, a datagram the socket does not take is dropped as a slow TCP
+    client's updates are.
+    Use with MyServer.add_publisher().
+    """
+    def __init__(self, address, interface=None, ttl=UDP_TTL, loopback=True, max_size=UDP_MAX_SIZE):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.address = address
+        self.max_size = max_size
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if is_multicast(address[0]):
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 if loopback else 0)
+            if interface is not None:
+                self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.socket.setblocking(0)
+        self.header = packet.datagram_packet(session=random.getrandbits(32))
+        self.logger.info('Publishing to {}:{} session 0x{:08x}'.format(address[0], address[1], self.header.session))
+
+        self.datagrams = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+
+        return
+
+    def send(self, data):
+        """
+        Send a buffer of whole frames in as few datagrams as possible
+        Returns False if any datagram was dropped
+        """
+        sent = True
+        start = 0
+        while start < len(data):
+            # Take whole frames up to max_size bytes, a larger frame goes alone
+            end = start
+            size = self.header.size
+            while end < len(data):
+                length = packet.PACKET_HEADER.unpack_from(data, end)[2]
+                if end > start and size + length > self.max_size:
+                    break
+                size += length
+                end += length
+            if size > UDP_MAX_DATAGRAM:
+                self.logger.warning('Frame of {} bytes is too large for a datagram, dropped'.format(end - start))
+                self.dropped += 1
+                sent = False
+            elif not self._send(data[start:end]):
+                sent = False
+            start = end
+        return sent
+
+    def _send(self, frames):
+        self.header.sequence += 1
+        self.header.timestamp = time.time()
+        datagram = self.header.pack() + frames
+        try:
+            self.socket.sendto(datagram, self.address)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                raise
+            self.dropped += 1
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('Datagram {} dropped {}'.format(self.header.sequence, repr(e)))
+            return False
+        self.datagrams += 1
+        self.bytes_sent += len(datagram)
+        return True
+
+    def close(self):
+        self.logger.debug('close()')
+        self.socket.close()
+
+class DatagramTransport(object):
+    """
+    Receiving end of a DatagramPublisher, used as the transport of a
+    MyClient (MyClient(transport=DatagramTransport(address)))
+    Joins the multicast group when the address is one.  recv_into() takes
+    one datagram straight into the decoder's buffer and checks the
+    datagram frame at its start, datagrams without a valid one, from an
+    older sequence number than the last accepted from the same session,
+    or sent more than max_age seconds ago (when set, this needs the clocks
+    of both ends to agree) are dropped by raising EAGAIN, so the client
+    only unpacks the frames of current datagrams.  The last sequence number
+    of the latest UDP_MAX_SESSIONS sessions is kept, a session not seen
+    before, such as a restarted publisher, is accepted from its first
+    datagram sent after the newest datagram accepted so far, so a late
+    datagram from an earlier run is still dropped.  MyClient reads
+    recv_size bytes from this transport so datagrams are never cut short.
+    Datagrams can not be sent to a multicast publisher, send() returns 0.
+    """
+    recv_size = UDP_RECV_SIZE
+
+    def __init__(self, address, interface='0.0.0.0', max_age=None):
+        self.logger = logging.getLogger(__name__)
+        self.logger.debug('__init__')
+
+        self.address = address
+        self.max_age = max_age
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            # Other subscribers on this host listen on the same port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if is_multicast(address[0]):
+            self.socket.bind(address)
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                   UDP_MEMBERSHIP.pack(socket.inet_aton(address[0]), socket.inet_aton(interface)))
+        else:
+            self.socket.bind(('' if interface == '0.0.0.0' else interface, address[1]))
+        self.socket.setblocking(0)
+        self.crc = crc8.CRC8()
+        self.header = packet.datagram_packet()
+        self.header_values = (packet.PACKET_START_BYTES[0], packet.PACKET_START_BYTES[1], self.header.size, self.header.id)
+        self.session = None # Session of the last datagram accepted
+        self.sequences = collections.OrderedDict() # Session -> last sequence number accepted
+        self.timestamp = None # Newest send time accepted
+
+        self.datagrams = 0
+        self.bad = 0
+        self.stale = 0
+        self.missed = 0
+
+        return
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def recv_into(self, view, size=0):
+        """
+        Receive one datagram into a writable memoryview, returns its size
+        """
+        size = size or len(view)
+        count = self.socket.recv_into(view, size)
+        if count >= size:
+            # Filled the view so the datagram may have been cut short
+            self.bad += 1
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        if not self._check(view, count):
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        return count
+
+    def recv(self, size):
+        data = self.socket.recv(size)
+        if not self._check(data, len(data)):
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        return data
+
+    def _check(self, data, count):
+        # Returns True if the datagram is current
+        header = self.header
+        if count < header.size or packet.PACKET_HEADER.unpack_from(data) != self.header_values:
+            # Too short or does not start with a datagram frame
+            self.bad += 1
+            return False
+        data_size = header.size - packet.PACKET_OVERHEAD
+        if self.crc.calculate_from(data, packet.PACKET_HEADER.size, data_size) != packet.PACKET_CRC.unpack_from(data, header.size - packet.PACKET_CRC.size)[0]:
+            self.bad += 1
+            return False
+        sequence, timestamp, session = header._struct.unpack_from(data, packet.PACKET_HEADER.size)
+        last = self.sequences.get(session)
+        if last is None:
+            if self.timestamp is not None and timestamp <= self.timestamp:
+                # Sent before datagrams already accepted, from a session
+                # that has been forgotten or never seen
+                self.stale += 1
+                return False
+        elif sequence <= last:
+            self.stale += 1
+            return False
+        if self.max_age is not None and time.time() - timestamp > self.max_age:
+            self.stale += 1
+            return False
+        if last is None:
+            self.logger.info('Publisher session 0x{:08x} started'.format(session))
+            if len(self.sequences) >= UDP_MAX_SESSIONS:
+                self.sequences.popitem(last=False)
+        else:
+            self.missed += sequence - last - 1
+            del self.sequences[session]
+        self.sequences[session] = sequence
+        self.session = session
+        self.timestamp = timestamp if self.timestamp is None else max(timestamp, self.timestamp)
+        self.datagrams += 1
+        return True
+
+    def send(self, data):
+        self.logger.warning('Datagram transport can not send')
+        return 0
+
+    def close(self):
+        self.logger.debug('close()')
+        self.socket.close()
+
+if __name__ == '__main__':
+    import argparse
+    import threading
+    import client
+    import server
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description='Test status packets over loopback multicast')
+
+    parser.add_argument('-g', '--group',
+                        help='Multicast group to publish to',
+                        default='239.255.42.99')
+    parser.add_argument('-p', '--port',
+                        help='UDP port to publish to',
+                        type=int,
+                        default=42999)
+    parser.add_argument('-n', '--num_clients',
+                        help='Number of clients to receive the status packets',
+                        type=int,
+                        default=4)
+    parser.add_argument('-v', '--verbose',
+                        help='Set verbosity level',
+                        action='count',
+                        default=0)
+
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: [%(levelname)-7s] %(name)-10s| %(message)s')
+    root_logger = logging.getLogger()
+
+    if args.verbose > 1:
+        root_logger.setLevel(logging.DEBUG)
+    elif args.verbose > 0:
+        root_logger.setLevel(logging.INFO)
+
+    def status_packets():
+        return [packet.Packet(format='If', id=0x01, name='Status', element_names=['count', 'value'], element_values=[0, 0.0]),
+                packet.Packet(format='256d', id=0x02, name='Samples', element_names=['sample_{}'.format(index) for index in range(256)],
+                              element_values=[0.0] * 256),
+                # Larger than a receive chunk, sent in a datagram of its own
+                packet.Packet(format='600d', id=0x03, name='Waveform', element_names=['point_{}'.format(index) for index in range(600)],
+                              element_values=[0.0] * 600)]
+
+    my_server = server.MyEventServer('127.0.0.1', 0)
+    for pkt in status_packets():
+        my_server.add_packet(pkt)
+        my_server.add_status(pkt.id)
+    my_publisher = DatagramPublisher((args.group, args.port), '127.0.0.1')
+    my_server.add_publisher(my_publisher, interval=0.01, keepalive=None)
+
+    my_clients = []
+    for index in range(args.num_clients):
+        my_client = client.MyClient(transport=DatagramTransport((args.group, args.port), '127.0.0.1'))
+        for pkt in status_packets():
+            my_client.add_packet(pkt)
+        my_clients.append(my_client)
+
+    server_thread = threading.Thread(target=my_server.start)
+    server_thread.setDaemon(True)
+    server_thread.start()
+
+    # Datagrams that must be rejected, sent straight to the group
+    rogue = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rogue.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton('127.0.0.1'))
+    corrupt = bytearray(packet.datagram_packet(1, time.time(), 0x1234).pack() + my_server.packet_list[0x01].pack())
+    corrupt[10] ^= 0xff
+
+    for count in range(1, 101):
+        with my_server.packet_list_lock:
+            my_server.packet_list[0x01].count = count
+            my_server.packet_list[0x02].sample_0 = count
+            my_server.packet_list[0x03].point_599 = count
+        if count == 50:
+            rogue.sendto(bytes(corrupt), (args.group, args.port))
+            rogue.sendto(b'garbage', (args.group, args.port))
+            # Replay of the publisher's first datagram
+            stale = packet.datagram_packet(1, time.time(), my_publisher.header.session).pack() + my_server.packet_list[0x01].pack()
+            rogue.sendto(stale, (args.group, args.port))
+            # Late datagram from an earlier publisher run
+            stale = packet.datagram_packet(1000, time.time() - 10.0, 0x5678).pack() + my_server.packet_list[0x01].pack()
+            rogue.sendto(stale, (args.group, args.port))
+        # The last update is given time to arrive
+        end = time.time() + (0.1 if count == 100 else 0.01)
+        while time.time() < end:
+            for my_client in my_clients:
+                my_client.process_input(0.001)
+    my_server.stop()
+
+    print('Published {} datagrams, {} bytes, {} dropped'.format(my_publisher.datagrams, my_publisher.bytes_sent, my_publisher.dropped))
+    for index, my_client in enumerate(my_clients):
+        transport = my_client.transport
+        print('Client {} count {} sample_0 {} point_599 {} datagrams {} bad {} stale {} missed {}'.format(
+            index, my_client.packet_list[0x01].count, my_client.packet_list[0x02].sample_0, my_client.packet_list[0x03].point_599,
+            transport.datagrams, transport.bad, transport.stale, transport.missed))
+        assert my_client.packet_list[0x01].count == 100
+        assert my_client.packet_list[0x03].point_599 == 100
+        assert transport.bad == 2 and transport.stale == 2
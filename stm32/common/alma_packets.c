@@ -0,0 +1,78 @@
+/* Generated by schema.py from packets.json, do not edit */
+#include <string.h>
+#include "alma_packets.h"
+#include "crc8.h"
+
+/* The structs must have the sizes of the Python struct formats */
+typedef char alma_server_value_size_check[(sizeof(alma_server_value) == 4) ? 1 : -1];
+typedef char alma_server_value_2_size_check[(sizeof(alma_server_value_2) == 4) ? 1 : -1];
+typedef char alma_negotiate_size_check[(sizeof(alma_negotiate) == 1) ? 1 : -1];
+typedef char alma_subscribe_size_check[(sizeof(alma_subscribe) == 40) ? 1 : -1];
+
+static inline uint16_t pack_frame(uint8_t id, const void *values, uint16_t size, uint8_t *frame)
+{
+    uint16_t length = size + ALMA_PACKET_OVERHEAD;
+
+    frame[0] = ALMA_PACKET_START_0;
+    frame[1] = ALMA_PACKET_START_1;
+    frame[2] = length & 0xff;
+    frame[3] = length >> 8;
+    frame[4] = id;
+    memcpy(frame + ALMA_PACKET_HEADER_SIZE, values, size);
+    frame[length - 1] = crc8_calculate(frame + ALMA_PACKET_HEADER_SIZE, size);
+    return length;
+}
+
+static inline int unpack_frame(uint8_t id, void *values, uint16_t size, const uint8_t *frame, uint16_t length)
+{
+    if (length != size + ALMA_PACKET_OVERHEAD ||
+        frame[0] != ALMA_PACKET_START_0 || frame[1] != ALMA_PACKET_START_1 ||
+        (frame[2] | (frame[3] << 8)) != length || frame[4] != id) {
+        return -1;
+    }
+    if (frame[length - 1] != crc8_calculate(frame + ALMA_PACKET_HEADER_SIZE, size)) {
+        return -1;
+    }
+    memcpy(values, frame + ALMA_PACKET_HEADER_SIZE, size);
+    return 0;
+}
+
+uint16_t alma_server_value_pack(const alma_server_value *values, uint8_t *frame)
+{
+    return pack_frame(ALMA_SERVER_VALUE_ID, values, sizeof(alma_server_value), frame);
+}
+
+int alma_server_value_unpack(alma_server_value *values, const uint8_t *frame, uint16_t length)
+{
+    return unpack_frame(ALMA_SERVER_VALUE_ID, values, sizeof(alma_server_value), frame, length);
+}
+
+uint16_t alma_server_value_2_pack(const alma_server_value_2 *values, uint8_t *frame)
+{
+    return pack_frame(ALMA_SERVER_VALUE_2_ID, values, sizeof(alma_server_value_2), frame);
+}
+
+int alma_server_value_2_unpack(alma_server_value_2 *values, const uint8_t *frame, uint16_t length)
+{
+    return unpack_frame(ALMA_SERVER_VALUE_2_ID, values, sizeof(alma_server_value_2), frame, length);
+}
+
+uint16_t alma_negotiate_pack(const alma_negotiate *values, uint8_t *frame)
+{
+    return pack_frame(ALMA_NEGOTIATE_ID, values, sizeof(alma_negotiate), frame);
+}
+
+int alma_negotiate_unpack(alma_negotiate *values, const uint8_t *frame, uint16_t length)
+{
+    return unpack_frame(ALMA_NEGOTIATE_ID, values, sizeof(alma_negotiate), frame, length);
+}
+
+uint16_t alma_subscribe_pack(const alma_subscribe *values, uint8_t *frame)
+{
+    return pack_frame(ALMA_SUBSCRIBE_ID, values, sizeof(alma_subscribe), frame);
+}
+
+int alma_subscribe_unpack(alma_subscribe *values, const uint8_t *frame, uint16_t length)
+{
+    return unpack_frame(ALMA_SUBSCRIBE_ID, values, sizeof(alma_subscribe), frame, length);
+}
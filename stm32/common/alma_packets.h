@@ -0,0 +1,62 @@
+/* Generated by schema.py from packets.json, do not edit */
+#ifndef ALMA_PACKETS_H
+#define ALMA_PACKETS_H
+
+#include <stdint.h>
+
+#if defined(__BYTE_ORDER__) && __BYTE_ORDER__ != __ORDER_LITTLE_ENDIAN__
+#error "The packet structs are copied as they are and must be little endian"
+#endif
+
+#define ALMA_PACKET_START_0        0xa1
+#define ALMA_PACKET_START_1        0x95
+#define ALMA_PACKET_HEADER_SIZE    5
+#define ALMA_PACKET_OVERHEAD       6
+
+/* Server Value */
+#define ALMA_SERVER_VALUE_ID 0x01
+#define ALMA_SERVER_VALUE_SIZE 10 /* Whole frame */
+
+typedef struct __attribute__((packed)) alma_server_value {
+    float value;
+} alma_server_value;
+
+uint16_t alma_server_value_pack(const alma_server_value *values, uint8_t *frame);
+int alma_server_value_unpack(alma_server_value *values, const uint8_t *frame, uint16_t length);
+
+/* Server Value 2 */
+#define ALMA_SERVER_VALUE_2_ID 0x02
+#define ALMA_SERVER_VALUE_2_SIZE 10 /* Whole frame */
+
+typedef struct __attribute__((packed)) alma_server_value_2 {
+    float value_2;
+} alma_server_value_2;
+
+uint16_t alma_server_value_2_pack(const alma_server_value_2 *values, uint8_t *frame);
+int alma_server_value_2_unpack(alma_server_value_2 *values, const uint8_t *frame, uint16_t length);
+
+/* Negotiate */
+#define ALMA_NEGOTIATE_ID 0xfc
+#define ALMA_NEGOTIATE_SIZE 7 /* Whole frame */
+
+typedef struct __attribute__((packed)) alma_negotiate {
+    uint8_t capabilities;
+} alma_negotiate;
+
+uint16_t alma_negotiate_pack(const alma_negotiate *values, uint8_t *frame);
+int alma_negotiate_unpack(alma_negotiate *values, const uint8_t *frame, uint16_t length);
+
+/* Subscribe */
+#define ALMA_SUBSCRIBE_ID 0xfe
+#define ALMA_SUBSCRIBE_SIZE 46 /* Whole frame */
+
+typedef struct __attribute__((packed)) alma_subscribe {
+    float interval;
+    float keepalive;
+    char packet_ids[32];
+} alma_subscribe;
+
+uint16_t alma_subscribe_pack(const alma_subscribe *values, uint8_t *frame);
+int alma_subscribe_unpack(alma_subscribe *values, const uint8_t *frame, uint16_t length);
+
+#endif
@@ -1,4 +1,5 @@
 #include "packet.h"
+#include "alma_packets.h"
 #include <stdio.h>
 
 // Test code for checking out the functionality of the common code.
@@ -14,5 +15,16 @@ int main(void)
 
     printf("CRC8 = 0x%02x\n", packet_calc_crc(&my_packet));
 
+    // Frame of a packet generated from packets.json
+    alma_server_value my_value = {1.5f};
+    uint8_t frame[ALMA_SERVER_VALUE_SIZE];
+    uint16_t length = alma_server_value_pack(&my_value, frame);
+
+    printf("Server Value frame =");
+    for (uint16_t index = 0; index < length; index++) {
+        printf(" %02x", frame[index]);
+    }
+    printf("\n");
+
     return 0;
 }